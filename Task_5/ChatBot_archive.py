@@ -0,0 +1,280 @@
+import json
+import os
+import sqlite3
+import threading
+import zlib
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+
+SEGMENT_SIZE = 64 * 1024 * 1024
+BLOCK_ROWS = 1000
+VACUUM_PAGES = 2000
+
+class ArchiveStore:
+    """Append-only, compressed archive of messages moved out of the messages table
+
+    Messages are written in blocks of up to BLOCK_ROWS rows of one room, each a
+    zlib-compressed JSON list of (id, username, message, message_type, timestamp, seq)
+    appended to the current segment file. Segments roll over at SEGMENT_SIZE and are
+    never rewritten, so backups only need to copy new files. The index, one row per
+    block with the room and id range it covers, lives in the archive_blocks table.
+    """
+    def __init__(self, directory, segment_size=SEGMENT_SIZE, cache_blocks=16):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.cache_blocks = cache_blocks
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def create_schema(cursor):
+        """Create the block index and the per-room retention policy table"""
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS room_retention (
+                room TEXT PRIMARY KEY,
+                max_age_days REAL,
+                max_messages INTEGER
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS archive_blocks (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                room TEXT NOT NULL,
+                first_id INTEGER NOT NULL,
+                last_id INTEGER NOT NULL,
+                first_timestamp TEXT NOT NULL,
+                last_timestamp TEXT NOT NULL,
+                row_count INTEGER NOT NULL,
+                segment TEXT NOT NULL,
+                offset INTEGER NOT NULL,
+                length INTEGER NOT NULL,
+                last_seq INTEGER
+            )
+        ''')
+        cursor.execute("PRAGMA table_info(archive_blocks)")
+        if 'last_seq' not in [column[1] for column in cursor.fetchall()]:
+            cursor.execute("ALTER TABLE archive_blocks ADD COLUMN last_seq INTEGER")
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_archive_blocks_room ON archive_blocks (room, last_id)"
+        )
+
+    def current_segment(self):
+        """Name of the segment new blocks go to, starting a new one when it is full"""
+        segments = sorted(name for name in os.listdir(self.directory) if name.startswith('segment-'))
+        if segments:
+            last = segments[-1]
+            if os.path.getsize(os.path.join(self.directory, last)) < self.segment_size:
+                return last
+            number = int(last[8:14]) + 1
+        else:
+            number = 1
+        return f"segment-{number:06d}.log"
+
+    def append(self, rows):
+        """Write one block of rows durably; returns (segment, offset, length)
+
+        Nothing refers to the block until the caller commits its index row, so a crash
+        in between only leaves unreferenced bytes behind.
+        """
+        data = zlib.compress(json.dumps(rows, separators=(',', ':')).encode(), 6)
+        segment = self.current_segment()
+        with open(os.path.join(self.directory, segment), 'ab') as f:
+            offset = f.tell()
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        return segment, offset, len(data)
+
+    def read_block(self, segment, offset, length):
+        """Rows of one block, oldest first"""
+        key = (segment, offset)
+        with self.lock:
+            rows = self.cache.get(key)
+            if rows is not None:
+                self.cache.move_to_end(key)
+                return rows
+        with open(os.path.join(self.directory, segment), 'rb') as f:
+            f.seek(offset)
+            rows = json.loads(zlib.decompress(f.read(length)))
+        with self.lock:
+            self.cache[key] = rows
+            while len(self.cache) > self.cache_blocks:
+                self.cache.popitem(last=False)
+        return rows
+
+    def blocks_before(self, cursor, room, before_id):
+        """Index entries of the blocks of room holding ids below before_id, newest first"""
+        if before_id is None:
+            cursor.execute(
+                "SELECT segment, offset, length FROM archive_blocks WHERE room = ? ORDER BY last_id DESC",
+                (room,)
+            )
+        else:
+            cursor.execute(
+                "SELECT segment, offset, length FROM archive_blocks WHERE room = ? AND first_id < ? "
+                "ORDER BY last_id DESC",
+                (room, before_id)
+            )
+        return cursor.fetchall()
+
+    def history(self, blocks, before_id, limit):
+        """Up to limit archived rows with id below before_id from blocks, newest first"""
+        found = []
+        for segment, offset, length in blocks:
+            for row in reversed(self.read_block(segment, offset, length)):
+                if before_id is None or row[0] < before_id:
+                    found.append(tuple(row))
+                    if len(found) == limit:
+                        return found
+        return found
+
+    def latest_seq(self, cursor, room):
+        """Highest sequence number of room in the archive, or None"""
+        cursor.execute("SELECT MAX(last_seq) FROM archive_blocks WHERE room = ?", (room,))
+        return cursor.fetchone()[0]
+
+    def latest_id(self, cursor):
+        """Highest message id in the archive, or 0"""
+        cursor.execute("SELECT COALESCE(MAX(last_id), 0) FROM archive_blocks")
+        return cursor.fetchone()[0]
+
+    def has_before(self, cursor, room, before_id):
+        cursor.execute(
+            "SELECT 1 FROM archive_blocks WHERE room = ? AND first_id < ? LIMIT 1", (room, before_id)
+        )
+        return cursor.fetchone() is not None
+
+def enable_incremental_vacuum(conn):
+    """Switch a database to incremental auto-vacuum
+
+    Databases created before retention existed need one full VACUUM for the switch,
+    which must run before anything else writes to the database.
+    """
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        print("Converting the database to incremental vacuum (one-time full VACUUM)...")
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("VACUUM")
+
+class RetentionJob:
+    """Background thread applying per-room retention policies
+
+    A message is archived once it is older than max_age_days or no longer among its
+    room's newest max_messages (None disables either limit). Rooms without a row in
+    room_retention use the defaults. Each block is appended to the archive first, then
+    indexed and deleted from messages in one transaction; freed pages are returned to
+    the filesystem with incremental vacuum, a bounded number of pages at a time so
+    the message writer is never locked out for long.
+    """
+    def __init__(self, db_path, archive, max_age_days=None, max_messages=None, interval=3600):
+        self.db_path = db_path
+        self.archive = archive
+        self.max_age_days = max_age_days
+        self.max_messages = max_messages
+        self.interval = interval
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='retention')
+        self.thread.daemon = True
+        self.archived = 0
+        self.vacuumed_pages = 0
+        self.runs = 0
+
+    def start(self):
+        self.thread.start()
+
+    def close(self):
+        self.stop_event.set()
+        if self.thread.is_alive():
+            self.thread.join()
+
+    def run(self):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            while not self.stop_event.is_set():
+                try:
+                    self.run_once(conn)
+                except sqlite3.Error as e:
+                    conn.rollback()
+                    print(f"Error applying message retention: {e}")
+                self.stop_event.wait(self.interval)
+        finally:
+            conn.close()
+
+    def policies(self, conn):
+        """{room: (max_age_days, max_messages)} for every room that has messages"""
+        overrides = {
+            room: (max_age_days, max_messages)
+            for room, max_age_days, max_messages in conn.execute(
+                "SELECT room, max_age_days, max_messages FROM room_retention"
+            )
+        }
+        rooms = [row[0] for row in conn.execute("SELECT DISTINCT room FROM messages")]
+        return {room: overrides.get(room, (self.max_age_days, self.max_messages)) for room in rooms}
+
+    def boundary(self, conn, room, max_age_days, max_messages):
+        """Messages of room with an id below the returned one are due for archiving"""
+        boundary = 0
+        if max_messages is not None:
+            row = conn.execute(
+                "SELECT id FROM messages WHERE room = ? ORDER BY id DESC LIMIT 1 OFFSET ?",
+                (room, max_messages)
+            ).fetchone()
+            if row:
+                boundary = row[0] + 1
+        if max_age_days is not None:
+            cutoff = (datetime.now(timezone.utc) - timedelta(days=max_age_days)).strftime('%Y-%m-%d %H:%M:%S')
+            # Ids follow posting order, so the first young message ends the old ones
+            row = conn.execute(
+                "SELECT id FROM messages WHERE room = ? AND timestamp >= ? ORDER BY id LIMIT 1",
+                (room, cutoff)
+            ).fetchone()
+            if row:
+                boundary = max(boundary, row[0])
+            else:
+                boundary = max(boundary, conn.execute(
+                    "SELECT COALESCE(MAX(id), 0) + 1 FROM messages WHERE room = ?", (room,)
+                ).fetchone()[0])
+        return boundary
+
+    def run_once(self, conn):
+        """Archive everything the policies allow, then reclaim the freed pages"""
+        for room, (max_age_days, max_messages) in self.policies(conn).items():
+            if max_age_days is None and max_messages is None:
+                continue
+            boundary = self.boundary(conn, room, max_age_days, max_messages)
+            while boundary and not self.stop_event.is_set():
+                rows = conn.execute(
+                    "SELECT id, username, message, message_type, timestamp, seq FROM messages "
+                    "WHERE room = ? AND id < ? ORDER BY id LIMIT ?",
+                    (room, boundary, BLOCK_ROWS)
+                ).fetchall()
+                if not rows:
+                    break
+                self.archive_block(conn, room, rows)
+        self.vacuum(conn)
+        self.runs += 1
+
+    def archive_block(self, conn, room, rows):
+        segment, offset, length = self.archive.append(rows)
+        conn.execute(
+            "INSERT INTO archive_blocks (room, first_id, last_id, first_timestamp, last_timestamp, "
+            "row_count, segment, offset, length, last_seq) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (room, rows[0][0], rows[-1][0], rows[0][4], rows[-1][4], len(rows), segment, offset, length,
+             max((row[5] for row in rows if row[5] is not None), default=None))
+        )
+        # By id, not by range: another worker may still commit an older id meanwhile
+        conn.executemany("DELETE FROM messages WHERE id = ?", [(row[0],) for row in rows])
+        conn.commit()
+        self.archived += len(rows)
+
+    def vacuum(self, conn):
+        # Without incremental auto-vacuum (policy added at runtime) freed pages stay until restart
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            return
+        while not self.stop_event.is_set():
+            free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+            if not free:
+                return
+            # executescript runs the pragma to completion; execute() would free one page
+            conn.executescript(f"PRAGMA incremental_vacuum({VACUUM_PAGES})")
+            self.vacuumed_pages += min(free, VACUUM_PAGES)
@@ -0,0 +1,68 @@
+import hashlib
+import hmac
+import os
+import time
+import json
+import base64
+
+# scrypt cost parameters; hashes made with other parameters are upgraded on login
+SCRYPT_N = 2 ** 14
+SCRYPT_R = 8
+SCRYPT_P = 1
+SALT_BYTES = 16
+
+def hash_password(password):
+    """Hash password with a random salt using scrypt"""
+    salt = os.urandom(SALT_BYTES)
+    digest = hashlib.scrypt(password.encode(), salt=salt, n=SCRYPT_N, r=SCRYPT_R, p=SCRYPT_P, dklen=32)
+    return f"scrypt${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}${salt.hex()}${digest.hex()}"
+
+def verify_password(password, stored_hash):
+    """Check password against a stored hash
+
+    Returns (matches, needs_rehash). Legacy unsalted SHA-256 hashes still verify
+    but always need a rehash.
+    """
+    if stored_hash.startswith('scrypt$'):
+        _, n, r, p, salt, digest = stored_hash.split('$')
+        n, r, p = int(n), int(r), int(p)
+        candidate = hashlib.scrypt(password.encode(), salt=bytes.fromhex(salt), n=n, r=r, p=p, dklen=len(digest) // 2)
+        matches = hmac.compare_digest(candidate.hex(), digest)
+        return matches, (n, r, p) != (SCRYPT_N, SCRYPT_R, SCRYPT_P)
+
+    legacy = hashlib.sha256(password.encode()).hexdigest()
+    return hmac.compare_digest(legacy, stored_hash), True
+
+class SessionTokens:
+    """Signed, expiring session tokens that are validated in memory
+
+    A token is base64url(json [username, expiry, nonce]) plus an HMAC-SHA256 signature,
+    so resuming a session needs neither a database query nor a KDF. Tokens only survive
+    a server restart if the same secret is configured.
+    """
+    def __init__(self, secret=None, ttl=3600):
+        self.secret = secret.encode() if isinstance(secret, str) else (secret or os.urandom(32))
+        self.ttl = ttl
+
+    def sign(self, payload):
+        return base64.urlsafe_b64encode(hmac.new(self.secret, payload, hashlib.sha256).digest()).rstrip(b'=')
+
+    def issue(self, username):
+        """Create a token for username; returns (token, expiry timestamp)"""
+        expires = int(time.time()) + self.ttl
+        body = json.dumps([username, expires, os.urandom(6).hex()]).encode()
+        payload = base64.urlsafe_b64encode(body).rstrip(b'=')
+        return (payload + b'.' + self.sign(payload)).decode(), expires
+
+    def validate(self, token):
+        """Return the username a token was issued to, or None if it is forged or expired"""
+        try:
+            payload, signature = token.encode().split(b'.')
+            if not hmac.compare_digest(signature, self.sign(payload)):
+                return None
+            username, expires, _ = json.loads(base64.urlsafe_b64decode(payload + b'=' * (-len(payload) % 4)))
+        except (ValueError, TypeError, AttributeError):
+            return None
+        if expires < time.time():
+            return None
+        return username
@@ -0,0 +1,848 @@
+import asyncio
+import argparse
+import base64
+import contextlib
+import hashlib
+import itertools
+import json
+import math
+import os
+import random
+import re
+import signal
+import socket
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from collections import Counter, deque
+from ChatBot_protocol import (encode_frame, FrameDecoder, WireCipher, WIRE_VERSIONS,
+                              compress_payload, decompress_payload, COMPRESSION_THRESHOLD)
+from ChatBot_server import ChatServer
+from ChatBot_codec import CODECS, DEFAULT_CODECS, dumps, loads
+from ChatBot_auth import SessionTokens, hash_password
+from ChatBot_files import CHUNK_SIZE
+from ChatBot_session import ClientSession
+from ChatBot_metrics import MetricsRegistry
+from ChatBot_ratelimit import DEFAULT_RATE_LIMITS
+from cryptography.fernet import Fernet
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a list of numbers"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+def latency_summary(samples):
+    """p50/p95/p99/max of latency samples in seconds, reported in milliseconds"""
+    if not samples:
+        return {'count': 0}
+    return {
+        'count': len(samples),
+        'mean_ms': round(statistics.mean(samples) * 1000, 3),
+        'p50_ms': round(percentile(samples, 50) * 1000, 3),
+        'p95_ms': round(percentile(samples, 95) * 1000, 3),
+        'p99_ms': round(percentile(samples, 99) * 1000, 3),
+        'max_ms': round(max(samples) * 1000, 3)
+    }
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+# Benchmarks measure capacity, which per-user rate limits would hide
+NO_RATE_LIMITS = dict.fromkeys(DEFAULT_RATE_LIMITS)
+
+def start_local_server(workdir, **options):
+    """Run a ChatServer in asyncio mode on a background thread against a scratch database"""
+    options.setdefault('rate_limits', NO_RATE_LIMITS)
+    server = ChatServer('127.0.0.1', free_port(), db_path=os.path.join(workdir, 'bench.db'), **options)
+    thread = threading.Thread(target=server.start_async_server)
+    thread.daemon = True
+    thread.start()
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((server.host, server.port)).close()
+            return server
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError("Benchmark server did not start")
+
+class BenchConnection:
+    """Minimal asyncio protocol client speaking the same wire format as ChatClient"""
+    def __init__(self, cipher, version=1, codec='json'):
+        self.cipher = cipher
+        self.version = version
+        self.codec = codec
+        self.compression = None
+        self.compression_threshold = COMPRESSION_THRESHOLD
+        self.decoder = FrameDecoder()
+        self.pending = deque()
+        self.reader = None
+        self.writer = None
+
+    async def connect(self, host, port):
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+
+    async def negotiate(self, codecs=DEFAULT_CODECS):
+        """Offer the same connection options as ChatClient and adopt what the server picks"""
+        self.send({'type': 'hello', 'versions': list(WIRE_VERSIONS), 'codecs': list(codecs), 'compression': ['zlib']})
+        welcome = await self.receive_type('welcome')
+        self.version = welcome.get('version', 1)
+        self.codec = welcome.get('codec', 'json')
+        self.compression = welcome.get('compression')
+        self.compression_threshold = welcome.get('compression_threshold', COMPRESSION_THRESHOLD)
+        return welcome
+
+    def send(self, data):
+        payload = dumps(data, self.codec)
+        if self.compression:
+            payload = compress_payload(payload, self.compression_threshold)
+        self.writer.write(encode_frame(self.cipher.encrypt(payload, self.version)))
+
+    async def receive(self):
+        while not self.pending:
+            chunk = await self.reader.read(65536)
+            if not chunk:
+                raise ConnectionError("Server closed the connection")
+            for frame in self.decoder.feed(chunk):
+                self.pending.append(loads(decompress_payload(self.cipher.decrypt(frame))))
+        return self.pending.popleft()
+
+    async def receive_type(self, message_type):
+        while True:
+            data = await self.receive()
+            if data['type'] == message_type:
+                return data
+
+    async def login(self, username, password):
+        self.send({'type': 'auth', 'action': 'login', 'username': username, 'password': password})
+        return await self.receive_type('auth_result')
+
+    async def resume(self, token):
+        self.send({'type': 'auth', 'action': 'resume', 'token': token})
+        return await self.receive_type('auth_result')
+
+    def close(self):
+        if self.writer:
+            self.writer.close()
+
+def seed_users(server, count, password='bench-password', prefix='user'):
+    """Insert benchmark users directly, sharing one precomputed hash"""
+    password_hash = server.hash_password(password)
+    conn = sqlite3.connect(server.db_path)
+    conn.executemany(
+        "INSERT OR IGNORE INTO users (username, password_hash) VALUES (?, ?)",
+        [(f"{prefix}{i}", password_hash) for i in range(count)]
+    )
+    conn.commit()
+    conn.close()
+    return password
+
+async def chat_probe(server, password, stop, samples, interval=0.01):
+    """Measure message delivery latency between two users while the benchmark runs"""
+    sender, receiver = BenchConnection(server.wire), BenchConnection(server.wire)
+    for conn, name in ((sender, 'probe0'), (receiver, 'probe1')):
+        await conn.connect(server.host, server.port)
+        await conn.login(name, password)
+        conn.send({'type': 'join_room', 'room': 'bench-probe'})
+        await conn.receive_type('room_joined')
+
+    async def receive_loop():
+        while True:
+            data = await receiver.receive()
+            if data['type'] == 'message':
+                samples.append(time.perf_counter() - float(data['message']))
+
+    receiving = asyncio.ensure_future(receive_loop())
+    while not stop.is_set():
+        sender.send({'type': 'message', 'message': repr(time.perf_counter())})
+        await asyncio.sleep(interval)
+    await asyncio.sleep(0.2)
+    receiving.cancel()
+    sender.close()
+    receiver.close()
+
+async def run_login_burst(server, users, concurrency):
+    password = seed_users(server, users)
+    seed_users(server, 2, password, prefix='probe')
+    stop = asyncio.Event()
+    chat_samples = []
+    probe = asyncio.ensure_future(chat_probe(server, password, stop, chat_samples))
+    await asyncio.sleep(0.5)
+
+    # Idle-traffic baseline before the burst
+    baseline = list(chat_samples)
+    gate = asyncio.Semaphore(concurrency)
+    login_samples = []
+    failures = 0
+
+    async def one_login(i):
+        nonlocal failures
+        async with gate:
+            conn = BenchConnection(server.wire)
+            await conn.connect(server.host, server.port)
+            started = time.perf_counter()
+            result = await conn.login(f"user{i}", password)
+            login_samples.append(time.perf_counter() - started)
+            if not result['success']:
+                failures += 1
+            conn.close()
+
+    chat_samples.clear()
+    started = time.perf_counter()
+    await asyncio.gather(*(one_login(i) for i in range(users)))
+    elapsed = time.perf_counter() - started
+    during = list(chat_samples)
+    stop.set()
+    await probe
+
+    return {
+        'benchmark': 'login',
+        'users': users,
+        'concurrency': concurrency,
+        'auth_workers': server.auth_pool.workers,
+        'elapsed_s': round(elapsed, 3),
+        'logins_per_s': round(users / elapsed, 1),
+        'failed_logins': failures,
+        'busy_rejections': server.auth_pool.rejected,
+        'login_latency': latency_summary(login_samples),
+        'chat_latency_idle': latency_summary(baseline),
+        'chat_latency_during_burst': latency_summary(during)
+    }
+
+def bench_login(args):
+    """Login throughput under a burst, and how much chat latency suffers meanwhile"""
+    # The in-process server logs to stdout; keep stdout for the JSON results
+    with tempfile.TemporaryDirectory() as workdir, contextlib.redirect_stdout(sys.stderr):
+        server = start_local_server(workdir, auth_workers=args.auth_workers, max_pending_auth=args.max_pending_auth)
+        return asyncio.run(run_login_burst(server, args.users, args.concurrency))
+
+def sample_payloads():
+    """Representative plaintexts: a chat line, a 50-message history and an upload chunk"""
+    message = {'type': 'message', 'username': 'alice', 'message': 'see you at the standup in five',
+               'room': 'general', 'timestamp': '2024-01-01 12:00:00', 'message_type': 'text'}
+    history = {'type': 'room_joined', 'room': 'general', 'users': ['alice', 'bob'], 'has_more': True,
+               'before_id': 1000,
+               'history': [[f"user{i % 7}", f"message number {i} about topic {i * 31 % 97}",
+                            'text', '2024-01-01 12:00:00'] for i in range(50)]}
+    chunk = {'type': 'upload_chunk', 'sha256': '0' * 64, 'offset': 0,
+             'data': base64.b64encode(os.urandom(48 * 1024)).decode()}
+    return {'message': message, 'history': history, 'upload_chunk': chunk}
+
+def time_per_call(fn, iterations):
+    started = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (time.perf_counter() - started) / iterations
+
+def bench_wire(args):
+    """CPU time and bytes on the wire per message for each wire version"""
+    cipher = WireCipher(Fernet.generate_key())
+    results = {'benchmark': 'wire', 'iterations': args.iterations, 'payloads': {}}
+    for name, message in sample_payloads().items():
+        payload = json.dumps(message).encode()
+        if args.compress:
+            payload = compress_payload(payload)
+        versions = {}
+        for version in (1, 2):
+            frame = encode_frame(cipher.encrypt(payload, version))
+            encode_s = time_per_call(lambda: encode_frame(cipher.encrypt(payload, version)), args.iterations)
+            decode_s = time_per_call(lambda: cipher.decrypt(frame[4:]), args.iterations)
+            versions[f"v{version}"] = {
+                'frame_bytes': len(frame),
+                'overhead_bytes': len(frame) - len(payload),
+                'encode_us': round(encode_s * 1e6, 2),
+                'decode_us': round(decode_s * 1e6, 2)
+            }
+        versions['bytes_saved_pct'] = round(100 * (1 - versions['v2']['frame_bytes'] / versions['v1']['frame_bytes']), 1)
+        versions['cpu_speedup'] = round(
+            (versions['v1']['encode_us'] + versions['v1']['decode_us']) /
+            (versions['v2']['encode_us'] + versions['v2']['decode_us']), 2)
+        results['payloads'][name] = dict(plaintext_bytes=len(payload), **versions)
+    return results
+
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ChatBot_server.py')
+
+def raise_fd_limit():
+    """Allow as many sockets as the hard limit permits; thousands of clients need it"""
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft < hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+            return hard
+        return soft
+    except (ImportError, ValueError, OSError):
+        return None
+
+def process_tree_rss(pid):
+    """Resident memory in bytes of a process and all its descendants (Linux only)"""
+    parents = {}
+    try:
+        for entry in os.listdir('/proc'):
+            if entry.isdigit():
+                try:
+                    with open(f'/proc/{entry}/stat') as f:
+                        # Field 4 is the parent pid; the command name may contain spaces
+                        parents[int(entry)] = int(f.read().rsplit(')', 1)[1].split()[1])
+                except (OSError, IndexError, ValueError):
+                    pass
+    except OSError:
+        return None
+    tree, frontier = {pid}, [pid]
+    while frontier:
+        parent = frontier.pop()
+        children = [child for child, ppid in parents.items() if ppid == parent and child not in tree]
+        tree.update(children)
+        frontier.extend(children)
+    total = 0
+    for member in tree:
+        try:
+            with open(f'/proc/{member}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1]) * 1024
+        except OSError:
+            pass
+    return total
+
+class ServerProcess:
+    """ChatBot_server.py run as a child process, so its memory can be measured apart from the clients"""
+    def __init__(self, workdir, mode='async', workers=1, extra_args=()):
+        self.port = free_port()
+        self.metrics_port = free_port()
+        self.workers = workers
+        self.token_secret = os.urandom(16).hex()
+        command = [sys.executable, SERVER_SCRIPT, '--host', '127.0.0.1', '--port', str(self.port),
+                   '--mode', mode, '--workers', str(workers), '--token-secret', self.token_secret,
+                   '--metrics-port', str(self.metrics_port)]
+        command.extend(extra_args)
+        # Unbuffered, so the encryption key and any startup error show up straight away
+        env = dict(os.environ, PYTHONUNBUFFERED='1')
+        self.process = subprocess.Popen(command, cwd=workdir, env=env, stdout=subprocess.PIPE,
+                                        stderr=subprocess.STDOUT, text=True)
+        self.db_path = os.path.join(workdir, 'chat_app.db')
+        self.output = deque(maxlen=50)
+        self.key = None
+        key_seen = threading.Event()
+
+        def drain():
+            # The server logs every connection; keep reading so its pipe never fills up
+            for line in self.process.stdout:
+                self.output.append(line.rstrip())
+                match = re.match(r'Encryption key: (\S+)', line)
+                if match and self.key is None:
+                    self.key = match.group(1).encode()
+                    key_seen.set()
+            key_seen.set()
+
+        thread = threading.Thread(target=drain)
+        thread.daemon = True
+        thread.start()
+        if not key_seen.wait(30) or self.key is None:
+            self.stop()
+            raise RuntimeError("Benchmark server did not start:\n" + "\n".join(self.output))
+        self.wait_listening(workers)
+
+    def wait_listening(self, workers):
+        """Wait until every worker answers on its metrics port, which it opens once it listens
+
+        Workers share stdout, so their startup lines can interleave and cannot be counted.
+        """
+        deadline = time.monotonic() + 30
+        waiting = set(range(workers))
+        while time.monotonic() < deadline:
+            for index in list(waiting):
+                try:
+                    urllib.request.urlopen(f"http://127.0.0.1:{self.metrics_port + index}/metrics", timeout=1).close()
+                    waiting.discard(index)
+                except OSError:
+                    pass
+            if not waiting:
+                try:
+                    socket.create_connection(('127.0.0.1', self.port)).close()
+                    return
+                except OSError:
+                    pass
+            time.sleep(0.05)
+        self.stop()
+        raise RuntimeError("Benchmark server is not accepting connections")
+
+    def rss(self):
+        return process_tree_rss(self.process.pid)
+
+    def counters(self, names):
+        """Sum of the named unlabelled metrics over all workers; missing ones read as 0"""
+        totals = dict.fromkeys(names, 0)
+        for index in range(self.workers):
+            try:
+                with urllib.request.urlopen(f"http://127.0.0.1:{self.metrics_port + index}/metrics", timeout=5) as r:
+                    text = r.read().decode()
+            except OSError:
+                continue
+            for line in text.splitlines():
+                name, _, value = line.partition(' ')
+                if name in totals:
+                    totals[name] += float(value)
+        return totals
+
+    def stop(self):
+        if self.process.poll() is None:
+            self.process.send_signal(signal.SIGINT)
+            try:
+                self.process.wait(20)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+
+def parse_mix(text):
+    """'text=0.9,image=0.05,file=0.05' -> normalised weights"""
+    mix = {}
+    for part in text.split(','):
+        kind, _, weight = part.partition('=')
+        if kind not in ('text', 'image', 'file'):
+            raise argparse.ArgumentTypeError(f"Unknown message type in mix: {kind}")
+        mix[kind] = float(weight or 1)
+    total = sum(mix.values())
+    if total <= 0:
+        raise argparse.ArgumentTypeError("Payload mix weights must add up to more than 0")
+    return {kind: weight / total for kind, weight in mix.items()}
+
+class LoadClient:
+    """One simulated user: connects, authenticates, joins a room and chats at a fixed rate"""
+    def __init__(self, index, room, wire, stats):
+        self.index = index
+        self.username = f"load{index}"
+        self.room = room
+        self.conn = BenchConnection(wire)
+        self.stats = stats
+        self.uploads = {}
+        self.sequence = 0
+        self.sent = 0
+
+    async def setup(self, host, port, args, tokens):
+        started = time.perf_counter()
+        await self.conn.connect(host, port)
+        if not args.no_negotiate:
+            await self.conn.negotiate()
+        if args.login == 'token':
+            result = await self.conn.resume(tokens.issue(self.username)[0])
+        else:
+            result = await self.conn.login(self.username, args.password)
+        if not result['success']:
+            raise ConnectionError(result.get('error', 'authentication failed'))
+        self.conn.send({'type': 'join_room', 'room': self.room})
+        await self.conn.receive_type('room_joined')
+        return time.perf_counter() - started
+
+    async def receive_loop(self):
+        stats = self.stats
+        while True:
+            data = await self.conn.receive()
+            kind = data['type']
+            if kind == 'message':
+                now = time.perf_counter()
+                if data['message_type'] == 'text':
+                    key = data['message'].split(' ', 1)[0]
+                else:
+                    key = json.loads(data['message'])['sha256']
+                sent = stats['sent_at'].get(key)
+                if sent is not None:
+                    stats['latency'][data['message_type']].append(now - sent)
+                stats['delivered'][data['message_type']] += 1
+            elif kind in ('upload_ready', 'upload_complete', 'upload_failed'):
+                waiter = self.uploads.pop(data['sha256'], None)
+                if waiter is not None and not waiter.done():
+                    waiter.set_result(data)
+            elif kind == 'error':
+                stats['errors'][data.get('error', 'error')] += 1
+
+    async def upload(self, payload):
+        """Upload an attachment through the chunked protocol and return its hash"""
+        sha256 = hashlib.sha256(payload).hexdigest()
+        loop = asyncio.get_running_loop()
+        self.uploads[sha256] = loop.create_future()
+        self.conn.send({'type': 'upload_begin', 'sha256': sha256, 'size': len(payload)})
+        answer = await self.uploads[sha256]
+        if answer['type'] == 'upload_ready':
+            self.uploads[sha256] = loop.create_future()
+            for offset in range(answer['offset'], len(payload), CHUNK_SIZE):
+                self.conn.send({'type': 'upload_chunk', 'sha256': sha256, 'offset': offset,
+                                'data': base64.b64encode(payload[offset:offset + CHUNK_SIZE]).decode()})
+                await self.conn.writer.drain()
+            self.conn.send({'type': 'upload_end', 'sha256': sha256})
+            answer = await self.uploads[sha256]
+        if answer['type'] != 'upload_complete':
+            raise ConnectionError(answer.get('error', 'upload failed'))
+        return sha256
+
+    async def send_loop(self, args, deadline):
+        stats = self.stats
+        kinds, weights = zip(*args.mix.items())
+        # Exponential gaps give Poisson arrivals, so clients do not send in lockstep
+        await asyncio.sleep(random.expovariate(args.rate))
+        while time.perf_counter() < deadline:
+            kind = random.choices(kinds, weights)[0]
+            self.sequence += 1
+            try:
+                if kind == 'text':
+                    key = f"{self.index}:{self.sequence}"
+                    body = key + ' ' + 'x' * max(0, args.text_size - len(key) - 1)
+                else:
+                    payload = os.urandom(args.attachment_size)
+                    started = time.perf_counter()
+                    key = await self.upload(payload)
+                    stats['upload_time'].append(time.perf_counter() - started)
+                    body = json.dumps({'sha256': key, 'size': len(payload), 'filename': f"{key[:8]}.bin",
+                                       'mime_type': 'image/png' if kind == 'image' else None})
+                stats['sent_at'][key] = time.perf_counter()
+                self.conn.send({'type': 'message', 'message': body, 'message_type': kind})
+                stats['sent'][kind] += 1
+                self.sent += 1
+                await self.conn.writer.drain()
+            except (ConnectionError, OSError) as e:
+                stats['errors'][str(e) or type(e).__name__] += 1
+                return
+            await asyncio.sleep(random.expovariate(args.rate))
+
+async def run_load(args, server):
+    wire = WireCipher(server.key)
+    tokens = SessionTokens(server.token_secret)
+    stats = {
+        'sent_at': {},
+        'sent': Counter(),
+        'delivered': Counter(),
+        'latency': {'text': [], 'image': [], 'file': []},
+        'upload_time': [],
+        'errors': Counter()
+    }
+    rooms = max(1, math.ceil(args.clients / args.room_size))
+    clients = [LoadClient(i, f"load-room-{i % rooms}", wire, stats) for i in range(args.clients)]
+    rss = {'idle_bytes': server.rss()}
+
+    gate = asyncio.Semaphore(args.connect_concurrency)
+    setup_samples = []
+    connected = []
+
+    async def connect(client):
+        async with gate:
+            try:
+                setup_samples.append(await client.setup('127.0.0.1', server.port, args, tokens))
+                connected.append(client)
+            except (ConnectionError, OSError, asyncio.TimeoutError) as e:
+                stats['errors'][f"setup: {e}"] += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(connect(client) for client in clients))
+    setup_elapsed = time.perf_counter() - started
+    rss['connected_bytes'] = server.rss()
+
+    write_counters = ('chat_sent_frames_total', 'chat_socket_writes_total')
+    writes_before = server.counters(write_counters)
+    receivers = [asyncio.ensure_future(client.receive_loop()) for client in connected]
+    peak_rss = rss['connected_bytes'] or 0
+    deadline = time.perf_counter() + args.duration
+    senders = asyncio.gather(*(client.send_loop(args, deadline) for client in connected))
+    started = time.perf_counter()
+    while not senders.done():
+        await asyncio.sleep(0.5)
+        peak_rss = max(peak_rss, server.rss() or 0)
+    await senders
+    send_elapsed = time.perf_counter() - started
+
+    # Every message should reach all other members of its room; wait for stragglers
+    room_sizes = Counter(client.room for client in connected)
+    expected = sum(client.sent * (room_sizes[client.room] - 1) for client in connected)
+    drain_deadline = time.perf_counter() + args.drain_timeout
+    while sum(stats['delivered'].values()) < expected and time.perf_counter() < drain_deadline:
+        await asyncio.sleep(0.1)
+    total_elapsed = time.perf_counter() - started
+    rss['peak_bytes'] = max(peak_rss, server.rss() or 0)
+    writes_after = server.counters(write_counters)
+    frames, writes = (writes_after[name] - writes_before[name] for name in write_counters)
+
+    for task in receivers:
+        task.cancel()
+    for client in connected:
+        client.conn.close()
+
+    delivered = sum(stats['delivered'].values())
+    sent = sum(stats['sent'].values())
+    all_latencies = [sample for samples in stats['latency'].values() for sample in samples]
+    return {
+        'benchmark': 'load',
+        'config': {
+            'clients': args.clients,
+            'room_size': args.room_size,
+            'rooms': rooms,
+            'rate_per_client': args.rate,
+            'duration_s': args.duration,
+            'mix': args.mix,
+            'text_size': args.text_size,
+            'attachment_size': args.attachment_size,
+            'login': args.login,
+            'negotiate': not args.no_negotiate,
+            'server_mode': args.mode,
+            'server_workers': args.workers,
+            'server_args': args.server_arg,
+            'rate_limits': args.rate_limits
+        },
+        'connected_clients': len(connected),
+        'setup_elapsed_s': round(setup_elapsed, 3),
+        'connection_setup': latency_summary(setup_samples),
+        'messages_sent': dict(stats['sent']),
+        'messages_per_s': round(sent / send_elapsed, 1) if send_elapsed else None,
+        'deliveries': dict(stats['delivered']),
+        'expected_deliveries': expected,
+        'delivery_ratio': round(delivered / expected, 4) if expected else None,
+        'deliveries_per_s': round(delivered / total_elapsed, 1) if total_elapsed else None,
+        'delivery_latency': latency_summary(all_latencies),
+        'delivery_latency_by_type': {kind: latency_summary(samples) for kind, samples in stats['latency'].items() if samples},
+        'upload_time': latency_summary(stats['upload_time']),
+        'errors': dict(stats['errors']),
+        'server_writes': {
+            'frames': int(frames),
+            'socket_writes': int(writes),
+            'frames_per_write': round(frames / writes, 2) if writes else None
+        },
+        'server_rss': rss
+    }
+
+def bench_load(args):
+    """End-to-end delivery latency and throughput with many simulated clients"""
+    fd_limit = raise_fd_limit()
+    with tempfile.TemporaryDirectory() as workdir:
+        server_args = list(args.server_arg) if args.rate_limits else ['--no-rate-limits'] + args.server_arg
+        server = ServerProcess(workdir, args.mode, args.workers, server_args)
+        try:
+            if args.login == 'password':
+                # One shared hash; logins still pay the full KDF on the server
+                password_hash = hash_password(args.password)
+                conn = sqlite3.connect(server.db_path)
+                conn.executemany(
+                    "INSERT OR IGNORE INTO users (username, password_hash) VALUES (?, ?)",
+                    [(f"load{i}", password_hash) for i in range(args.clients)]
+                )
+                conn.commit()
+                conn.close()
+            results = asyncio.run(run_load(args, server))
+        finally:
+            server.stop()
+    results['fd_limit'] = fd_limit
+    return results
+
+def bench_codec(args):
+    """Serialization CPU and payload bytes per message for each codec"""
+    results = {'benchmark': 'codec', 'iterations': args.iterations, 'payloads': {}}
+    for name, message in sample_payloads().items():
+        codecs = {}
+        for codec in CODECS.values():
+            payload = codec.encode(message)
+            codecs[codec.name] = {
+                'bytes': len(payload),
+                'compressed_bytes': len(compress_payload(payload)),
+                'encode_us': round(time_per_call(lambda: codec.encode(message), args.iterations) * 1e6, 2),
+                'decode_us': round(time_per_call(lambda: codec.decode(payload), args.iterations) * 1e6, 2)
+            }
+        results['payloads'][name] = codecs
+    return results
+
+def seed_messages(conn, count, rooms, seed=7):
+    """Fill the messages table with count random chat lines spread over rooms"""
+    rng = random.Random(seed)
+    # Zipf-like vocabulary: a few very common words and a long tail of rare ones
+    vocabulary = [f"w{i}" for i in range(20000)]
+    cumulative = list(itertools.accumulate(1 / (i + 1) for i in range(len(vocabulary))))
+    vocabulary[:6] = ['standup', 'deploy', 'lunch', 'review', 'release', 'meeting']
+    start = time.time() - count
+    batch = []
+    for i in range(1, count + 1):
+        words = rng.choices(vocabulary, cum_weights=cumulative, k=rng.randint(3, 15))
+        message_type = 'text' if rng.random() < 0.95 else 'image'
+        timestamp = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(start + i))
+        batch.append((i, f"room{rng.randrange(rooms)}", f"user{rng.randrange(500)}", ' '.join(words), message_type, timestamp))
+        if len(batch) == 10000:
+            conn.executemany("INSERT INTO messages (id, room, username, message, message_type, timestamp) "
+                             "VALUES (?, ?, ?, ?, ?, ?)", batch)
+            conn.commit()
+            batch = []
+    if batch:
+        conn.executemany("INSERT INTO messages (id, room, username, message, message_type, timestamp) "
+                         "VALUES (?, ?, ?, ?, ?, ?)", batch)
+        conn.commit()
+
+def bench_search(args):
+    """Search latency over a large message table, against a LIKE scan of the same data"""
+    with tempfile.TemporaryDirectory() as workdir, contextlib.redirect_stdout(sys.stderr):
+        server = ChatServer(db_path=os.path.join(workdir, 'search.db'))
+        try:
+            started = time.perf_counter()
+            seed_messages(server.conn, args.messages, args.rooms)
+            seed_seconds = time.perf_counter() - started
+            middle = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(time.time() - args.messages // 2))
+            queries = {
+                'common_word': {'query': 'standup'},
+                'two_words': {'query': 'deploy review'},
+                'rare_word': {'query': 'w15000'},
+                'prefix': {'query': 'w123*'},
+                'room_scoped': {'query': 'lunch', 'room': 'room3'},
+                'recent_half': {'query': 'release', 'since': middle},
+                'second_page': {'query': 'meeting', 'offset': 20}
+            }
+            results = {'benchmark': 'search', 'messages': args.messages, 'rooms': args.rooms,
+                       'seed_seconds': round(seed_seconds, 2), 'queries': {}}
+            for name, params in queries.items():
+                samples = []
+                for _ in range(args.repeat):
+                    started = time.perf_counter()
+                    rows, _ = server.search_index.search(**params)
+                    samples.append(time.perf_counter() - started)
+                results['queries'][name] = dict(latency_summary(samples), results=len(rows))
+            started = time.perf_counter()
+            server.conn.execute(
+                "SELECT room, username, message, timestamp FROM messages "
+                "WHERE message LIKE ? AND message_type = 'text' ORDER BY id DESC LIMIT 20", ('%w15000%',)
+            ).fetchall()
+            results['like_scan_ms'] = round((time.perf_counter() - started) * 1000, 3)
+            return results
+        finally:
+            server.shutdown()
+
+class NullSession(ClientSession):
+    """Session without a transport; frames just pile up in its queue"""
+    def start(self):
+        pass
+
+    def wake_writer(self):
+        pass
+
+    def close_transport(self):
+        pass
+
+def time_message_path(workdir, members, iterations, **options):
+    """Seconds per chat message through process_data into a room of in-memory sessions"""
+    server = ChatServer(db_path=os.path.join(workdir, f"metrics-{options.get('metrics')}.db"),
+                        rate_limits=NO_RATE_LIMITS, **options)
+    try:
+        sessions = []
+        for i in range(members):
+            session = NullSession(('bench', i), max_queue=iterations + 1)
+            session.username = f"user{i}"
+            server.open_session(session)
+            server.join_room(session, 'general')
+            session.current_room = 'general'
+            sessions.append(session)
+        frame = server.wire.encrypt(dumps({'type': 'message', 'message': 'see you at the standup in five'}, 'binary'), 2)
+        sender = sessions[0]
+        started = time.perf_counter()
+        for _ in range(iterations):
+            server.process_data(sender, frame)
+        elapsed = time.perf_counter() - started
+        for session in sessions:
+            server.close_session(session)
+        return elapsed / iterations
+    finally:
+        server.shutdown()
+
+def bench_metrics(args):
+    """Cost of each metric operation, and of instrumentation on the chat message path"""
+    registry = MetricsRegistry()
+    counter = registry.counter('bench_total', "counter")
+    labeled = registry.counter('bench_labeled_total', "labeled counter", label='room')
+    histogram = registry.histogram('bench_seconds', "histogram")
+    for i in range(20):
+        labeled.inc(1, f"room{i}")
+        histogram.observe(i / 1000)
+    results = {
+        'benchmark': 'metrics',
+        'operations_us': {
+            'counter_inc': round(time_per_call(counter.inc, args.iterations * 10) * 1e6, 3),
+            'labeled_inc': round(time_per_call(lambda: labeled.inc(1, 'room7'), args.iterations * 10) * 1e6, 3),
+            'histogram_observe': round(time_per_call(lambda: histogram.observe(0.0042), args.iterations * 10) * 1e6, 3),
+            'render': round(time_per_call(registry.render, 100) * 1e6, 3)
+        },
+        'room_size': args.room_size,
+        'iterations': args.iterations
+    }
+    with tempfile.TemporaryDirectory() as workdir, contextlib.redirect_stdout(sys.stderr):
+        # Best of a few rounds each, interleaved so drift hits both sides alike
+        timings = {True: [], False: []}
+        for _ in range(args.rounds):
+            for enabled in (False, True):
+                timings[enabled].append(time_message_path(workdir, args.room_size, args.iterations, metrics=enabled))
+    disabled, enabled = min(timings[False]), min(timings[True])
+    results['message_us'] = {'metrics_off': round(disabled * 1e6, 2), 'metrics_on': round(enabled * 1e6, 2)}
+    results['overhead_percent'] = round((enabled - disabled) / disabled * 100, 2)
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Chat server benchmarks (results are printed as JSON)")
+    parser.add_argument('--output', help="also write the JSON results to this file")
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    login_parser = subparsers.add_parser('login', help="login burst throughput and chat latency")
+    login_parser.add_argument('--users', type=int, default=1000)
+    login_parser.add_argument('--concurrency', type=int, default=200)
+    login_parser.add_argument('--auth-workers', type=int, default=None)
+    login_parser.add_argument('--max-pending-auth', type=int, default=10000)
+    login_parser.set_defaults(run=bench_login)
+
+    wire_parser = subparsers.add_parser('wire', help="per-message cost of wire version 1 vs 2")
+    wire_parser.add_argument('--iterations', type=int, default=2000)
+    wire_parser.add_argument('--compress', action='store_true', help="compress payloads first, as negotiated connections do")
+    wire_parser.set_defaults(run=bench_wire)
+
+    load_parser = subparsers.add_parser('load', help="many simulated clients: throughput, delivery latency, setup time, server RSS")
+    load_parser.add_argument('--clients', type=int, default=1000)
+    load_parser.add_argument('--room-size', type=int, default=50, help="clients per room")
+    load_parser.add_argument('--rate', type=float, default=0.2, help="messages per second per client")
+    load_parser.add_argument('--duration', type=float, default=20, help="seconds of traffic")
+    load_parser.add_argument('--mix', type=parse_mix, default='text=1',
+                             help="payload mix, e.g. text=0.9,image=0.05,file=0.05")
+    load_parser.add_argument('--text-size', type=int, default=64, help="bytes per text message")
+    load_parser.add_argument('--attachment-size', type=int, default=32 * 1024, help="bytes per image/file")
+    load_parser.add_argument('--login', choices=['token', 'password'], default='token',
+                             help="resume with minted session tokens (cheap) or log in with a password (full KDF)")
+    load_parser.add_argument('--password', default='bench-password')
+    load_parser.add_argument('--no-negotiate', action='store_true', help="skip hello: legacy base64/JSON wire format")
+    load_parser.add_argument('--connect-concurrency', type=int, default=200)
+    load_parser.add_argument('--drain-timeout', type=float, default=10,
+                             help="seconds to wait for in-flight deliveries after sending stops")
+    load_parser.add_argument('--mode', choices=['async', 'threaded'], default='async', help="server I/O mode")
+    load_parser.add_argument('--workers', type=int, default=1, help="server processes")
+    load_parser.add_argument('--rate-limits', action='store_true',
+                             help="keep the server's rate limits (off by default, so capacity is measured)")
+    load_parser.add_argument('--server-arg', action='append', default=[],
+                             help="extra ChatBot_server.py argument, e.g. --server-arg=--codec=json")
+    load_parser.set_defaults(run=bench_load)
+
+    codec_parser = subparsers.add_parser('codec', help="per-message cost of each message codec")
+    codec_parser.add_argument('--iterations', type=int, default=2000)
+    codec_parser.set_defaults(run=bench_codec)
+
+    search_parser = subparsers.add_parser('search', help="full-text search latency over many messages")
+    search_parser.add_argument('--messages', type=int, default=1000000)
+    search_parser.add_argument('--rooms', type=int, default=100)
+    search_parser.add_argument('--repeat', type=int, default=20)
+    search_parser.set_defaults(run=bench_search)
+
+    metrics_parser = subparsers.add_parser('metrics', help="cost of metrics on the chat message path")
+    metrics_parser.add_argument('--iterations', type=int, default=2000)
+    metrics_parser.add_argument('--room-size', type=int, default=50)
+    metrics_parser.add_argument('--rounds', type=int, default=5)
+    metrics_parser.set_defaults(run=bench_metrics)
+
+    args = parser.parse_args()
+    results = json.dumps(args.run(args), indent=2)
+    print(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(results + '\n')
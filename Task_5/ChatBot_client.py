@@ -5,12 +5,17 @@ import threading
 import json
 import base64
 from datetime import datetime
-from cryptography.fernet import Fernet
 import os
 import mimetypes
 from PIL import Image, ImageTk
 import pygame
 import io
+import time
+import hashlib
+from ChatBot_protocol import (encode_frame, FrameDecoder, WireCipher, WIRE_VERSIONS,
+                              compress_payload, decompress_payload, COMPRESSION_THRESHOLD)
+from ChatBot_files import CHUNK_SIZE, MAX_FILE_SIZE
+from ChatBot_codec import DEFAULT_CODECS, dumps, loads
 
 class ChatClient:
     def __init__(self):
@@ -20,6 +25,23 @@ class ChatClient:
         self.connected = False
         self.encryption_key = None
         self.cipher = None
+        self.wire_version = 1
+        self.codec = 'json'
+        self.room_history = []
+        self.history_before_id = None
+        # Rooms in list order with their member counts, kept current by the server's updates
+        self.room_counts = {}
+        # Newest sequence number seen in the current room, for delta resync on reconnect
+        self.last_seq = None
+        self.server_address = None
+        self.session_token = None
+        self.send_lock = threading.Lock()
+        self.compression = None
+        self.compression_threshold = COMPRESSION_THRESHOLD
+        self.uploads = {}
+        self.downloads = {}
+        self.image_cache = {}
+        self.search_window = None
         
         # Initialize pygame for sound notifications
         pygame.mixer.init()
@@ -137,6 +159,12 @@ class ChatClient:
                                  command=self.disconnect)
         disconnect_btn.pack(side='right', padx=10, pady=10)
         
+        # Search button
+        search_btn = tk.Button(top_frame, text="Search", font=('Arial', 10), 
+                             bg='#3498db', fg='white', padx=15, pady=5, 
+                             command=self.search_dialog)
+        search_btn.pack(side='right', padx=5, pady=10)
+        
         # Main content frame
         main_frame = tk.Frame(self.chat_frame, bg='#2c3e50')
         main_frame.pack(fill='both', expand=True, padx=5, pady=5)
@@ -172,6 +200,12 @@ class ChatClient:
                                   font=('Arial', 14, 'bold'), fg='#ecf0f1', bg='#34495e')
         self.chat_header.pack(pady=10)
         
+        # Older history is fetched page by page on demand
+        self.older_btn = tk.Button(right_panel, text="Load older messages", font=('Arial', 9), 
+                                 bg='#7f8c8d', fg='white', padx=10, pady=2, 
+                                 state='disabled', command=self.load_older_messages)
+        self.older_btn.pack(pady=(0, 5))
+        
         # Messages area
         self.messages_text = scrolledtext.ScrolledText(right_panel, wrap=tk.WORD, 
                                                      font=('Arial', 10), bg='#ecf0f1', 
@@ -230,67 +264,132 @@ class ChatClient:
                 self.status_label.config(text="Please enter the encryption key")
                 return False
                 
-            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.socket.connect((server, port))
-            
             # Set up encryption
             self.encryption_key = key.encode()
-            self.cipher = Fernet(self.encryption_key)
-            
-            self.connected = True
-            
-            # Start receiving messages
-            receive_thread = threading.Thread(target=self.receive_messages)
-            receive_thread.daemon = True
-            receive_thread.start()
+            self.cipher = WireCipher(self.encryption_key)
             
+            self.open_socket(server, port)
             return True
             
         except Exception as e:
             self.status_label.config(text=f"Connection failed: {str(e)}")
             return False
             
-    def encrypt_message(self, message):
-        """Encrypt message before sending"""
-        return base64.b64encode(self.cipher.encrypt(message.encode())).decode()
-        
-    def decrypt_message(self, encrypted_message):
-        """Decrypt received message"""
-        try:
-            return self.cipher.decrypt(base64.b64decode(encrypted_message.encode())).decode()
-        except:
-            return encrypted_message
+    def open_socket(self, server, port):
+        """Open the server connection and start the receive thread"""
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.connect((server, port))
+        self.server_address = (server, port)
+        self.connected = True
+        self.wire_version = 1
+        self.codec = 'json'
+        self.compression = None
+        
+        # Start receiving messages
+        receive_thread = threading.Thread(target=self.receive_messages)
+        receive_thread.daemon = True
+        receive_thread.start()
+        
+        # Offer the binary wire format, codecs and compression; until the server's welcome
+        # accepts them we keep speaking version 1 JSON, which every server understands
+        self.send_data({
+            'type': 'hello',
+            'versions': list(WIRE_VERSIONS),
+            'codecs': list(DEFAULT_CODECS),
+            'compression': ['zlib'],
+            'heartbeat': True
+        })
+        
+    def reconnect(self):
+        """Re-establish a dropped connection and resume the session with its token"""
+        self.root.after(0, lambda: self.display_system_message("Connection lost, reconnecting..."))
+        delay = 1
+        while self.session_token and not self.connected:
+            try:
+                self.open_socket(*self.server_address)
+                self.send_data({'type': 'auth', 'action': 'resume', 'token': self.session_token})
+                return
+            except OSError:
+                time.sleep(delay)
+                delay = min(delay * 2, 30)
             
+    def encode_payload(self, data):
+        """Serialize, compress if negotiated, and encrypt one message"""
+        payload = dumps(data, self.codec)
+        if self.compression:
+            payload = compress_payload(payload, self.compression_threshold)
+        return self.cipher.encrypt(payload, self.wire_version)
+        
+    def decode_payload(self, frame):
+        """Decrypt, decompress and parse one received frame"""
+        return loads(decompress_payload(self.cipher.decrypt(frame)))
+        
     def send_data(self, data):
         """Send encrypted data to server"""
         if self.connected:
             try:
-                encrypted_data = self.encrypt_message(json.dumps(data))
-                self.socket.send(encrypted_data.encode())
+                encrypted_data = self.encode_payload(data)
+                # Uploads send from their own thread, so whole frames must not interleave
+                with self.send_lock:
+                    self.socket.sendall(encode_frame(encrypted_data))
             except Exception as e:
                 print(f"Error sending data: {e}")
                 
     def receive_messages(self):
         """Receive and handle messages from server"""
+        decoder = FrameDecoder()
         while self.connected:
             try:
-                encrypted_data = self.socket.recv(1024).decode()
-                if encrypted_data:
-                    data = json.loads(self.decrypt_message(encrypted_data))
-                    self.handle_server_message(data)
-                else:
+                chunk = self.socket.recv(65536)
+                if not chunk:
                     break
+                for frame in decoder.feed(chunk):
+                    data = self.decode_payload(frame)
+                    self.handle_server_message(data)
             except Exception as e:
                 if self.connected:
                     print(f"Error receiving message: {e}")
                 break
                 
+        # The server went away rather than the user disconnecting: resume if we can
+        if self.connected and self.session_token:
+            self.connected = False
+            try:
+                self.socket.close()
+            except OSError:
+                pass
+            reconnect_thread = threading.Thread(target=self.reconnect)
+            reconnect_thread.daemon = True
+            reconnect_thread.start()
+            
     def handle_server_message(self, data):
         """Handle different types of messages from server"""
-        if data['type'] == 'auth_result':
+        if data['type'] == 'welcome':
+            self.wire_version = data.get('version', 1)
+            self.codec = data.get('codec', 'json')
+            self.compression = data.get('compression')
+            self.compression_threshold = data.get('compression_threshold', COMPRESSION_THRESHOLD)
+            if data.get('heartbeat_interval'):
+                # The server pings a quiet connection, so a long silence means it is gone
+                self.socket.settimeout(data['heartbeat_interval'] * 3)
+                
+        elif data['type'] == 'ping':
+            self.send_data({'type': 'pong'})
+            
+        elif data['type'] == 'auth_result':
             if data['success']:
                 self.username = data['username']
-                self.root.after(0, self.create_chat_window)
+                self.session_token = data.get('session_token')
+                if data.get('resumed'):
+                    self.root.after(0, lambda: self.display_system_message("Reconnected"))
+                    # Subscriptions do not survive the connection, so ask for the list again
+                    self.load_rooms()
+                    if self.current_room:
+                        self.send_data({'type': 'join_room', 'room': self.current_room, 'since_seq': self.last_seq})
+                else:
+                    self.root.after(0, self.create_chat_window)
+            elif data.get('resumed'):
+                self.root.after(0, lambda: self.session_expired(data['error']))
             else:
                 self.root.after(0, lambda: self.status_label.config(text=data['error']))
                 
@@ -301,14 +400,39 @@ class ChatClient:
                 self.root.after(0, lambda: self.status_label.config(text=data['error']))
                 
         elif data['type'] == 'rooms_list':
-            self.root.after(0, lambda: self.update_rooms_list(data['rooms']))
+            self.root.after(0, lambda: self.update_rooms_list(data['rooms'], data.get('members')))
+            
+        elif data['type'] in ('room_added', 'room_removed', 'room_count_changed'):
+            self.root.after(0, lambda: self.apply_room_changes(data))
             
         elif data['type'] == 'room_joined':
+            self.last_seq = data.get('seq')
+            if data.get('delta') and data['room'] == self.current_room:
+                # Rejoined after a reconnect: only the messages missed meanwhile were sent
+                self.room_history.extend(data['history'])
+                for message in data['history']:
+                    username, content, msg_type, timestamp = message
+                    self.root.after(0, lambda m={'username': username, 'message': content,
+                                                  'message_type': msg_type, 'timestamp': timestamp}:
+                                    self.display_message(m, from_history=True))
+                return
             self.current_room = data['room']
+            self.room_history = list(data['history'])
             self.root.after(0, lambda: self.update_chat_header(data['room']))
-            self.root.after(0, lambda: self.display_message_history(data['history']))
+            self.root.after(0, lambda: self.display_message_history(self.room_history))
+            self.root.after(0, lambda: self.update_history_cursor(data.get('before_id'), data.get('has_more', False)))
+            
+        elif data['type'] == 'history_page':
+            if data['room'] == self.current_room:
+                self.room_history = list(data['messages']) + self.room_history
+                self.root.after(0, lambda: self.display_message_history(self.room_history))
+                self.root.after(0, lambda: self.messages_text.see('1.0'))
+                self.root.after(0, lambda: self.update_history_cursor(data['before_id'], data['has_more']))
             
         elif data['type'] == 'message':
+            if data.get('seq') is not None:
+                self.last_seq = max(self.last_seq or 0, data['seq'])
+            self.room_history.append([data['username'], data['message'], data.get('message_type', 'text'), data['timestamp']])
             self.root.after(0, lambda: self.display_message(data))
             self.play_notification_sound()
             
@@ -318,10 +442,30 @@ class ChatClient:
         elif data['type'] == 'user_left':
             self.root.after(0, lambda: self.display_system_message(f"{data['username']} left the room"))
             
+        elif data['type'] in ('upload_ready', 'upload_complete', 'upload_failed'):
+            transfer = self.uploads.get(data['sha256'])
+            if transfer:
+                transfer['response'] = data
+                transfer['event'].set()
+                
+        elif data['type'] == 'file_chunk':
+            self.receive_file_chunk(data)
+            
+        elif data['type'] == 'download_failed':
+            download = self.downloads.pop(data['sha256'], None)
+            if download:
+                download['sink'].close()
+                self.root.after(0, lambda: self.display_system_message(f"Download failed: {data['error']}"))
+                
+        elif data['type'] == 'throttled':
+            self.root.after(0, lambda: self.display_system_message(f"Message not sent: {data['error']}"))
+            
+        elif data['type'] == 'search_results':
+            self.root.after(0, lambda: self.show_search_results(data))
+            
         elif data['type'] == 'room_created':
             if data['success']:
                 self.root.after(0, lambda: messagebox.showinfo("Success", f"Room '{data['room']}' created successfully!"))
-                self.load_rooms()
             else:
                 self.root.after(0, lambda: messagebox.showerror("Error", data['error']))
                 
@@ -364,22 +508,59 @@ class ChatClient:
             self.send_data(auth_data)
             
     def load_rooms(self):
-        """Load available rooms from server"""
-        self.send_data({'type': 'get_rooms'})
+        """Load available rooms from server and subscribe to changes of the list"""
+        self.send_data({'type': 'get_rooms', 'subscribe': True})
         
-    def update_rooms_list(self, rooms):
+    def update_rooms_list(self, rooms, members=None):
         """Update the rooms list in the GUI"""
+        self.room_counts = dict(zip(rooms, members or [None] * len(rooms)))
         self.rooms_listbox.delete(0, tk.END)
-        for room in rooms:
-            self.rooms_listbox.insert(tk.END, room)
+        for room, count in self.room_counts.items():
+            self.rooms_listbox.insert(tk.END, self.room_label(room, count))
             
+    def apply_room_changes(self, data):
+        """Patch the rooms list with one update from the server, touching only the changed rows"""
+        positions = {room: index for index, room in enumerate(self.room_counts)}
+        if data['type'] == 'room_removed':
+            # Bottom up, so deleting a row does not shift the ones still to go
+            for index in sorted((positions[r] for r in data['rooms'] if r in positions), reverse=True):
+                self.rooms_listbox.delete(index)
+            for room in data['rooms']:
+                self.room_counts.pop(room, None)
+            return
+        for room, count in zip(data['rooms'], data['members']):
+            if room in positions:
+                self.rooms_listbox.delete(positions[room])
+                self.rooms_listbox.insert(positions[room], self.room_label(room, count))
+            else:
+                self.rooms_listbox.insert(tk.END, self.room_label(room, count))
+            self.room_counts[room] = count
+            
+    def room_label(self, room, count):
+        return room if not count else f"{room} ({count})"
+        
     def join_room(self, event=None):
         """Join a selected room"""
         selection = self.rooms_listbox.curselection()
         if selection:
-            room = self.rooms_listbox.get(selection[0])
+            room = list(self.room_counts)[selection[0]]
             self.send_data({'type': 'join_room', 'room': room})
             
+    def update_history_cursor(self, before_id, has_more):
+        """Remember where the next older history page starts"""
+        self.history_before_id = before_id
+        self.older_btn.config(state='normal' if has_more else 'disabled')
+        
+    def load_older_messages(self):
+        """Request the page of history preceding what is already shown"""
+        if self.current_room and self.history_before_id is not None:
+            self.send_data({
+                'type': 'get_history',
+                'room': self.current_room,
+                'before_id': self.history_before_id,
+                'limit': 50
+            })
+            
     def create_room_dialog(self):
         """Show dialog to create a new room"""
         dialog = tk.Toplevel(self.root)
@@ -422,6 +603,78 @@ class ChatClient:
         
         dialog.bind('<Return>', lambda e: create_room())
         
+    def search_dialog(self):
+        """Show the message search window"""
+        if self.search_window is not None and self.search_window.winfo_exists():
+            self.search_window.lift()
+            return
+        dialog = self.search_window = tk.Toplevel(self.root)
+        dialog.title("Search Messages")
+        dialog.geometry("600x450")
+        dialog.configure(bg='#34495e')
+        dialog.transient(self.root)
+        
+        search_frame = tk.Frame(dialog, bg='#34495e')
+        search_frame.pack(fill='x', padx=10, pady=10)
+        
+        self.search_entry = tk.Entry(search_frame, font=('Arial', 12))
+        self.search_entry.pack(side='left', fill='x', expand=True, padx=(0, 5))
+        self.search_entry.focus()
+        
+        self.search_room_only = tk.BooleanVar(value=False)
+        room_check = tk.Checkbutton(search_frame, text="This room only", variable=self.search_room_only, 
+                                  font=('Arial', 10), fg='#ecf0f1', bg='#34495e', selectcolor='#2c3e50')
+        room_check.pack(side='left', padx=5)
+        
+        search_btn = tk.Button(search_frame, text="Search", font=('Arial', 10), 
+                             bg='#2ecc71', fg='white', padx=15, pady=5, 
+                             command=self.run_search)
+        search_btn.pack(side='left')
+        
+        self.search_results_text = scrolledtext.ScrolledText(dialog, wrap=tk.WORD, font=('Arial', 10), 
+                                                           bg='#ecf0f1', fg='#2c3e50')
+        self.search_results_text.pack(fill='both', expand=True, padx=10)
+        self.search_results_text.tag_configure('username', foreground='#3498db', font=('Arial', 10, 'bold'))
+        self.search_results_text.tag_configure('timestamp', foreground='#7f8c8d', font=('Arial', 8))
+        self.search_results_text.config(state='disabled')
+        
+        self.search_more_btn = tk.Button(dialog, text="More results", font=('Arial', 9), 
+                                       bg='#7f8c8d', fg='white', padx=10, pady=2, 
+                                       state='disabled', command=lambda: self.run_search(self.search_offset))
+        self.search_more_btn.pack(pady=5)
+        self.search_offset = 0
+        
+        dialog.bind('<Return>', lambda e: self.run_search())
+        
+    def run_search(self, offset=0):
+        """Request one page of search results"""
+        query = self.search_entry.get().strip()
+        if not query:
+            return
+        request = {'type': 'search', 'query': query, 'offset': offset, 'limit': 20}
+        if self.search_room_only.get() and self.current_room:
+            request['room'] = self.current_room
+        self.send_data(request)
+        
+    def show_search_results(self, data):
+        """Show a page of search results, appending when it continues the last one"""
+        if self.search_window is None or not self.search_window.winfo_exists():
+            return
+        self.search_results_text.config(state='normal')
+        if data['offset'] == 0:
+            self.search_results_text.delete(1.0, tk.END)
+        if data.get('error'):
+            self.search_results_text.insert(tk.END, data['error'] + '\n')
+        elif not data['results'] and data['offset'] == 0:
+            self.search_results_text.insert(tk.END, f"No messages match '{data['query']}'\n")
+        for room, username, message, timestamp in data['results']:
+            self.search_results_text.insert(tk.END, f"[{timestamp}] #{room} ", 'timestamp')
+            self.search_results_text.insert(tk.END, f"{username}: ", 'username')
+            self.search_results_text.insert(tk.END, self.process_emojis(message) + '\n')
+        self.search_results_text.config(state='disabled')
+        self.search_offset = data['offset'] + len(data['results'])
+        self.search_more_btn.config(state='normal' if data['has_more'] else 'disabled')
+        
     def update_chat_header(self, room):
         """Update the chat header with current room"""
         self.chat_header.config(text=f"Room: {room}")
@@ -482,26 +735,96 @@ class ChatClient:
     def display_image_message(self, image_data):
         """Display image messages"""
         try:
-            # Decode base64 image
-            image_bytes = base64.b64decode(image_data)
-            image = Image.open(io.BytesIO(image_bytes))
-            
-            # Resize image if too large
-            max_size = (300, 300)
-            image.thumbnail(max_size, Image.Resampling.LANCZOS)
-            
-            photo = ImageTk.PhotoImage(image)
-            self.messages_text.image_create(tk.END, image=photo)
+            reference = self.parse_attachment(image_data)
+            if reference is None:
+                # Inline base64 image from an older server
+                image = Image.open(io.BytesIO(base64.b64decode(image_data)))
+                image.thumbnail((300, 300), Image.Resampling.LANCZOS)
+                self.insert_image(tk.END, image)
+                self.messages_text.insert(tk.END, '\n')
+                return
+                
+            # Only the server-made thumbnail is fetched; the original waits until it is opened
+            preview = reference
+            if reference.get('thumbnail'):
+                preview = dict(reference['thumbnail'], filename=reference['filename'])
+            sha256 = preview['sha256']
+            if sha256 in self.image_cache:
+                self.insert_image(tk.END, self.image_cache[sha256])
+            else:
+                # Leave a placeholder and fetch the image in chunks
+                if not hasattr(self, 'image_placeholders'):
+                    self.image_placeholders = 0
+                self.image_placeholders += 1
+                tag = f"image_{self.image_placeholders}"
+                self.messages_text.insert(tk.END, f"[Loading image {reference['filename']}...]", tag)
+                self.download(preview, io.BytesIO(), lambda sink: self.show_downloaded_image(sha256, sink, tag))
+                
+            if not hasattr(self, 'file_links'):
+                self.file_links = 0
+            self.file_links += 1
+            link = f"file_{self.file_links}"
+            self.messages_text.insert(tk.END, " [Open]", link)
+            self.messages_text.tag_configure(link, foreground='#2980b9', underline=True)
+            self.messages_text.tag_bind(link, '<Button-1>', lambda e, info=reference: self.open_image(info))
             self.messages_text.insert(tk.END, '\n')
             
-            # Keep a reference to prevent garbage collection
-            if not hasattr(self, 'images'):
-                self.images = []
-            self.images.append(photo)
-            
         except Exception as e:
             self.messages_text.insert(tk.END, f"[Image could not be displayed: {str(e)}]\n")
             
+    def insert_image(self, index, image):
+        """Insert a PIL image into the messages area"""
+        photo = ImageTk.PhotoImage(image)
+        self.messages_text.image_create(index, image=photo)
+        
+        # Keep a reference to prevent garbage collection
+        if not hasattr(self, 'images'):
+            self.images = []
+        self.images.append(photo)
+        
+    def show_downloaded_image(self, sha256, sink, tag):
+        """Replace an image placeholder with the downloaded image"""
+        try:
+            image = Image.open(io.BytesIO(sink.getvalue()))
+            image.thumbnail((300, 300), Image.Resampling.LANCZOS)
+            self.image_cache[sha256] = image
+        except Exception as e:
+            image = None
+            error = str(e)
+            
+        ranges = self.messages_text.tag_ranges(tag)
+        if not ranges:
+            return
+        self.messages_text.config(state='normal')
+        self.messages_text.delete(ranges[0], ranges[1])
+        if image is not None:
+            self.insert_image(ranges[0], image)
+        else:
+            self.messages_text.insert(ranges[0], f"[Image could not be displayed: {error}]")
+        self.messages_text.config(state='disabled')
+        
+    def open_image(self, reference):
+        """Download an image at full resolution and show it in its own window"""
+        self.download(reference, io.BytesIO(), lambda sink: self.show_full_image(reference, sink))
+        
+    def show_full_image(self, reference, sink):
+        try:
+            image = Image.open(io.BytesIO(sink.getvalue()))
+            image.load()
+        except Exception as e:
+            self.display_system_message(f"{reference['filename']} could not be opened: {str(e)}")
+            return
+            
+        window = tk.Toplevel(self.root)
+        window.title(reference['filename'])
+        # Fit the screen; anything smaller is shown as it is
+        image.thumbnail((int(self.root.winfo_screenwidth() * 0.9), int(self.root.winfo_screenheight() * 0.9)),
+                        Image.Resampling.LANCZOS)
+        photo = ImageTk.PhotoImage(image)
+        label = tk.Label(window, image=photo)
+        label.image = photo
+        label.pack()
+        
     def display_file_message(self, file_data):
         """Display file messages"""
         try:
@@ -509,11 +832,69 @@ class ChatClient:
             filename = file_info['filename']
             size = file_info['size']
             
-            self.messages_text.insert(tk.END, f"📁 File: {filename} ({size} bytes)\n")
+            self.messages_text.insert(tk.END, f"📁 File: {filename} ({size} bytes) ")
+            if 'sha256' in file_info:
+                if not hasattr(self, 'file_links'):
+                    self.file_links = 0
+                self.file_links += 1
+                tag = f"file_{self.file_links}"
+                self.messages_text.insert(tk.END, "[Download]", tag)
+                self.messages_text.tag_configure(tag, foreground='#2980b9', underline=True)
+                self.messages_text.tag_bind(tag, '<Button-1>', lambda e, info=file_info: self.save_file(info))
+            self.messages_text.insert(tk.END, '\n')
             
         except Exception as e:
             self.messages_text.insert(tk.END, f"[File info could not be displayed: {str(e)}]\n")
             
+    def parse_attachment(self, message):
+        """Return the blob reference of an attachment message, or None for inline data"""
+        try:
+            info = json.loads(message)
+        except ValueError:
+            return None
+        if isinstance(info, dict) and 'sha256' in info:
+            return info
+        return None
+        
+    def save_file(self, file_info):
+        """Ask where to save a shared file and download it there"""
+        path = filedialog.asksaveasfilename(title="Save file as", initialfile=file_info['filename'])
+        if path:
+            self.download(file_info, open(path, 'wb'),
+                          lambda sink: self.display_system_message(f"Saved {file_info['filename']}"))
+            
+    def download(self, reference, sink, on_complete):
+        """Fetch a stored file chunk by chunk into sink (a file or BytesIO)"""
+        sha256 = reference['sha256']
+        if sha256 in self.downloads:
+            if isinstance(sink, io.BytesIO) and isinstance(self.downloads[sha256]['sink'], io.BytesIO):
+                self.downloads[sha256]['callbacks'].append(on_complete)
+            else:
+                sink.close()
+                self.display_system_message(f"{reference['filename']} is already downloading")
+            return
+        self.downloads[sha256] = {'sink': sink, 'offset': 0, 'callbacks': [on_complete]}
+        self.send_data({'type': 'download', 'sha256': sha256, 'offset': 0, 'length': CHUNK_SIZE})
+        
+    def receive_file_chunk(self, data):
+        """Store a downloaded chunk and request the next one"""
+        download = self.downloads.get(data['sha256'])
+        if download is None or data['offset'] != download['offset']:
+            return
+        chunk = base64.b64decode(data['data'])
+        download['sink'].write(chunk)
+        download['offset'] += len(chunk)
+        
+        if download['offset'] < data['size'] and chunk:
+            self.send_data({'type': 'download', 'sha256': data['sha256'], 'offset': download['offset'], 'length': CHUNK_SIZE})
+            return
+            
+        del self.downloads[data['sha256']]
+        if not isinstance(download['sink'], io.BytesIO):
+            download['sink'].close()
+        for callback in download['callbacks']:
+            self.root.after(0, lambda cb=callback: cb(download['sink']))
+            
     def process_emojis(self, text):
         """Process emoji shortcuts in text"""
         emoji_dict = {
@@ -597,47 +978,77 @@ class ChatClient:
         )
         
         if file_path:
-            try:
-                # Check file size (limit to 5MB)
-                file_size = os.path.getsize(file_path)
-                if file_size > 5 * 1024 * 1024:
-                    messagebox.showerror("Error", "File size must be less than 5MB")
-                    return
-                    
-                filename = os.path.basename(file_path)
-                mime_type, _ = mimetypes.guess_type(file_path)
+            # Check file size
+            file_size = os.path.getsize(file_path)
+            if file_size > MAX_FILE_SIZE:
+                messagebox.showerror("Error", f"File size must be less than {MAX_FILE_SIZE // (1024 * 1024)}MB")
+                return
                 
+            # Upload in the background; the file is streamed, never read whole
+            upload_thread = threading.Thread(target=self.upload_file, args=(file_path, file_size))
+            upload_thread.daemon = True
+            upload_thread.start()
+            
+    def wait_for_upload(self, sha256, request, timeout=30):
+        """Send an upload request and wait for the server's answer"""
+        transfer = {'event': threading.Event(), 'response': None}
+        self.uploads[sha256] = transfer
+        self.send_data(request)
+        if not transfer['event'].wait(timeout):
+            raise TimeoutError("Server did not answer the upload request")
+        return transfer['response']
+        
+    def upload_file(self, file_path, file_size):
+        """Upload a file in chunks, resuming where the server left off, then post a reference"""
+        sha256 = None
+        try:
+            filename = os.path.basename(file_path)
+            mime_type, _ = mimetypes.guess_type(file_path)
+            
+            digest = hashlib.sha256()
+            with open(file_path, 'rb') as f:
+                for block in iter(lambda: f.read(CHUNK_SIZE), b''):
+                    digest.update(block)
+            sha256 = digest.hexdigest()
+            
+            response = self.wait_for_upload(sha256, {'type': 'upload_begin', 'sha256': sha256, 'size': file_size})
+            if response['type'] == 'upload_ready':
+                # Stream the part the server does not have yet
                 with open(file_path, 'rb') as f:
-                    file_data = f.read()
-                    
-                # Check if it's an image
-                if mime_type and mime_type.startswith('image/'):
-                    # Send as image
-                    encoded_data = base64.b64encode(file_data).decode()
-                    message_data = {
-                        'type': 'message',
-                        'message': encoded_data,
-                        'message_type': 'image'
-                    }
-                else:
-                    # Send as file
-                    file_info = {
-                        'filename': filename,
-                        'size': file_size,
-                        'mime_type': mime_type,
-                        'data': base64.b64encode(file_data).decode()
-                    }
-                    message_data = {
-                        'type': 'message',
-                        'message': json.dumps(file_info),
-                        'message_type': 'file'
-                    }
-                    
-                self.send_data(message_data)
+                    offset = response['offset']
+                    f.seek(offset)
+                    for block in iter(lambda: f.read(CHUNK_SIZE), b''):
+                        self.send_data({
+                            'type': 'upload_chunk',
+                            'sha256': sha256,
+                            'offset': offset,
+                            'data': base64.b64encode(block).decode()
+                        })
+                        offset += len(block)
+                response = self.wait_for_upload(sha256, {'type': 'upload_end', 'sha256': sha256})
                 
-            except Exception as e:
-                messagebox.showerror("Error", f"Failed to send file: {str(e)}")
+            if response['type'] != 'upload_complete':
+                raise RuntimeError(response.get('error', 'Upload failed'))
                 
+            # Check if it's an image
+            message_type = 'image' if mime_type and mime_type.startswith('image/') else 'file'
+            file_info = {
+                'sha256': sha256,
+                'filename': filename,
+                'size': file_size,
+                'mime_type': mime_type
+            }
+            self.send_data({
+                'type': 'message',
+                'message': json.dumps(file_info),
+                'message_type': message_type
+            })
+            
+        except Exception as e:
+            self.root.after(0, lambda: messagebox.showerror("Error", f"Failed to send file: {str(e)}"))
+        finally:
+            self.uploads.pop(sha256, None)
+            
     def send_message(self, event=None):
         """Send a text message"""
         message = self.message_entry.get().strip()
@@ -683,8 +1094,14 @@ class ChatClient:
         except:
             pass  # Fallback: no notification
             
+    def session_expired(self, error):
+        """Return to the login screen when a session could not be resumed"""
+        self.disconnect()
+        self.status_label.config(text=error)
+        
     def disconnect(self):
         """Disconnect from server and return to login"""
+        self.session_token = None
         self.connected = False
         if self.socket:
             self.socket.close()
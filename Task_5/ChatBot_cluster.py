@@ -0,0 +1,287 @@
+import json
+import os
+import socket
+import threading
+import time
+from collections import Counter, deque
+from ChatBot_protocol import encode_frame, FrameDecoder
+
+class MessageIds:
+    """Message id allocator for one of several workers sharing a database
+
+    Worker i of n hands out ids congruent to i modulo n, so workers never collide
+    without coordinating. Ids seen from other workers move the counter past them,
+    which keeps ids close to posting order across the cluster.
+    """
+    def __init__(self, after, workers=1, index=0):
+        self.lock = threading.Lock()
+        self.step = workers
+        self.index = index
+        self.next_id = self.following(after)
+        # Highest value handed out here or seen from another worker
+        self.latest = after
+
+    def following(self, value):
+        """Smallest id of this worker greater than value"""
+        return value + 1 + (self.index - value - 1) % self.step
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        with self.lock:
+            value = self.next_id
+            self.next_id += self.step
+            self.latest = max(self.latest, value)
+            return value
+
+    def observe(self, value):
+        """Account for an id allocated by another worker"""
+        with self.lock:
+            if value >= self.next_id:
+                self.next_id = self.following(value)
+            self.latest = max(self.latest, value)
+
+class RoomSequences:
+    """Per-room message sequence numbers, one MessageIds allocator per room
+
+    A room's counter starts after the highest sequence the loader reports for it.
+    With several workers the sequences of a room interleave like message ids do, so
+    they increase but are not dense.
+    """
+    def __init__(self, loader, workers=1, index=0):
+        self.loader = loader
+        self.workers = workers
+        self.index = index
+        self.rooms = {}
+        self.lock = threading.Lock()
+
+    def allocator(self, room):
+        with self.lock:
+            allocator = self.rooms.get(room)
+            if allocator is None:
+                allocator = self.rooms[room] = MessageIds(self.loader(room), self.workers, self.index)
+            return allocator
+
+    def next(self, room):
+        return next(self.allocator(room))
+
+    def observe(self, room, seq):
+        self.allocator(room).observe(seq)
+
+    def latest(self, room):
+        """Highest sequence of room known to this worker (0 before the first message)
+
+        Only rooms with messages get an allocator, so joining rooms under ever new
+        names does not grow this table.
+        """
+        with self.lock:
+            allocator = self.rooms.get(room)
+        if allocator is None:
+            return self.loader(room)
+        return allocator.latest
+
+class BusHub:
+    """Local pub/sub relay between worker processes over a Unix domain socket
+
+    Every event a worker publishes is forwarded to all other workers. When a worker's
+    connection drops, the others get a worker_gone event so they forget its presence.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.peers = {}
+        self.server = None
+
+    def start(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(self.path)
+        os.chmod(self.path, 0o600)
+        self.server.listen(64)
+        thread = threading.Thread(target=self.accept_loop, name='bus-hub')
+        thread.daemon = True
+        thread.start()
+
+    def accept_loop(self):
+        while True:
+            try:
+                conn, _ = self.server.accept()
+            except OSError:
+                return
+            thread = threading.Thread(target=self.relay, args=(conn,), name='bus-relay')
+            thread.daemon = True
+            thread.start()
+
+    def relay(self, conn):
+        """Forward everything one worker publishes to every other worker"""
+        decoder = FrameDecoder()
+        worker = None
+        with self.lock:
+            # One lock per peer, so relays from different workers never interleave frames
+            self.peers[conn] = threading.Lock()
+        try:
+            while True:
+                chunk = conn.recv(65536)
+                if not chunk:
+                    break
+                frames = decoder.feed(chunk)
+                if frames:
+                    if worker is None:
+                        worker = json.loads(frames[0]).get('worker')
+                    self.forward(conn, b''.join(encode_frame(frame) for frame in frames))
+        except OSError:
+            pass
+        finally:
+            with self.lock:
+                self.peers.pop(conn, None)
+            conn.close()
+            if worker is not None:
+                self.forward(None, encode_frame(json.dumps({'event': 'worker_gone', 'worker': worker}).encode()))
+
+    def forward(self, source, data):
+        with self.lock:
+            targets = [(peer, lock) for peer, lock in self.peers.items() if peer is not source]
+        for peer, lock in targets:
+            try:
+                with lock:
+                    peer.sendall(data)
+            except OSError:
+                pass
+
+    def close(self):
+        if self.server:
+            self.server.close()
+        with self.lock:
+            peers = list(self.peers)
+        for peer in peers:
+            try:
+                peer.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+class BusClient:
+    """A worker's connection to the bus hub
+
+    publish() only queues the event, so it is safe from the event loop; a writer thread
+    sends everything queued in one write. Received events are passed to handler on the
+    reader thread.
+    """
+    def __init__(self, path, worker, handler, connect_timeout=10):
+        self.path = path
+        self.worker = worker
+        self.handler = handler
+        self.connect_timeout = connect_timeout
+        self.outbound = deque()
+        self.ready = threading.Condition()
+        self.closed = False
+        self.sock = None
+
+    def start(self):
+        deadline = time.monotonic() + self.connect_timeout
+        while True:
+            try:
+                self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                self.sock.connect(self.path)
+                break
+            except OSError:
+                self.sock.close()
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.05)
+        for target, name in ((self.read_loop, 'bus-reader'), (self.write_loop, 'bus-writer')):
+            thread = threading.Thread(target=target, name=name)
+            thread.daemon = True
+            thread.start()
+        # Announce ourselves; the other workers answer with their presence
+        self.publish({'event': 'hello'})
+
+    def publish(self, event):
+        """Queue an event for every other worker"""
+        event['worker'] = self.worker
+        frame = encode_frame(json.dumps(event).encode())
+        with self.ready:
+            self.outbound.append(frame)
+            self.ready.notify()
+
+    def write_loop(self):
+        while True:
+            with self.ready:
+                while not self.outbound and not self.closed:
+                    self.ready.wait()
+                if self.closed:
+                    return
+                data = b''.join(self.outbound)
+                self.outbound.clear()
+            try:
+                self.sock.sendall(data)
+            except OSError:
+                return
+
+    def read_loop(self):
+        decoder = FrameDecoder()
+        try:
+            while True:
+                chunk = self.sock.recv(65536)
+                if not chunk:
+                    break
+                for frame in decoder.feed(chunk):
+                    try:
+                        self.handler(json.loads(frame))
+                    except Exception as e:
+                        print(f"Error handling bus event: {e}")
+        except OSError:
+            pass
+        if not self.closed:
+            print(f"Worker {self.worker} lost its connection to the message bus")
+
+    def close(self):
+        with self.ready:
+            self.closed = True
+            self.ready.notify()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+class RemotePresence:
+    """Room members connected to other workers, as reported over the bus"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.workers = {}
+
+    def update(self, worker, username, joined=(), left=()):
+        with self.lock:
+            rooms = self.workers.setdefault(worker, {})
+            for room in left:
+                names = rooms.get(room)
+                if names and names[username]:
+                    names[username] -= 1
+                    if not names[username]:
+                        del names[username]
+                    if not names:
+                        del rooms[room]
+            for room in joined:
+                rooms.setdefault(room, Counter())[username] += 1
+
+    def replace(self, worker, rooms):
+        """Take a worker's full presence snapshot"""
+        with self.lock:
+            self.workers[worker] = {room: Counter(names) for room, names in rooms.items() if names}
+
+    def forget(self, worker):
+        with self.lock:
+            self.workers.pop(worker, None)
+
+    def names(self, room):
+        """Usernames in room on other workers"""
+        with self.lock:
+            return [name for rooms in self.workers.values()
+                    for name in rooms.get(room, Counter()).elements()]
+
+    def count(self, room):
+        """Number of members of room on other workers"""
+        with self.lock:
+            return sum(sum(rooms[room].values()) for rooms in self.workers.values() if room in rooms)
@@ -0,0 +1,289 @@
+import json
+import re
+import struct
+from itertools import chain
+
+# Binary payloads start with a marker byte that neither JSON ('{') nor a compressed
+# payload (0x01) nor a v2 wire frame (0x02) can start with, so they decode without state
+BINARY_MARKER = b'\x03'
+
+# Tag tables are part of the wire contract: only ever append to them. Names missing
+# from a table are sent as strings after a 0 tag, so new message types need no codec change.
+MESSAGE_TYPES = (
+    None, 'message', 'user_joined', 'user_left', 'room_joined', 'history_page', 'rooms_list',
+    'auth', 'auth_result', 'register_result', 'join_room', 'get_history', 'get_rooms',
+    'create_room', 'room_created', 'hello', 'welcome', 'error', 'upload_begin', 'upload_chunk',
+    'upload_end', 'upload_ready', 'upload_complete', 'upload_failed', 'download', 'file_chunk',
+    'download_failed', 'get_metrics', 'metrics', 'search', 'search_results',
+    'set_retention', 'retention', 'throttled', 'ping', 'pong', 'profile', 'profile_report',
+    'room_added', 'room_removed', 'room_count_changed'
+)
+FIELD_NAMES = (
+    None, 'username', 'message', 'room', 'timestamp', 'message_type', 'success', 'error',
+    'history', 'users', 'before_id', 'has_more', 'messages', 'rooms', 'action', 'password',
+    'room_name', 'limit', 'session_token', 'token_expires', 'resumed', 'token', 'sha256',
+    'size', 'offset', 'length', 'data', 'filename', 'mime_type', 'version', 'versions',
+    'compression', 'compression_threshold', 'codec', 'codecs', 'email', 'metrics', 'query',
+    'results', 'since', 'until', 'max_age_days', 'max_messages', 'seq',
+    'since_seq', 'delta', 'too_far_behind', 'request', 'retry_after', 'heartbeat',
+    'heartbeat_interval', 'sample_every', 'memory', 'profiling', 'sampled', 'functions',
+    'allocations', 'handlers', 'members', 'subscribe'
+)
+TYPE_TAGS = {name: tag for tag, name in enumerate(MESSAGE_TYPES) if name}
+FIELD_TAGS = {name: tag for tag, name in enumerate(FIELD_NAMES) if name}
+
+# Value tags
+NONE, FALSE, TRUE, INT, FLOAT, STR, LIST, DICT, TIMESTAMP, STRLIST, TABLE = range(11)
+
+FLOAT_FIELD = struct.Struct('!d')
+# 'YYYY-MM-DD HH:MM:SS' timestamps travel as six packed integers instead of 19 characters
+TIMESTAMP_FIELD = struct.Struct('!HBBBBB')
+TIMESTAMP_PATTERN = re.compile(r'[0-9]{4}-[0-9]{2}-[0-9]{2} [0-9]{2}:[0-9]{2}:[0-9]{2}\Z')
+
+class CodecError(ValueError):
+    """Raised when a binary payload is malformed"""
+    pass
+
+class JsonCodec:
+    """Plain JSON, readable on the wire and kept for debugging and older peers"""
+    name = 'json'
+
+    def encode(self, message):
+        return json.dumps(message).encode()
+
+    def decode(self, payload):
+        return json.loads(payload)
+
+class BinaryCodec:
+    """Compact tagged binary encoding of protocol messages
+
+    A payload is the marker, the message type tag and a map of the remaining fields.
+    Field names and message types become one-byte tags, integers are zigzag varints,
+    strings and containers are varint length-prefixed and timestamps are struct-packed.
+    Lists of strings, and lists of equal-length rows of strings such as a history page,
+    are packed as one NUL-joined block so they cost a single join and split instead of
+    a tag per item.
+    """
+    name = 'binary'
+
+    def encode(self, message):
+        out = bytearray(BINARY_MARKER)
+        message_type = message.get('type')
+        tag = TYPE_TAGS.get(message_type)
+        if tag is None:
+            out.append(0)
+            write_value(out, message_type)
+        else:
+            out.append(tag)
+        write_fields(out, message, len(message) - ('type' in message), 'type')
+        return bytes(out)
+
+    def decode(self, payload):
+        if payload[:1] != BINARY_MARKER:
+            raise CodecError("Not a binary payload")
+        payload = bytes(payload)
+        try:
+            tag = payload[1]
+            if tag:
+                message_type, pos = MESSAGE_TYPES[tag], 2
+            else:
+                message_type, pos = read_value(payload, 2)
+            message = {'type': message_type}
+            pos = read_fields(payload, pos, message)
+        except (IndexError, UnicodeDecodeError, struct.error) as e:
+            raise CodecError(f"Malformed binary payload: {e}")
+        if pos != len(payload):
+            raise CodecError("Trailing bytes after binary payload")
+        return message
+
+def write_varint(out, value):
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+def write_string(out, value):
+    encoded = value.encode()
+    length = len(encoded)
+    if length < 0x80:
+        out.append(length)
+    else:
+        write_varint(out, length)
+    out += encoded
+
+def write_fields(out, fields, count, skip=None):
+    write_varint(out, count)
+    for key, value in fields.items():
+        if key == skip:
+            continue
+        tag = FIELD_TAGS.get(key)
+        if tag is None:
+            out.append(0)
+            write_string(out, key)
+        else:
+            out.append(tag)
+        # Plain strings are by far the most common value, so they skip the type dispatch
+        if type(value) is str and len(value) != 19:
+            out.append(STR)
+            encoded = value.encode()
+            if len(encoded) < 0x80:
+                out.append(len(encoded))
+            else:
+                write_varint(out, len(encoded))
+            out += encoded
+        else:
+            write_value(out, value)
+
+def write_value(out, value):
+    kind = type(value)
+    if kind is str:
+        if len(value) == 19 and TIMESTAMP_PATTERN.match(value):
+            out.append(TIMESTAMP)
+            out += TIMESTAMP_FIELD.pack(int(value[0:4]), int(value[5:7]), int(value[8:10]),
+                                        int(value[11:13]), int(value[14:16]), int(value[17:19]))
+        else:
+            out.append(STR)
+            write_string(out, value)
+    elif kind is int:
+        out.append(INT)
+        write_varint(out, value << 1 if value >= 0 else ((-value) << 1) - 1)
+    elif value is None:
+        out.append(NONE)
+    elif kind is bool:
+        out.append(TRUE if value else FALSE)
+    elif kind is list or kind is tuple:
+        if value and write_strings(out, value):
+            return
+        out.append(LIST)
+        write_varint(out, len(value))
+        for item in value:
+            write_value(out, item)
+    elif kind is dict:
+        out.append(DICT)
+        write_fields(out, value, len(value))
+    elif kind is float:
+        out.append(FLOAT)
+        out += FLOAT_FIELD.pack(value)
+    else:
+        raise TypeError(f"Cannot encode {kind.__name__} values")
+
+def write_strings(out, items):
+    """Pack a list of strings or of string rows as one block; False if items don't qualify"""
+    table = set(map(type, items)) <= {list, tuple}
+    try:
+        if table:
+            widths = set(map(len, items))
+            width = len(items[0])
+            if widths != {width} or not width:
+                return False
+            cells = len(items) * width
+            joined = '\0'.join(chain.from_iterable(items)).encode()
+        else:
+            cells = len(items)
+            joined = '\0'.join(items).encode()
+    except TypeError:
+        # str.join rejects any non-string item, which is cheaper than checking each one
+        return False
+    # A NUL inside an item would split it; such lists take the general path
+    if joined.count(0) != cells - 1:
+        return False
+    if table:
+        out.append(TABLE)
+        write_varint(out, len(items))
+        write_varint(out, width)
+    else:
+        out.append(STRLIST)
+    write_varint(out, len(joined))
+    out += joined
+    return True
+
+def read_varint(data, pos):
+    byte = data[pos]
+    if byte < 0x80:
+        return byte, pos + 1
+    result = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+def read_block(data, pos):
+    length, pos = read_varint(data, pos)
+    end = pos + length
+    if end > len(data):
+        raise IndexError("value runs past end of payload")
+    return data[pos:end], end
+
+def read_fields(data, pos, fields):
+    count, pos = read_varint(data, pos)
+    for _ in range(count):
+        tag = data[pos]
+        if tag:
+            if tag >= len(FIELD_NAMES):
+                raise IndexError(f"unknown field tag {tag}")
+            key, pos = FIELD_NAMES[tag], pos + 1
+        else:
+            key, pos = read_block(data, pos + 1)
+            key = key.decode()
+        fields[key], pos = read_value(data, pos)
+    return pos
+
+def read_value(data, pos):
+    tag = data[pos]
+    pos += 1
+    if tag == STR:
+        value, pos = read_block(data, pos)
+        return value.decode(), pos
+    if tag == STRLIST:
+        value, pos = read_block(data, pos)
+        return value.decode().split('\0'), pos
+    if tag == TABLE:
+        rows, pos = read_varint(data, pos)
+        width, pos = read_varint(data, pos)
+        value, pos = read_block(data, pos)
+        cells = value.decode().split('\0')
+        if not width or len(cells) != rows * width:
+            raise CodecError("Table size does not match its cells")
+        return list(map(list, zip(*[iter(cells)] * width))), pos
+    if tag == INT:
+        value, pos = read_varint(data, pos)
+        return (value >> 1) ^ -(value & 1), pos
+    if tag == TIMESTAMP:
+        year, month, day, hour, minute, second = TIMESTAMP_FIELD.unpack_from(data, pos)
+        return (f"{year:04d}-{month:02d}-{day:02d} {hour:02d}:{minute:02d}:{second:02d}",
+                pos + TIMESTAMP_FIELD.size)
+    if tag == NONE:
+        return None, pos
+    if tag == TRUE:
+        return True, pos
+    if tag == FALSE:
+        return False, pos
+    if tag == LIST:
+        count, pos = read_varint(data, pos)
+        items = []
+        for _ in range(count):
+            item, pos = read_value(data, pos)
+            items.append(item)
+        return items, pos
+    if tag == DICT:
+        fields = {}
+        return fields, read_fields(data, pos, fields)
+    if tag == FLOAT:
+        return FLOAT_FIELD.unpack_from(data, pos)[0], pos + FLOAT_FIELD.size
+    raise CodecError(f"Unknown value tag {tag}")
+
+CODECS = {'binary': BinaryCodec(), 'json': JsonCodec()}
+DEFAULT_CODECS = ('binary', 'json')
+
+def dumps(message, codec='json'):
+    """Serialize a protocol message with the named codec"""
+    return CODECS[codec].encode(message)
+
+def loads(payload):
+    """Parse a payload produced by any codec; the first byte tells them apart"""
+    if payload[:1] == BINARY_MARKER:
+        return CODECS['binary'].decode(payload)
+    return json.loads(payload)
@@ -0,0 +1,186 @@
+import cProfile
+import pstats
+import threading
+import time
+import tracemalloc
+from datetime import datetime
+
+# Stack depth kept per traced allocation; one frame is enough to rank allocation sites
+TRACEMALLOC_FRAMES = 1
+
+class HandlerProfiler:
+    """Samples request handlers with cProfile, and optionally allocations with tracemalloc
+
+    Off until an admin switches it on, so the normal request path only pays for one
+    attribute check. While on, every sample_every-th request runs under a profiler of its
+    own type, so the report shows where each request type spends its time. A profiler
+    only hooks the thread that starts it, so one request is profiled at a time and
+    requests arriving meanwhile run as usual. Work a handler hands to a pool, such as
+    password hashing, is not included. tracemalloc traces every allocation of the whole
+    process while it runs, which is much more costly, so it is requested separately.
+    """
+    def __init__(self):
+        self.active = False
+        self.sample_every = 100
+        self.memory = False
+        self.since = None
+        self.seen = 0
+        self.profiles = {}
+        self.sampled = {}
+        self.allocations = None
+        self.lock = threading.Lock()
+
+    def start(self, sample_every=100, memory=False):
+        """Begin a fresh profiling run, discarding the results of the last one"""
+        with self.lock:
+            self.sample_every = max(1, int(sample_every))
+            self.seen = 0
+            self.profiles = {}
+            self.sampled = {}
+            self.allocations = None
+            if memory and self.memory:
+                tracemalloc.clear_traces()
+            elif memory:
+                tracemalloc.start(TRACEMALLOC_FRAMES)
+            elif self.memory:
+                tracemalloc.stop()
+            self.memory = memory
+            self.since = datetime.now().isoformat()
+            self.active = True
+
+    def stop(self):
+        """Stop sampling; the results stay available for report()"""
+        with self.lock:
+            self.active = False
+            if self.memory:
+                # Tracing ends with the run, so keep what it found for the report
+                self.allocations = self.take_allocations()
+                tracemalloc.stop()
+                self.memory = False
+
+    def due(self):
+        # Unlocked; a lost increment only shifts which request gets sampled
+        self.seen += 1
+        return self.seen % self.sample_every == 0
+
+    def run(self, message_type, function, session, data):
+        """Call one handler under its request type's profiler"""
+        if not self.lock.acquire(blocking=False):
+            return function(session, data)
+        try:
+            if not self.active:
+                return function(session, data)
+            profile = self.profiles.get(message_type)
+            if profile is None:
+                profile = self.profiles[message_type] = cProfile.Profile()
+            self.sampled[message_type] = self.sampled.get(message_type, 0) + 1
+            return profile.runcall(function, session, data)
+        finally:
+            self.lock.release()
+
+    def take_allocations(self):
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, cProfile.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>')
+        ))
+        return snapshot.statistics('lineno')
+
+    def report(self, limit=20):
+        """Top functions by own time per sampled request type, and top allocation sites
+
+        Functions are [location, calls, own seconds, cumulative seconds] and allocation
+        sites [location, bytes, blocks], both largest first.
+        """
+        with self.lock:
+            functions = {}
+            for message_type, profile in self.profiles.items():
+                # snapshot_stats reads the totals without disabling the profiler like
+                # pstats.Stats would
+                profile.snapshot_stats()
+                rows = sorted(profile.stats.items(), key=lambda item: item[1][2], reverse=True)[:limit]
+                functions[message_type] = [
+                    [pstats.func_std_string(pstats.func_strip_path(key)), calls, round(own, 6), round(cumulative, 6)]
+                    for key, (_, calls, own, cumulative, _) in rows
+                ]
+            allocations = self.take_allocations() if self.memory else self.allocations
+            return {
+                'profiling': self.active,
+                'since': self.since,
+                'sample_every': self.sample_every,
+                'sampled': dict(self.sampled),
+                'functions': functions,
+                'allocations': [
+                    [str(stat.traceback[0]), stat.size, stat.count] for stat in (allocations or [])[:limit]
+                ]
+            }
+
+class HandlerRegistry:
+    """Routes each request to the handler registered for its type
+
+    A handler is called with the session and the decoded request and may return a
+    response, which is sent back on the same session, or a Future when it handed the
+    request to a worker pool, which the connection's reader waits for before reading on.
+    Requests of unknown types, or that need a login the session does not have, are
+    ignored; admin-only ones from other users are refused. Every handled request is
+    counted and timed per type, and also into a histogram labelled by type when
+    metrics are enabled.
+    """
+    def __init__(self, respond, metrics, admins=()):
+        self.respond = respond
+        self.admins = admins
+        self.handlers = {}
+        # message type -> [calls, seconds]; kept whether or not metrics are enabled
+        self.totals = {}
+        self.totals_lock = threading.Lock()
+        self.seconds = metrics.histogram(
+            'chat_handler_seconds', "Time to handle one request, by request type", label='type')
+        self.profiler = HandlerProfiler()
+
+    def register(self, message_type, function, login=True, admin=False, sampled=True):
+        """Handle message_type with function(session, data); sampled=False keeps it out of profiles"""
+        self.handlers[message_type] = (function, login or admin, admin, sampled)
+
+    def dispatch(self, session, data):
+        """Run the handler for one decoded request; returns its Future, if any"""
+        message_type = data.get('type')
+        handler = self.handlers.get(message_type)
+        if handler is None:
+            return None
+        function, login, admin, sampled = handler
+        if login and not session.username:
+            return None
+        started = time.perf_counter()
+        try:
+            if admin and session.username not in self.admins:
+                result = {'type': 'error', 'error': 'Not authorized'}
+            elif sampled and self.profiler.active and self.profiler.due():
+                result = self.profiler.run(message_type, function, session, data)
+            else:
+                result = function(session, data)
+            if isinstance(result, dict):
+                self.respond(session, result)
+                return None
+            return result
+        finally:
+            elapsed = time.perf_counter() - started
+            with self.totals_lock:
+                totals = self.totals.get(message_type)
+                if totals is None:
+                    totals = self.totals[message_type] = [0, 0.0]
+                totals[0] += 1
+                totals[1] += elapsed
+            self.seconds.observe(elapsed, message_type)
+
+    def stats(self):
+        """Calls and time spent per request type since the server started"""
+        with self.totals_lock:
+            totals = {message_type: tuple(entry) for message_type, entry in self.totals.items()}
+        return {
+            message_type: {
+                'calls': calls,
+                'seconds': round(seconds, 6),
+                'mean_ms': round(seconds * 1000 / calls, 3) if calls else 0
+            }
+            for message_type, (calls, seconds) in totals.items()
+        }
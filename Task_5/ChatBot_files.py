@@ -0,0 +1,120 @@
+import hashlib
+import os
+import re
+
+CHUNK_SIZE = 64 * 1024
+MAX_FILE_SIZE = 100 * 1024 * 1024
+
+DIGEST_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+
+class TransferError(Exception):
+    """Raised when an upload or download request cannot be honoured"""
+    pass
+
+class Upload:
+    """An upload in progress, appended chunk by chunk to a .part file
+
+    The digest is updated as chunks arrive, so finishing never re-reads the file. A
+    .part file left by an interrupted upload is re-hashed once and continued from its end.
+    """
+    def __init__(self, sha256, size, path):
+        self.sha256 = sha256
+        self.size = size
+        self.path = path
+        self.digest = hashlib.sha256()
+        self.offset = 0
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(CHUNK_SIZE), b''):
+                    self.digest.update(block)
+                    self.offset += len(block)
+            if self.offset > size:
+                os.remove(path)
+                self.digest = hashlib.sha256()
+                self.offset = 0
+        self.file = open(path, 'ab')
+
+    def write(self, offset, data):
+        """Append the chunk that starts at offset"""
+        if offset != self.offset:
+            raise TransferError(f"Expected chunk at offset {self.offset}, got {offset}")
+        if self.offset + len(data) > self.size:
+            raise TransferError("Upload is larger than its declared size")
+        self.file.write(data)
+        self.digest.update(data)
+        self.offset += len(data)
+
+    def close(self):
+        self.file.close()
+
+class BlobStore:
+    """Content-addressed file store: each distinct file is kept once on disk under its SHA-256"""
+    def __init__(self, root, max_file_size=MAX_FILE_SIZE):
+        self.root = root
+        self.max_file_size = max_file_size
+        self.incoming = os.path.join(root, 'incoming')
+        os.makedirs(self.incoming, exist_ok=True)
+
+    @staticmethod
+    def valid_digest(sha256):
+        return isinstance(sha256, str) and DIGEST_PATTERN.match(sha256) is not None
+
+    def path(self, sha256):
+        if not self.valid_digest(sha256):
+            raise TransferError("Invalid file hash")
+        return os.path.join(self.root, sha256[:2], sha256)
+
+    def exists(self, sha256):
+        return self.valid_digest(sha256) and os.path.exists(self.path(sha256))
+
+    def size(self, sha256):
+        return os.path.getsize(self.path(sha256))
+
+    def begin_upload(self, sha256, size, owner):
+        """Start or resume an upload; returns None when the blob is already stored"""
+        if self.exists(sha256):
+            return None
+        if not self.valid_digest(sha256):
+            raise TransferError("Invalid file hash")
+        if not isinstance(size, int) or size < 0 or size > self.max_file_size:
+            raise TransferError(f"File size must be less than {self.max_file_size // (1024 * 1024)}MB")
+        owner_key = hashlib.sha1(owner.encode()).hexdigest()[:12]
+        return Upload(sha256, size, os.path.join(self.incoming, f"{sha256}.{owner_key}.part"))
+
+    def finish_upload(self, upload):
+        """Verify a completed upload and move it into the store"""
+        upload.close()
+        if upload.offset != upload.size:
+            raise TransferError(f"Upload incomplete: {upload.offset} of {upload.size} bytes")
+        if upload.digest.hexdigest() != upload.sha256:
+            os.remove(upload.path)
+            raise TransferError("Uploaded data does not match its hash")
+        target = self.path(upload.sha256)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if os.path.exists(target):
+            os.remove(upload.path)
+        else:
+            os.replace(upload.path, target)
+
+    def put_bytes(self, data):
+        """Store an in-memory blob and return its hash"""
+        sha256 = hashlib.sha256(data).hexdigest()
+        if not self.exists(sha256):
+            target = self.path(sha256)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            part = os.path.join(self.incoming, f"{sha256}.inline.part")
+            with open(part, 'wb') as f:
+                f.write(data)
+            os.replace(part, target)
+        return sha256
+
+    def read(self, sha256, offset, length=CHUNK_SIZE):
+        """Read one range of a stored blob, at most CHUNK_SIZE bytes"""
+        if not self.exists(sha256):
+            raise TransferError("File not found")
+        if offset < 0:
+            raise TransferError("Invalid offset")
+        with open(self.path(sha256), 'rb') as f:
+            f.seek(offset)
+            # A negative length would make read() return the rest of the file
+            return f.read(max(1, min(length, CHUNK_SIZE)))
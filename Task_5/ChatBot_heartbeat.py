@@ -0,0 +1,104 @@
+import heapq
+import itertools
+import socket
+import threading
+import time
+
+def enable_keepalive(sock, idle=60, interval=15, count=4):
+    """Let the kernel probe an idle connection and fail it when the peer is gone
+
+    Covers clients that never answer heartbeats: a dead peer's blocked recv then
+    errors out after about idle + interval * count seconds. The tuning options
+    are not available everywhere; the plain keepalive flag is.
+    """
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        for option, value in (('TCP_KEEPIDLE', idle), ('TCP_KEEPINTVL', interval), ('TCP_KEEPCNT', count)):
+            if hasattr(socket, option):
+                sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+    except OSError:
+        pass
+
+class HeartbeatMonitor:
+    """Pings quiet connections and closes the ones that stay silent
+
+    One thread watches every connection of either I/O mode. Deadlines sit in a heap
+    that is only touched when one comes due, never per received frame: a due entry
+    whose session was heard from since is pushed back to its new deadline. A session
+    quiet for interval seconds is sent a ping, and another every interval it stays
+    quiet; one silent for timeout seconds is closed, and its reader then cleans up
+    presence as for any other disconnect.
+    """
+    def __init__(self, ping, interval=30, timeout=90):
+        self.ping = ping
+        self.interval = interval
+        self.timeout = timeout
+        self.heap = []
+        self.order = itertools.count()
+        self.ready = threading.Condition()
+        self.closed = False
+        self.pings = 0
+        self.reaped = 0
+        self.thread = threading.Thread(target=self.run, name='heartbeat')
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def watch(self, session):
+        """Start monitoring a session that answers pings"""
+        self.schedule(session, session.last_seen + self.interval)
+
+    def schedule(self, session, deadline):
+        with self.ready:
+            heapq.heappush(self.heap, (deadline, next(self.order), session))
+            if self.heap[0][2] is session:
+                self.ready.notify()
+
+    def watched(self):
+        """Number of heap entries, i.e. sessions watched (closed ones linger until due)"""
+        return len(self.heap)
+
+    def run(self):
+        while True:
+            with self.ready:
+                while True:
+                    if self.closed:
+                        return
+                    if self.heap:
+                        wait = self.heap[0][0] - time.monotonic()
+                        if wait <= 0:
+                            _, _, session = heapq.heappop(self.heap)
+                            break
+                        self.ready.wait(wait)
+                    else:
+                        self.ready.wait()
+            self.check(session)
+
+    def check(self, session):
+        """Handle one due session: reschedule, ping or close it"""
+        if session.closed:
+            return
+        now = time.monotonic()
+        silent = now - session.last_seen
+        if silent >= self.timeout:
+            self.reaped += 1
+            session.close()
+            return
+        if silent >= self.interval:
+            # Pinged again every interval while quiet, closed once the timeout passes
+            try:
+                self.ping(session)
+                self.pings += 1
+            except ConnectionError:
+                return
+            self.schedule(session, min(session.last_seen + self.timeout, now + self.interval))
+        else:
+            self.schedule(session, session.last_seen + self.interval)
+
+    def close(self):
+        with self.ready:
+            self.closed = True
+            self.ready.notify()
+        if self.thread.is_alive():
+            self.thread.join()
@@ -0,0 +1,205 @@
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Seconds; spans a sub-millisecond fan-out up to a slow commit or KDF run
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+# Label values past a metric's cap are folded together, so user-created rooms
+# cannot grow the number of series without bound
+OTHER_LABEL = '_other'
+
+def format_value(value):
+    return repr(value) if isinstance(value, float) else str(value)
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in labels.values())
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + '}'
+
+class Counter:
+    """Monotonic counter, optionally split by one label"""
+    kind = 'counter'
+
+    def __init__(self, name, help, label=None, max_labels=1000):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.max_labels = max_labels
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, label_value=None):
+        with self.lock:
+            if label_value not in self.values and len(self.values) >= self.max_labels:
+                label_value = OTHER_LABEL
+            self.values[label_value] = self.values.get(label_value, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            values = list(self.values.items())
+        for label_value, value in values:
+            labels = {self.label: label_value} if self.label else {}
+            yield self.name, labels, value
+
+    def snapshot(self):
+        with self.lock:
+            if self.label:
+                return {str(label): value for label, value in self.values.items()}
+            return self.values.get(None, 0)
+
+class Histogram:
+    """Distribution of observed values over fixed buckets, optionally split by one label"""
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS, label=None, max_labels=100):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.label = label
+        self.max_labels = max_labels
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, label_value=None):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(label_value)
+            if series is None:
+                if len(self.series) >= self.max_labels:
+                    label_value = OTHER_LABEL
+                series = self.series.setdefault(label_value, [[0] * (len(self.buckets) + 1), 0.0])
+            series[0][index] += 1
+            series[1] += value
+
+    def collect(self):
+        """Per label value: (cumulative bucket counts, sum, count)"""
+        with self.lock:
+            series = [(label, list(counts), total) for label, (counts, total) in self.series.items()]
+        for label_value, counts, total in series:
+            cumulative = []
+            running = 0
+            for count in counts:
+                running += count
+                cumulative.append(running)
+            yield label_value, cumulative, total, running
+
+    def samples(self):
+        bounds = [format_value(bound) for bound in self.buckets] + ['+Inf']
+        for label_value, cumulative, total, count in self.collect():
+            labels = {self.label: label_value} if self.label else {}
+            for bound, running in zip(bounds, cumulative):
+                yield self.name + '_bucket', dict(labels, le=bound), running
+            yield self.name + '_sum', labels, total
+            yield self.name + '_count', labels, count
+
+    def snapshot(self):
+        bounds = [str(bound) for bound in self.buckets] + ['+Inf']
+        series = {
+            label_value: {'count': count, 'sum': total, 'buckets': dict(zip(bounds, cumulative))}
+            for label_value, cumulative, total, count in self.collect()
+        }
+        if not self.label:
+            return series.get(None, {'count': 0, 'sum': 0.0, 'buckets': {}})
+        return {str(label_value): values for label_value, values in series.items()}
+
+class Callback:
+    """Gauge or counter read from existing server state when metrics are collected"""
+    def __init__(self, name, help, function, kind='gauge'):
+        self.name = name
+        self.help = help
+        self.function = function
+        self.kind = kind
+
+    def samples(self):
+        yield self.name, {}, self.function()
+
+    def snapshot(self):
+        return self.function()
+
+class NullMetric:
+    """Stands in for counters and histograms when instrumentation is switched off"""
+    def inc(self, amount=1, label_value=None):
+        pass
+
+    def observe(self, value, label_value=None):
+        pass
+
+NULL_METRIC = NullMetric()
+
+class MetricsRegistry:
+    """The server's metrics, rendered in the Prometheus text format or as a dict"""
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.metrics = []
+
+    def counter(self, name, help, label=None, max_labels=1000):
+        return self.register(Counter(name, help, label, max_labels))
+
+    def histogram(self, name, help, buckets=DEFAULT_BUCKETS, label=None, max_labels=100):
+        return self.register(Histogram(name, help, buckets, label, max_labels))
+
+    def gauge(self, name, help, function):
+        return self.register(Callback(name, help, function))
+
+    def counter_function(self, name, help, function):
+        """A counter whose running total is kept elsewhere"""
+        return self.register(Callback(name, help, function, 'counter'))
+
+    def register(self, metric):
+        if not self.enabled and not isinstance(metric, Callback):
+            return NULL_METRIC
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format"""
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{format_labels(labels)} {format_value(value)}")
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        """All metrics as plain values, for the admin protocol message"""
+        return {metric.name: metric.snapshot() for metric in self.metrics}
+
+class MetricsServer:
+    """Serves a registry over HTTP on a background thread, for Prometheus to scrape"""
+    def __init__(self, registry, host='127.0.0.1', port=9100):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self.httpd = None
+
+    def start(self):
+        registry = self.registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?', 1)[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((self.host, self.port), Handler)
+        self.httpd.daemon_threads = True
+        thread = threading.Thread(target=self.httpd.serve_forever, name='metrics-http')
+        thread.daemon = True
+        thread.start()
+
+    def close(self):
+        if self.httpd:
+            self.httpd.shutdown()
+            self.httpd.server_close()
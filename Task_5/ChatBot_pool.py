@@ -0,0 +1,27 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+class WorkerPool:
+    """Bounded thread pool that keeps slow work (KDFs, searches) off the connection handlers
+
+    At most max_pending jobs may be queued or running; submit() returns None beyond
+    that so a burst is shed instead of piling up behind the work already queued.
+    """
+    def __init__(self, workers=None, max_pending=256, name='worker'):
+        self.workers = workers or min(4, os.cpu_count() or 1)
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=name)
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.rejected = 0
+
+    def submit(self, fn, *args):
+        """Run fn(*args) on the pool; returns a Future, or None when the pool is saturated"""
+        if not self.slots.acquire(blocking=False):
+            self.rejected += 1
+            return None
+        future = self.executor.submit(fn, *args)
+        future.add_done_callback(lambda f: self.slots.release())
+        return future
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
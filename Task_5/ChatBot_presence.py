@@ -0,0 +1,251 @@
+import threading
+
+class PresenceIndex:
+    """Thread-safe room membership and presence index
+
+    Rooms map to sets of sessions and every session maps back to the set of rooms it
+    is in, so join and leave are O(1). Fan-out reads an immutable snapshot of a room's
+    members that is rebuilt only after the membership changed, so broadcasts never
+    iterate a set another thread is mutating. Rooms that are not stored are forgotten
+    once their last member leaves.
+    """
+    def __init__(self, rooms=()):
+        self.lock = threading.Lock()
+        self.stored = set(rooms)
+        self.room_members = {room: set() for room in rooms}
+        self.memberships = {}
+        self.usernames = {}
+        self.snapshots = {}
+
+    def login(self, session, username):
+        """Mark a session as authenticated as username"""
+        with self.lock:
+            self.usernames[session] = username
+            for room in self.memberships.get(session, ()):
+                self.snapshots.pop(room, None)
+
+    def logout(self, session):
+        """Forget a session entirely and return the rooms it was removed from"""
+        with self.lock:
+            self.usernames.pop(session, None)
+            rooms = self.memberships.pop(session, set())
+            for room in rooms:
+                self.room_members[room].discard(session)
+                self.snapshots.pop(room, None)
+                self.discard_if_empty(room)
+            return rooms
+
+    def add_room(self, room):
+        """Make a stored room known, to be kept even while empty"""
+        with self.lock:
+            self.stored.add(room)
+            self.room_members.setdefault(room, set())
+
+    def room_names(self):
+        with self.lock:
+            return list(self.room_members)
+
+    def leave(self, session, room):
+        """Remove a session from a room; returns False if it was not a member"""
+        with self.lock:
+            return self.remove_member(session, room)
+
+    def switch(self, session, room):
+        """Move a session into room, leaving every other room, and return the rooms it left"""
+        with self.lock:
+            left = [r for r in self.memberships.get(session, ()) if r != room]
+            for r in left:
+                self.remove_member(session, r)
+            self.add_member(session, room)
+            return left
+
+    def members(self, room):
+        """Immutable snapshot of a room's sessions, safe to iterate without the lock"""
+        with self.lock:
+            return self.snapshot(room)[0]
+
+    def member_names(self, room):
+        """Usernames of a room's members"""
+        with self.lock:
+            return list(self.snapshot(room)[1])
+
+    def count(self, room):
+        return len(self.room_members.get(room, ()))
+
+    def rooms_of(self, session):
+        with self.lock:
+            return set(self.memberships.get(session, ()))
+
+    def add_member(self, session, room):
+        members = self.room_members.setdefault(room, set())
+        if session not in members:
+            members.add(session)
+            self.memberships.setdefault(session, set()).add(room)
+            self.snapshots.pop(room, None)
+
+    def remove_member(self, session, room):
+        members = self.room_members.get(room)
+        if not members or session not in members:
+            return False
+        members.discard(session)
+        rooms = self.memberships.get(session)
+        if rooms is not None:
+            rooms.discard(room)
+            if not rooms:
+                del self.memberships[session]
+        self.snapshots.pop(room, None)
+        self.discard_if_empty(room)
+        return True
+
+    def discard_if_empty(self, room):
+        """Forget a room nobody is in unless it is stored; caller holds the lock"""
+        if not self.room_members[room] and room not in self.stored:
+            del self.room_members[room]
+
+    def snapshot(self, room):
+        """Cached (sessions, usernames) tuple for a room; caller holds the lock"""
+        snapshot = self.snapshots.get(room)
+        if snapshot is None:
+            if room not in self.room_members:
+                # Not cached, so lookups of unknown rooms leave nothing behind
+                return (), ()
+            sessions = tuple(self.room_members[room])
+            names = tuple(self.usernames.get(s, 'Unknown') for s in sessions)
+            snapshot = (sessions, names)
+            self.snapshots[room] = snapshot
+        return snapshot
+
+class RoomDirectory:
+    """The room list with member counts, kept in memory and pushed to subscribers as changes
+
+    Holds every stored room plus any other room someone is in, so listing rooms never
+    reads the database. Joins, leaves and new rooms only mark a room as changed; a
+    background thread looks at the changed rooms once per interval and sends
+    subscribers at most one room_added, room_removed and room_count_changed message
+    for everything that happened meanwhile, so a busy server costs one small update
+    per interval instead of a full list per poll. Rooms that exist only because
+    someone is in them are removed again once empty.
+    """
+    def __init__(self, count, send, interval=0.5):
+        self.count = count
+        self.send = send
+        self.interval = interval
+        self.stored = set()
+        self.rooms = {}
+        self.dirty = set()
+        self.subscribers = set()
+        self.listing = None
+        self.lock = threading.Condition()
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, name='room-directory')
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def load(self, rooms):
+        """Take the stored rooms at startup; their counts follow as members join"""
+        with self.lock:
+            for room in rooms:
+                self.stored.add(room)
+                self.rooms.setdefault(room, 0)
+            self.listing = None
+
+    def add_room(self, room):
+        """A room was created, here or on another worker"""
+        with self.lock:
+            self.stored.add(room)
+            self.mark_locked((room,))
+
+    def mark(self, rooms):
+        """Note that the membership of rooms changed"""
+        if rooms:
+            with self.lock:
+                self.mark_locked(rooms)
+
+    def mark_all(self, rooms=()):
+        """Recount every listed room, plus rooms, e.g. after another worker came or went"""
+        with self.lock:
+            self.mark_locked(set(self.rooms).union(rooms))
+
+    def mark_locked(self, rooms):
+        if not self.dirty:
+            self.lock.notify()
+        self.dirty.update(rooms)
+
+    def __len__(self):
+        return len(self.rooms)
+
+    def rooms_list(self):
+        """The full list as a rooms_list message, rebuilt only after something changed"""
+        with self.lock:
+            return self.rooms_list_locked()
+
+    def rooms_list_locked(self):
+        if self.listing is None:
+            self.listing = {'type': 'rooms_list', 'rooms': list(self.rooms), 'members': list(self.rooms.values())}
+        return self.listing
+
+    def subscribe(self, session, respond):
+        """Send a session the full list and from then on every change to it
+
+        The list is sent under the lock, so no change it already contains can reach
+        the session after it.
+        """
+        with self.lock:
+            self.subscribers.add(session)
+            respond(session, self.rooms_list_locked())
+
+    def unsubscribe(self, session):
+        with self.lock:
+            self.subscribers.discard(session)
+
+    def run(self):
+        with self.lock:
+            while True:
+                while not self.dirty and not self.closed:
+                    self.lock.wait()
+                if self.closed:
+                    return
+                # Let the changes of one interval gather into one update
+                self.lock.wait(self.interval)
+                if self.closed:
+                    return
+                self.flush()
+
+    def flush(self):
+        """Apply the marked rooms' current counts and notify subscribers; caller holds the lock"""
+        added, removed, changed = [], [], []
+        for room in sorted(self.dirty):
+            count = self.count(room)
+            if room not in self.rooms:
+                if count or room in self.stored:
+                    self.rooms[room] = count
+                    added.append(room)
+            elif not count and room not in self.stored:
+                del self.rooms[room]
+                removed.append(room)
+            elif count != self.rooms[room]:
+                self.rooms[room] = count
+                changed.append(room)
+        self.dirty.clear()
+        if not (added or removed or changed):
+            return
+        self.listing = None
+        sessions = tuple(self.subscribers)
+        if not sessions:
+            return
+        if removed:
+            self.send(sessions, {'type': 'room_removed', 'rooms': removed})
+        if added:
+            self.send(sessions, {'type': 'room_added', 'rooms': added, 'members': [self.rooms[r] for r in added]})
+        if changed:
+            self.send(sessions, {'type': 'room_count_changed', 'rooms': changed,
+                                 'members': [self.rooms[r] for r in changed]})
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.lock.notify()
+        if self.thread.is_alive():
+            self.thread.join()
@@ -0,0 +1,122 @@
+import struct
+import zlib
+import os
+import base64
+from cryptography.fernet import Fernet
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+# Every frame on the wire is a 4-byte big-endian payload length followed by the payload
+FRAME_HEADER = struct.Struct('!I')
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+class FrameError(Exception):
+    """Raised when the peer sends a frame that cannot be decoded"""
+    pass
+
+def encode_frame(payload):
+    """Prefix a payload with its length header"""
+    if len(payload) > MAX_FRAME_SIZE:
+        raise FrameError(f"Frame of {len(payload)} bytes exceeds limit of {MAX_FRAME_SIZE}")
+    return FRAME_HEADER.pack(len(payload)) + payload
+
+class FrameDecoder:
+    """Incremental decoder that turns arbitrary recv() chunks into complete frames"""
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE):
+        self.max_frame_size = max_frame_size
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        """Append received bytes and return every frame completed by them"""
+        self.buffer += data
+        frames = []
+        offset = 0
+        header_size = FRAME_HEADER.size
+
+        while len(self.buffer) - offset >= header_size:
+            (length,) = FRAME_HEADER.unpack_from(self.buffer, offset)
+            if length > self.max_frame_size:
+                raise FrameError(f"Frame of {length} bytes exceeds limit of {self.max_frame_size}")
+            end = offset + header_size + length
+            if len(self.buffer) < end:
+                break
+            frames.append(bytes(self.buffer[offset + header_size:end]))
+            offset = end
+
+        # Drop consumed bytes once per feed so a large partial frame is never re-copied per frame
+        if offset:
+            del self.buffer[:offset]
+        return frames
+
+    def pending(self):
+        """Number of buffered bytes belonging to an incomplete frame"""
+        return len(self.buffer)
+
+# Payloads are JSON, which always starts with '{', so a leading marker byte can
+# flag a compressed payload without any per-connection state on the receiving side
+COMPRESSED_MARKER = b'\x01'
+COMPRESSION_THRESHOLD = 256
+MAX_PAYLOAD_SIZE = 64 * 1024 * 1024
+
+# Preset dictionary of the protocol's JSON vocabulary, most frequent fragments last
+ZLIB_DICTIONARY = (
+    b'"resumed": true, "session_token": "token_expires": "error": "success": false, "success": true, '
+    b'"has_more": false, "has_more": true, "before_id": null, "before_id": '
+    b'"mime_type": "image/png", "mime_type": null, "filename": "size": "sha256": "offset": "data": "'
+    b'{"type": "rooms_list", "rooms": ["general", {"type": "history_page", "messages": [['
+    b'{"type": "room_joined", "room": "general", "history": [["users": ["'
+    b'{"type": "user_left", "username": "{"type": "user_joined", "username": "'
+    b'"message_type": "image", "message_type": "file", "message_type": "text", "timestamp": "20'
+    b'{"type": "message", "username": "", "message": "", "room": "general", "timestamp": "20'
+)
+
+def compress_payload(payload, threshold=COMPRESSION_THRESHOLD):
+    """zlib-compress a payload with the protocol dictionary if that makes it smaller"""
+    if len(payload) < threshold:
+        return payload
+    compressor = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS, zdict=ZLIB_DICTIONARY)
+    compressed = COMPRESSED_MARKER + compressor.compress(payload) + compressor.flush()
+    return compressed if len(compressed) < len(payload) else payload
+
+def decompress_payload(payload, max_size=MAX_PAYLOAD_SIZE):
+    """Undo compress_payload; uncompressed payloads pass through unchanged"""
+    if not payload.startswith(COMPRESSED_MARKER):
+        return payload
+    decompressor = zlib.decompressobj(zlib.MAX_WBITS, zdict=ZLIB_DICTIONARY)
+    data = decompressor.decompress(payload[1:], max_size)
+    if decompressor.unconsumed_tail:
+        raise FrameError(f"Compressed payload expands beyond {max_size} bytes")
+    return data
+
+# Wire versions: 1 = base64(Fernet token), kept for older clients; 2 = raw AES-256-GCM.
+# A v1 frame is base64 text and so never starts with 0x02, which keeps frames self-describing.
+WIRE_VERSIONS = (2, 1)
+V2_MARKER = b'\x02'
+NONCE_SIZE = 12
+
+def derive_aead_key(fernet_key):
+    """Derive the v2 AES-GCM key from the shared Fernet key, so both versions use one secret"""
+    return HKDF(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=None,
+        info=b'chat wire v2 aes-256-gcm'
+    ).derive(base64.urlsafe_b64decode(fernet_key))
+
+class WireCipher:
+    """Encrypts payloads in either wire version and decrypts whichever version arrives"""
+    def __init__(self, key):
+        self.fernet = Fernet(key)
+        self.aead = AESGCM(derive_aead_key(key))
+
+    def encrypt(self, payload, version=1):
+        if version >= 2:
+            nonce = os.urandom(NONCE_SIZE)
+            return V2_MARKER + nonce + self.aead.encrypt(nonce, payload, None)
+        return base64.b64encode(self.fernet.encrypt(payload))
+
+    def decrypt(self, data):
+        if data[:1] == V2_MARKER:
+            return self.aead.decrypt(data[1:1 + NONCE_SIZE], data[1 + NONCE_SIZE:], None)
+        return self.fernet.decrypt(base64.b64decode(data))
@@ -0,0 +1,117 @@
+import threading
+import time
+
+# name: (tokens per second, burst). Message limits are per user, room_messages per room,
+# register per client address; message_bytes counts the characters of chat messages.
+DEFAULT_RATE_LIMITS = {
+    'messages': (5, 20),
+    'message_bytes': (16 * 1024, 64 * 1024),
+    'room_messages': (100, 300),
+    'create_room': (0.1, 3),
+    'register': (0.05, 5)
+}
+
+def parse_rate_limit(text):
+    """Parse 'name=rate/burst' (or 'name=off') from the command line"""
+    name, _, value = text.partition('=')
+    if name not in DEFAULT_RATE_LIMITS:
+        raise ValueError(f"Unknown rate limit {name!r}, expected one of {', '.join(DEFAULT_RATE_LIMITS)}")
+    if value == 'off':
+        return name, None
+    rate, _, burst = value.partition('/')
+    rate = float(rate)
+    burst = float(burst) if burst else max(rate, 1)
+    if rate <= 0 or burst <= 0:
+        raise ValueError("Rate and burst must be positive")
+    return name, (rate, burst)
+
+class TokenBucket:
+    """Holds up to burst tokens, refilled at rate per second"""
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait(self, amount, now):
+        """Seconds until amount tokens are available, 0 if they are now"""
+        self.refill(now)
+        # A request larger than the burst can never fit; charge the whole burst instead
+        amount = min(amount, self.burst)
+        if self.tokens >= amount:
+            return 0
+        return (amount - self.tokens) / self.rate
+
+    def take(self, amount, now):
+        """Spend amount tokens; returns 0 on success, else seconds until they are available"""
+        wait = self.wait(amount, now)
+        if not wait:
+            self.tokens -= min(amount, self.burst)
+        return wait
+
+class RateLimiter:
+    """Token buckets per (limit, key), e.g. ('messages', username) or ('room_messages', room)
+
+    Buckets are created on first use and forgotten once they have refilled, so memory
+    follows the keys active recently rather than every user ever seen. A limit set
+    to None is not enforced.
+    """
+    def __init__(self, limits=None, max_buckets=100000):
+        self.limits = dict(DEFAULT_RATE_LIMITS)
+        self.limits.update(limits or {})
+        self.max_buckets = max_buckets
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def check(self, name, key, amount=1):
+        """Spend from one bucket; returns 0 when allowed, else seconds to wait"""
+        return self.check_all([(name, key, amount)])[0]
+
+    def check_all(self, requests):
+        """Spend from several buckets, but only if every one of them allows it
+
+        requests are (name, key, amount) triples. Returns (0, None) when allowed, else
+        the longest wait and the name of the limit imposing it, with nothing spent,
+        so a request one limit rejects does not use up the others.
+        """
+        now = time.monotonic()
+        with self.lock:
+            buckets = []
+            wait, limited = 0, None
+            for name, key, amount in requests:
+                bucket = self.bucket(name, key, now)
+                if bucket is None:
+                    continue
+                bucket_wait = bucket.wait(amount, now)
+                if bucket_wait > wait:
+                    wait, limited = bucket_wait, name
+                buckets.append((bucket, amount))
+            if not wait:
+                for bucket, amount in buckets:
+                    bucket.take(amount, now)
+            return wait, limited
+
+    def bucket(self, name, key, now):
+        """The bucket of (name, key), created full on first use; None if the limit is off"""
+        limit = self.limits.get(name)
+        if limit is None:
+            return None
+        bucket = self.buckets.get((name, key))
+        if bucket is None:
+            if len(self.buckets) >= self.max_buckets:
+                self.prune(now)
+            bucket = self.buckets[(name, key)] = TokenBucket(limit[0], limit[1], now)
+        return bucket
+
+    def prune(self, now):
+        """Drop buckets that are full again, which behave exactly like new ones"""
+        for key, bucket in list(self.buckets.items()):
+            bucket.refill(now)
+            if bucket.tokens >= bucket.burst:
+                del self.buckets[key]
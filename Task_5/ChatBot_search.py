@@ -0,0 +1,170 @@
+import re
+
+# Attachments are stored as blob references, which are not worth searching
+UNINDEXED_TYPES = ('image', 'file')
+
+# Roughly what FTS5's unicode61 tokenizer treats as one token
+TOKEN_PATTERN = re.compile(r'[^\W_]+')
+TERM_PATTERN = re.compile(r'([^\W_]+)(\*?)')
+
+# BM25 term saturation and length normalisation
+K1 = 1.2
+B = 0.75
+
+def query_terms(query):
+    """Lowercased (word, is_prefix) pairs of a free-text query; 'word*' is a prefix"""
+    return [(word.lower(), bool(star)) for word, star in TERM_PATTERN.findall(query)]
+
+def match_expression(terms):
+    """FTS5 query matching every term in the message column
+
+    Terms are quoted, so FTS5 operators and punctuation typed by users never reach
+    the query parser.
+    """
+    return 'message : (' + ' AND '.join(f'"{word}"' + ('*' if prefix else '') for word, prefix in terms) + ')'
+
+def room_expression(room):
+    """FTS5 filter narrowing candidates to rooms whose names contain room's words"""
+    words = TOKEN_PATTERN.findall(room)
+    if not words:
+        return None
+    return 'room : "' + ' '.join(words) + '"'
+
+def rank(rows, terms):
+    """Order candidate rows (id, room, username, message, timestamp) best match first
+
+    Every candidate contains every term, so inverse document frequency cannot tell
+    them apart; what is left of BM25 is term frequency against message length, both
+    counted in tokens the way FTS5 splits them, so 'cat' does not count inside
+    'concatenate' unless it was searched as 'cat*'. Ties go to the newest message.
+    """
+    tokenized = [TOKEN_PATTERN.findall(row[3].lower()) for row in rows]
+    average = sum(map(len, tokenized)) / len(rows) if rows else 1
+    scored = []
+    for row, tokens in zip(rows, tokenized):
+        norm = K1 * (1 - B + B * len(tokens) / (average or 1))
+        score = 0.0
+        for word, prefix in terms:
+            if prefix:
+                frequency = sum(1 for token in tokens if token.startswith(word))
+            else:
+                frequency = tokens.count(word)
+            score += frequency * (K1 + 1) / (frequency + norm)
+        scored.append((-score, -row[0], row))
+    scored.sort(key=lambda item: item[:2])
+    return [row for _, _, row in scored]
+
+class MessageSearch:
+    """Ranked full-text search over chat messages using an SQLite FTS5 index
+
+    The index is an external-content FTS5 table over messages, kept in sync by
+    triggers, so every batch the message writer commits is indexed in the same
+    transaction. Text messages are indexed; image and file references are not.
+    The room column is indexed too, which lets a room-scoped search skip other
+    rooms' matches inside FTS5 instead of ranking them and filtering afterwards.
+
+    Ranking every match of a common word costs time in proportion to the table (FTS5's
+    bm25() alone scans all of them to count documents), so matches are ranked, in
+    Python, in windows of `candidates` at a time, newest window first. FTS5 walks its
+    index newest-first and stops at the end of the window, which keeps a page bounded
+    however much history there is; for all but the most common words the first window
+    holds every match, and paging past a full window carries on into the next one.
+    """
+    def __init__(self, conn, lock, candidates=1000):
+        self.conn = conn
+        self.lock = lock
+        self.candidates = candidates
+
+    def create_schema(self):
+        """Create the index and its triggers, indexing existing messages on first run"""
+        excluded = ', '.join(f"'{t}'" for t in UNINDEXED_TYPES)
+        with self.lock:
+            cursor = self.conn.cursor()
+            # Workers start together; the write lock makes exactly one of them backfill
+            cursor.execute("BEGIN IMMEDIATE")
+            cursor.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'messages_fts'"
+            )
+            exists = cursor.fetchone() is not None
+            cursor.execute('''
+                CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+                    message, room, content='messages', content_rowid='id'
+                )
+            ''')
+            cursor.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages
+                WHEN new.message_type NOT IN ({excluded})
+                BEGIN
+                    INSERT INTO messages_fts (rowid, message, room) VALUES (new.id, new.message, new.room);
+                END
+            ''')
+            cursor.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages
+                WHEN old.message_type NOT IN ({excluded})
+                BEGIN
+                    INSERT INTO messages_fts (messages_fts, rowid, message, room)
+                    VALUES ('delete', old.id, old.message, old.room);
+                END
+            ''')
+            if not exists:
+                cursor.execute(
+                    f"INSERT INTO messages_fts (rowid, message, room) "
+                    f"SELECT id, message, room FROM messages WHERE message_type NOT IN ({excluded})"
+                )
+            self.conn.commit()
+
+    def search(self, query, room=None, since=None, until=None, limit=20, offset=0, conn=None):
+        """Return (results best match first, has_more) for one page of a search
+
+        Each result is [room, username, message, timestamp]. since and until bound
+        the message timestamp ('YYYY-MM-DD HH:MM:SS', inclusive). conn is a connection
+        owned by the calling thread; without one the shared connection is used under
+        its lock.
+        """
+        terms = query_terms(query)
+        if not terms:
+            return [], False
+        expression = match_expression(terms)
+        conditions = ["messages_fts MATCH ?"]
+        params = []
+        if room is not None:
+            scope = room_expression(room)
+            if scope:
+                expression = f"{scope} AND {expression}"
+            conditions.append("m.room = ?")
+            params.append(room)
+        if since:
+            conditions.append("m.timestamp >= ?")
+            params.append(since)
+        if until:
+            conditions.append("m.timestamp <= ?")
+            params.append(until)
+
+        sql = (
+            "SELECT m.id, m.room, m.username, m.message, m.timestamp FROM messages_fts "
+            "JOIN messages m ON m.id = messages_fts.rowid "
+            f"WHERE {' AND '.join(conditions)} "
+            "ORDER BY messages_fts.rowid DESC LIMIT ? OFFSET ?"
+        )
+        page = []
+        window, skip = divmod(offset, self.candidates)
+        while True:
+            # One row past the window tells whether an older window follows
+            window_params = [expression] + params + [self.candidates + 1, window * self.candidates]
+            if conn is not None:
+                rows = conn.execute(sql, window_params).fetchall()
+            else:
+                with self.lock:
+                    cursor = self.conn.cursor()
+                    cursor.execute(sql, window_params)
+                    rows = cursor.fetchall()
+            older = len(rows) > self.candidates
+            ranked = rank(rows[:self.candidates], terms)
+            taken = ranked[skip:skip + limit - len(page)]
+            page.extend(list(row[1:]) for row in taken)
+            if len(page) == limit:
+                return page, skip + len(taken) < len(ranked) or older
+            if not older:
+                return page, False
+            window += 1
+            skip = 0
@@ -1,28 +1,199 @@
 import socket
 import threading
+import asyncio
+import argparse
 import json
-import hashlib
 import sqlite3
 import base64
 import os
-from datetime import datetime
+import time
+import math
+import signal
+import tempfile
+import multiprocessing
+from concurrent.futures import Future
+from datetime import datetime, timezone
 from cryptography.fernet import Fernet
 import uuid
+from ChatBot_protocol import encode_frame, FrameDecoder, WireCipher, WIRE_VERSIONS, compress_payload, decompress_payload
+from ChatBot_storage import MessageWriter, RoomHistoryCache
+from ChatBot_session import ThreadedSession, AsyncSession
+from ChatBot_presence import PresenceIndex, RoomDirectory
+from ChatBot_auth import SessionTokens, hash_password, verify_password
+from ChatBot_pool import WorkerPool
+from ChatBot_files import BlobStore, TransferError, CHUNK_SIZE
+from ChatBot_codec import CODECS, dumps, loads
+from ChatBot_cluster import MessageIds, RoomSequences, BusHub, BusClient, RemotePresence
+from ChatBot_metrics import MetricsRegistry, MetricsServer
+from ChatBot_search import MessageSearch
+from ChatBot_archive import ArchiveStore, RetentionJob, enable_incremental_vacuum
+from ChatBot_thumbnails import Thumbnailer
+from ChatBot_ratelimit import RateLimiter, DEFAULT_RATE_LIMITS, parse_rate_limit
+from ChatBot_heartbeat import HeartbeatMonitor, enable_keepalive
+from ChatBot_dispatch import HandlerRegistry
 
 class ChatServer:
-    def __init__(self, host='localhost', port=12345):
+    MAX_HISTORY_PAGE = 200
+    MAX_UPLOADS_PER_SESSION = 4
+    MAX_SEARCH_PAGE = 50
+    # Clients missing more than this many messages get a fresh snapshot instead
+    MAX_DELTA = 500
+    # Posts to one room are serialised so seq order is delivery order; rooms share
+    # this many locks, which keeps memory flat however many rooms there are
+    POST_LOCKS = 64
+    # Queued history, room and retention requests before new ones are refused as busy
+    MAX_PENDING_DB = 256
+    
+    def __init__(self, host='localhost', port=12345, db_path='chat_app.db',
+                 send_queue_size=256, overflow_policy='drop_oldest', max_drops=1000,
+                 coalesce_window=0.002, coalesce_bytes=64 * 1024,
+                 auth_workers=None, max_pending_auth=256, token_secret=None, token_ttl=3600,
+                 files_dir=None, compression=True, compression_threshold=256, codec='binary',
+                 encryption_key=None, worker_index=0, worker_count=1, bus_path=None,
+                 metrics=True, metrics_port=None, admins=(), archive_dir=None, retain_days=None,
+                 retain_messages=None, retention_interval=3600, thumbnail_workers=None,
+                 rate_limits=None, heartbeat_interval=30, idle_timeout=90, room_update_interval=0.5,
+                 search_workers=2, max_pending_searches=64):
         self.host = host
         self.port = port
-        self.clients = {}
-        self.rooms = {'general': []}
-        self.encryption_key = Fernet.generate_key()
-        self.cipher = Fernet(self.encryption_key)
+        self.db_path = db_path
+        self.session_options = {
+            'max_queue': send_queue_size,
+            'overflow': overflow_policy,
+            'max_drops': max_drops,
+            'coalesce_window': coalesce_window,
+            'coalesce_bytes': coalesce_bytes
+        }
+        self.sessions = set()
+        self.closed_session_stats = {'dropped_frames': 0, 'slow_disconnects': 0, 'sent_frames': 0,
+                                     'sent_bytes': 0, 'writes': 0, 'received_bytes': 0}
+        self.admins = set(admins)
+        self.rate_limiter = RateLimiter(rate_limits)
+        # Clients that offer heartbeats are pinged when quiet and dropped when silent
+        self.heartbeat = None
+        if heartbeat_interval:
+            self.heartbeat = HeartbeatMonitor(self.send_ping, heartbeat_interval, max(idle_timeout, heartbeat_interval))
+            self.heartbeat.start()
+        self.presence = PresenceIndex(['general'])
+        # Room list and member counts for subscribed clients, updated once per interval
+        self.room_directory = RoomDirectory(self.room_member_count, self.send_to_sessions, room_update_interval)
+        # Multi-process mode: this server is worker_index of worker_count, linked by a bus
+        self.worker_index = worker_index
+        self.worker_count = worker_count
+        self.bus_path = bus_path
+        self.bus = None
+        self.remote_presence = RemotePresence()
+        self.presence_lock = threading.Lock()
+        self.post_locks = [threading.Lock() for _ in range(self.POST_LOCKS)]
+        self.auth_pool = WorkerPool(auth_workers, max_pending_auth, name='auth')
+        # Searches run on their own threads and read connections, never on the event loop
+        self.search_pool = WorkerPool(search_workers, max_pending_searches, name='search')
+        # Requests that read or commit through the shared connection; its lock lets
+        # only one of them run at a time anyway, so one thread is enough
+        self.db_pool = WorkerPool(1, self.MAX_PENDING_DB, name='db')
+        self.session_tokens = SessionTokens(token_secret, token_ttl)
+        self.compression = compression
+        self.compression_threshold = compression_threshold
+        self.codec = codec
+        self.blob_store = BlobStore(files_dir or os.path.join(os.path.dirname(os.path.abspath(db_path)), 'chat_files'))
+        self.thumbnailer = Thumbnailer(self.blob_store, thumbnail_workers)
+        self.archive = ArchiveStore(archive_dir or os.path.join(os.path.dirname(os.path.abspath(db_path)), 'chat_archive'))
+        self.retention = {'max_age_days': retain_days, 'max_messages': retain_messages, 'interval': retention_interval}
+        self.retention_job = None
+        self.encryption_key = encryption_key or Fernet.generate_key()
+        self.wire = WireCipher(self.encryption_key)
+        self.metrics_port = metrics_port
+        self.metrics_server = None
+        self.init_metrics(metrics)
+        self.init_handlers()
         self.init_database()
+        stored_rooms = self.get_rooms()
+        for room in stored_rooms:
+            self.presence.add_room(room)
+        self.room_directory.load(stored_rooms)
+        self.room_directory.start()
+        
+    def init_metrics(self, enabled):
+        """Define the counters and histograms kept while serving"""
+        metrics = self.metrics = MetricsRegistry(enabled)
+        self.connections_total = metrics.counter('chat_connections_total', "Client connections accepted")
+        metrics.gauge('chat_connections', "Open client connections", lambda: len(self.sessions))
+        metrics.gauge('chat_rooms', "Rooms in the room directory", lambda: len(self.room_directory))
+        metrics.gauge('chat_room_subscribers', "Connections receiving room directory changes",
+                      lambda: len(self.room_directory.subscribers))
+        self.messages_received = metrics.counter(
+            'chat_messages_received_total', "Chat messages received from clients", label='room')
+        self.messages_delivered = metrics.counter(
+            'chat_messages_delivered_total', "Room events delivered to members on this process", label='room')
+        metrics.counter_function('chat_received_bytes_total', "Bytes read from clients",
+                                 lambda: self.session_total('received_bytes'))
+        metrics.counter_function('chat_sent_bytes_total', "Bytes written to clients",
+                                 lambda: self.session_total('sent_bytes'))
+        metrics.counter_function('chat_sent_frames_total', "Frames written to clients",
+                                 lambda: self.session_total('sent_frames'))
+        metrics.counter_function('chat_socket_writes_total', "Socket writes carrying those frames",
+                                 lambda: self.session_total('writes'))
+        self.broadcast_seconds = metrics.histogram(
+            'chat_broadcast_seconds', "Time to encode and queue one room event for its members")
+        self.auth_seconds = metrics.histogram(
+            'chat_auth_seconds', "Login and registration time on the auth pool", label='action')
+        metrics.counter_function('chat_auth_rejected_total', "Logins and registrations refused as busy",
+                                 lambda: self.auth_pool.rejected)
+        self.throttled_requests = metrics.counter(
+            'chat_throttled_total', "Requests refused by a rate limit", label='limit')
+        self.search_seconds = metrics.histogram('chat_search_seconds', "Full-text search query time")
+        self.db_write_seconds = metrics.histogram(
+            'chat_db_write_seconds', "Time to commit one batch of chat messages")
+        self.db_rows_written = metrics.counter('chat_db_rows_written_total', "Chat messages committed")
+        metrics.gauge('chat_db_write_queue', "Chat messages waiting to be committed",
+                      lambda: self.message_writer.pending())
+        for name, key, help in (
+            ('chat_send_queue_frames', 'queued_frames', "Frames waiting in all send queues"),
+            ('chat_send_queue_bytes', 'queued_bytes', "Bytes waiting in all send queues"),
+            ('chat_send_queue_max_depth', 'max_queue_depth', "Deepest send queue right now"),
+            ('chat_send_queue_peak_depth', 'peak_queue_depth', "Deepest send queue of any open connection")
+        ):
+            metrics.gauge(name, help, lambda key=key: self.outbound_stats()[key])
+        metrics.counter_function('chat_heartbeat_pings_total', "Pings sent to quiet connections",
+                                 lambda: self.heartbeat.pings if self.heartbeat else 0)
+        metrics.counter_function('chat_idle_disconnects_total', "Connections closed for not answering pings",
+                                 lambda: self.heartbeat.reaped if self.heartbeat else 0)
+        metrics.counter_function('chat_dropped_frames_total', "Frames dropped for slow consumers",
+                                 lambda: self.outbound_stats()['dropped_frames'])
+        metrics.counter_function('chat_slow_disconnects_total', "Slow consumers disconnected",
+                                 lambda: self.outbound_stats()['slow_disconnects'])
+        metrics.counter_function('chat_thumbnails_total', "Image thumbnails generated",
+                                 lambda: self.thumbnailer.generated)
+        metrics.counter_function('chat_thumbnail_failures_total', "Images that could not be thumbnailed",
+                                 lambda: self.thumbnailer.failed)
+        metrics.counter_function('chat_archived_messages_total', "Messages moved to archive segments",
+                                 lambda: self.retention_job.archived if self.retention_job else 0)
+        metrics.counter_function('chat_history_cache_hits_total', "Room history served from memory",
+                                 lambda: self.history_cache.stats()['hits'])
+        metrics.counter_function('chat_history_cache_misses_total', "Room history loaded from the database",
+                                 lambda: self.history_cache.stats()['misses'])
+        
+    def record_db_write(self, rows, seconds):
+        """Message writer callback for every committed batch"""
+        self.db_write_seconds.observe(seconds)
+        self.db_rows_written.inc(rows)
+        
+    def session_total(self, attribute):
+        """Sum of a per-session counter over open and closed connections"""
+        return self.closed_session_stats[attribute] + sum(getattr(s, attribute) for s in list(self.sessions))
         
     def init_database(self):
         """Initialize SQLite database for users and messages"""
-        self.conn = sqlite3.connect('chat_app.db', check_same_thread=False)
+        self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
         self.cursor = self.conn.cursor()
+        # The shared cursor is used from handler threads; auth workers get their own connections
+        self.db_lock = threading.RLock()
+        self.thread_db = threading.local()
+        
+        # New databases can hand pages freed by archiving back to the filesystem
+        self.cursor.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        # WAL lets the message writer commit while handlers keep reading
+        self.cursor.execute("PRAGMA journal_mode=WAL")
         
         # Create users table
         self.cursor.execute('''
@@ -43,10 +214,24 @@ class ChatServer:
                 username TEXT NOT NULL,
                 message TEXT NOT NULL,
                 message_type TEXT DEFAULT 'text',
-                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                seq INTEGER
             )
         ''')
         
+        # History is always read per room newest-first by id, so keep it index-only
+        self.cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_messages_room_id ON messages (room, id)"
+        )
+        self.migrate_message_sequences()
+        
+        # Full-text index over text messages, maintained by triggers on insert
+        self.search_index = MessageSearch(self.conn, self.db_lock)
+        self.search_index.create_schema()
+        
+        # Messages past their room's retention policy move to compressed archive segments
+        ArchiveStore.create_schema(self.cursor)
+        
         # Create rooms table
         self.cursor.execute('''
             CREATE TABLE IF NOT EXISTS rooms (
@@ -59,222 +244,1004 @@ class ChatServer:
         
         self.conn.commit()
         
-    def hash_password(self, password):
-        """Hash password using SHA-256"""
-        return hashlib.sha256(password.encode()).hexdigest()
+        # Chat messages are persisted by a background writer in batches, so ids
+        # are assigned here rather than by AUTOINCREMENT at insert time. Retention
+        # may have archived every row, so ids already in the archive count too
+        self.cursor.execute("SELECT COALESCE(MAX(id), 0) FROM messages")
+        latest_id = max(self.cursor.fetchone()[0], self.archive.latest_id(self.cursor))
+        self.message_ids = MessageIds(latest_id, self.worker_count, self.worker_index)
+        self.room_seqs = RoomSequences(self.load_room_seq, self.worker_count, self.worker_index)
+        if self.worker_index == 0 and self.retention_enabled():
+            enable_incremental_vacuum(self.conn)
+        self.message_writer = MessageWriter(self.db_path, on_commit=self.record_db_write)
+        self.message_writer.start()
         
-    def authenticate_user(self, username, password):
-        """Authenticate user credentials"""
-        password_hash = self.hash_password(password)
+        # One worker applies retention for the whole database
+        if self.worker_index == 0:
+            self.retention_job = RetentionJob(
+                self.db_path, self.archive, self.retention['max_age_days'],
+                self.retention['max_messages'], self.retention['interval']
+            )
+            self.retention_job.start()
+        
+        # Recent messages per room are served from memory
+        self.history_cache = RoomHistoryCache(self.load_recent_messages)
+        
+    def migrate_message_sequences(self):
+        """Number the messages of databases created before per-room sequences existed"""
+        # Workers start together; the write lock makes exactly one of them migrate
+        self.cursor.execute("BEGIN IMMEDIATE")
+        self.cursor.execute("PRAGMA table_info(messages)")
+        if 'seq' not in [column[1] for column in self.cursor.fetchall()]:
+            self.cursor.execute("ALTER TABLE messages ADD COLUMN seq INTEGER")
+            self.cursor.execute(
+                "UPDATE messages SET seq = numbered.seq FROM ("
+                "SELECT id, ROW_NUMBER() OVER (PARTITION BY room ORDER BY id) AS seq FROM messages"
+                ") AS numbered WHERE messages.id = numbered.id"
+            )
         self.cursor.execute(
-            "SELECT username FROM users WHERE username = ? AND password_hash = ?",
-            (username, password_hash)
+            "CREATE INDEX IF NOT EXISTS idx_messages_room_seq ON messages (room, seq)"
         )
-        return self.cursor.fetchone() is not None
+        self.conn.commit()
+        
+    def load_room_seq(self, room):
+        """Highest stored sequence number of a room (room sequence loader)"""
+        with self.db_lock:
+            self.cursor.execute("SELECT MAX(seq) FROM messages WHERE room = ?", (room,))
+            latest = self.cursor.fetchone()[0]
+            if latest is None:
+                latest = self.archive.latest_seq(self.cursor, room)
+        return latest or 0
+        
+    def worker_connection(self):
+        """SQLite connection owned by the calling worker thread"""
+        conn = getattr(self.thread_db, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path)
+            self.thread_db.conn = conn
+        return conn
+        
+    def hash_password(self, password):
+        """Hash password using salted scrypt"""
+        return hash_password(password)
+        
+    def authenticate_user(self, username, password):
+        """Authenticate user credentials, upgrading outdated hashes (runs on the auth pool)"""
+        conn = self.worker_connection()
+        row = conn.execute(
+            "SELECT password_hash FROM users WHERE username = ?", (username,)
+        ).fetchone()
+        if row is None:
+            return False
+        matches, needs_rehash = verify_password(password, row[0])
+        if matches and needs_rehash:
+            conn.execute(
+                "UPDATE users SET password_hash = ? WHERE username = ?",
+                (self.hash_password(password), username)
+            )
+            conn.commit()
+        return matches
         
     def register_user(self, username, password, email=""):
-        """Register a new user"""
+        """Register a new user (runs on the auth pool)"""
+        conn = self.worker_connection()
         try:
             password_hash = self.hash_password(password)
-            self.cursor.execute(
+            conn.execute(
                 "INSERT INTO users (username, password_hash, email) VALUES (?, ?, ?)",
                 (username, password_hash, email)
             )
-            self.conn.commit()
+            conn.commit()
             return True
         except sqlite3.IntegrityError:
+            # End the implicit transaction, or this connection keeps the write lock
+            conn.rollback()
             return False
             
     def save_message(self, room, username, message, message_type='text'):
-        """Save message to database"""
-        self.cursor.execute(
-            "INSERT INTO messages (room, username, message, message_type) VALUES (?, ?, ?, ?)",
-            (room, username, message, message_type)
-        )
-        self.conn.commit()
+        """Record message in the room cache and queue it for the database writer"""
+        timestamp = datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+        row = (next(self.message_ids), username, message, message_type, timestamp, self.room_seqs.next(room))
+        self.history_cache.append(room, row)
+        self.message_writer.submit(row[0], room, username, message, message_type, timestamp, row[5])
+        self.publish({'event': 'stored', 'room': room, 'row': row})
+        return row
+        
+    def load_recent_messages(self, room, limit):
+        """Load the newest messages of a room oldest-first, with ids (history cache loader)"""
+        with self.db_lock:
+            self.cursor.execute(
+                "SELECT id, username, message, message_type, timestamp, seq FROM messages "
+                "WHERE room = ? ORDER BY id DESC LIMIT ?",
+                (room, limit)
+            )
+            return list(reversed(self.cursor.fetchall()))
         
     def get_message_history(self, room, limit=50):
         """Get message history for a room"""
-        self.cursor.execute(
-            "SELECT username, message, message_type, timestamp FROM messages WHERE room = ? ORDER BY timestamp DESC LIMIT ?",
-            (room, limit)
-        )
-        messages = self.cursor.fetchall()
-        return list(reversed(messages))
+        messages, _, _ = self.get_history_page(room, limit=limit)
+        return messages
         
-    def create_room(self, room_name, created_by):
-        """Create a new chat room"""
-        try:
+    def get_history_page(self, room, before_id=None, limit=50):
+        """Get one page of room history older than before_id (keyset pagination)
+        
+        Returns (messages oldest-first, cursor for the next older page, has_more).
+        The newest page is served from the in-memory history cache.
+        """
+        cached = None
+        if before_id is None and limit <= self.history_cache.capacity:
+            cached = self.history_cache.recent(room)
+        if cached:
+            rows = cached[-limit:]
+            has_more = len(cached) > limit or self.has_older(room, rows[0][0])
+            return [list(row[1:5]) for row in rows], rows[0][0], has_more
+            
+        with self.db_lock:
+            if before_id is None:
+                self.cursor.execute(
+                    "SELECT id, username, message, message_type, timestamp FROM messages "
+                    "WHERE room = ? ORDER BY id DESC LIMIT ?",
+                    (room, limit + 1)
+                )
+            else:
+                self.cursor.execute(
+                    "SELECT id, username, message, message_type, timestamp FROM messages "
+                    "WHERE room = ? AND id < ? ORDER BY id DESC LIMIT ?",
+                    (room, before_id, limit + 1)
+                )
+            rows = self.cursor.fetchall()
+            if len(rows) <= limit:
+                # Past the retained window: continue from the archive
+                older_than = rows[-1][0] if rows else before_id
+                blocks = self.archive.blocks_before(self.cursor, room, older_than)
+            else:
+                blocks = None
+        if blocks:
+            rows += self.archive.history(blocks, older_than, limit + 1 - len(rows))
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        next_before_id = rows[-1][0] if rows else before_id
+        messages = [list(row[1:5]) for row in reversed(rows)]
+        return messages, next_before_id, has_more
+        
+    def room_delta(self, room, since_seq, latest):
+        """Messages of room with since_seq < seq <= latest, oldest first
+        
+        Returns None when they cannot all be provided: too many, archived already,
+        not all written yet, or since_seq is from a sequence this server never issued.
+        """
+        if since_seq > latest:
+            return None
+        if since_seq == latest:
+            return []
+        cached = self.history_cache.recent(room)
+        if cached and cached[0][5] is not None and cached[0][5] <= since_seq:
+            return [list(row[1:5]) for row in cached if since_seq < row[5] <= latest]
+            
+        with self.db_lock:
+            archived = self.archive.latest_seq(self.cursor, room)
+            if archived is not None and archived > since_seq:
+                return None
+            self.cursor.execute(
+                "SELECT id, username, message, message_type, timestamp, seq FROM messages "
+                "WHERE room = ? AND seq > ? AND seq <= ? ORDER BY seq LIMIT ?",
+                (room, since_seq, latest, self.MAX_DELTA + 1)
+            )
+            rows = self.cursor.fetchall()
+        if len(rows) > self.MAX_DELTA:
+            return None
+        # Messages still queued for the writer are only in the cache
+        stored = rows[-1][5] if rows else since_seq
+        rows += [row for row in cached if stored < row[5] <= latest]
+        # A shortfall means rows are still queued, here beyond what the cache holds or
+        # in another worker's writer. Several workers leave gaps in a room's sequence
+        # anyway, so those cannot be told apart and any shortfall counts. Waiting for
+        # the writers would stall the request path (the event loop, in asyncio mode),
+        # so send a snapshot instead
+        if len(rows) == latest - since_seq:
+            return [list(row[1:5]) for row in rows]
+        return None
+        
+    def has_older(self, room, before_id):
+        """Whether the database or the archive holds messages of room older than before_id"""
+        with self.db_lock:
             self.cursor.execute(
-                "INSERT INTO rooms (name, created_by) VALUES (?, ?)",
-                (room_name, created_by)
+                "SELECT EXISTS (SELECT 1 FROM messages WHERE room = ? AND id < ?)", (room, before_id)
             )
+            return bool(self.cursor.fetchone()[0]) or self.archive.has_before(self.cursor, room, before_id)
+            
+    def retention_enabled(self):
+        """Whether a default or any per-room retention policy is configured"""
+        if self.retention['max_age_days'] is not None or self.retention['max_messages'] is not None:
+            return True
+        with self.db_lock:
+            self.cursor.execute("SELECT 1 FROM room_retention LIMIT 1")
+            return self.cursor.fetchone() is not None
+            
+    def set_retention(self, room, max_age_days=None, max_messages=None):
+        """Set a room's retention policy; None for both removes it (the defaults apply again)"""
+        with self.db_lock:
+            if max_age_days is None and max_messages is None:
+                self.cursor.execute("DELETE FROM room_retention WHERE room = ?", (room,))
+            else:
+                self.cursor.execute(
+                    "INSERT OR REPLACE INTO room_retention (room, max_age_days, max_messages) VALUES (?, ?, ?)",
+                    (room, max_age_days, max_messages)
+                )
             self.conn.commit()
-            self.rooms[room_name] = []
+            
+    def search_messages(self, session, data):
+        """Hand a search request to the search pool, keeping the query off the handlers"""
+        query = str(data.get('query', ''))
+        limit = max(1, min(int(data.get('limit', 20)), self.MAX_SEARCH_PAGE))
+        offset = max(0, int(data.get('offset', 0)))
+        response = {'type': 'search_results', 'query': query, 'room': data.get('room'), 'offset': offset}
+        future = self.search_pool.submit(self.run_search, session, response, data.get('since'), data.get('until'), limit)
+        if future is None:
+            response.update(results=[], has_more=False, error='Server busy, please try again')
+            return response
+        return future
+        
+    def run_search(self, session, response, since, until, limit):
+        """Answer a search request with one page of ranked results (on the search pool)"""
+        started = time.perf_counter()
+        try:
+            results, has_more = self.search_index.search(
+                response['query'], response['room'], since, until, limit, response['offset'],
+                self.worker_connection()
+            )
+        except sqlite3.Error as e:
+            print(f"Error searching messages: {e}")
+            results, has_more = [], False
+            response['error'] = 'Search failed'
+        self.search_seconds.observe(time.perf_counter() - started)
+        response.update(results=results, has_more=has_more)
+        self.send_response(session, response)
+        
+    def create_room(self, room_name, created_by):
+        """Create a new chat room"""
+        try:
+            with self.db_lock:
+                self.cursor.execute(
+                    "INSERT INTO rooms (name, created_by) VALUES (?, ?)",
+                    (room_name, created_by)
+                )
+                self.conn.commit()
+            self.presence.add_room(room_name)
+            self.room_directory.add_room(room_name)
+            self.publish({'event': 'room_created', 'room': room_name})
             return True
         except sqlite3.IntegrityError:
+            with self.db_lock:
+                self.conn.rollback()
             return False
             
     def get_rooms(self):
-        """Get list of available rooms"""
-        self.cursor.execute("SELECT name FROM rooms")
-        rooms = [row[0] for row in self.cursor.fetchall()]
+        """Get the stored rooms; clients are served from the room directory instead"""
+        with self.db_lock:
+            self.cursor.execute("SELECT name FROM rooms")
+            rooms = [row[0] for row in self.cursor.fetchall()]
         if 'general' not in rooms:
             rooms.insert(0, 'general')
         return rooms
         
-    def encrypt_message(self, message):
-        """Encrypt message"""
-        return base64.b64encode(self.cipher.encrypt(message.encode())).decode()
+    def encode_message(self, message, wire_format=('json', 1, None)):
+        """Serialize, optionally compress, encrypt and frame one protocol message"""
+        codec, version, compression = wire_format
+        payload = dumps(message, codec)
+        if compression:
+            payload = compress_payload(payload, self.compression_threshold)
+        return encode_frame(self.wire.encrypt(payload, version))
         
-    def decrypt_message(self, encrypted_message):
-        """Decrypt message"""
+    def decode_message(self, frame):
+        """Decrypt and parse one request frame; version, compression and codec are recognised per frame"""
+        return loads(decompress_payload(self.wire.decrypt(frame)))
+        
+    def broadcast_to_room(self, room, message, sender_session=None):
+        """Broadcast message to all clients in a room, on this worker and all others"""
+        self.deliver_to_room(room, message, sender_session)
+        self.publish({'event': 'broadcast', 'room': room, 'message': message})
+        
+    def deliver_to_room(self, room, message, sender_session=None):
+        """Send message to the members of a room connected to this process"""
+        members = self.presence.members(room)
+        if members:
+            started = time.perf_counter()
+            delivered = 0
+            # Encode once per wire format in use, not once per member
+            frames = {}
+            for session in members:
+                if session is not sender_session:
+                    wire_format = session.wire_format()
+                    frame = frames.get(wire_format)
+                    if frame is None:
+                        frame = frames[wire_format] = self.encode_message(message, wire_format)
+                    try:
+                        session.send(frame)
+                        delivered += 1
+                    except:
+                        self.leave_room(session, room)
+            self.messages_delivered.inc(delivered, room)
+            self.broadcast_seconds.observe(time.perf_counter() - started)
+                            
+    def publish(self, event):
+        """Pass an event to the other workers when running as one of several"""
+        if self.bus is not None:
+            self.bus.publish(event)
+            
+    def join_room(self, session, room):
+        """Move a session into room and tell the other workers who came and went"""
+        with self.presence_lock:
+            joined = [] if room in self.presence.rooms_of(session) else [room]
+            left = self.presence.switch(session, room)
+            if joined or left:
+                self.publish({'event': 'presence', 'username': session.username, 'joined': joined, 'left': left})
+                self.room_directory.mark(joined + left)
+                
+    def leave_room(self, session, room):
+        with self.presence_lock:
+            if self.presence.leave(session, room):
+                self.room_directory.mark([room])
+                if session.username:
+                    self.publish({'event': 'presence', 'username': session.username, 'joined': [], 'left': [room]})
+                
+    def logout(self, session):
+        """Drop a session from presence and return the rooms it was in"""
+        with self.presence_lock:
+            rooms = self.presence.logout(session)
+            self.room_directory.mark(rooms)
+            if rooms and session.username:
+                self.publish({'event': 'presence', 'username': session.username, 'joined': [], 'left': list(rooms)})
+            return rooms
+            
+    def room_members(self, room):
+        """Usernames in a room across all workers"""
+        return self.presence.member_names(room) + self.remote_presence.names(room)
+        
+    def room_member_count(self, room):
+        """Number of members of a room across all workers"""
+        return self.presence.count(room) + self.remote_presence.count(room)
+        
+    def handle_bus_event(self, event):
+        """Apply an event published by another worker (runs on the bus reader thread)"""
+        kind = event['event']
+        if kind == 'broadcast':
+            self.deliver_to_room(event['room'], event['message'])
+        elif kind == 'stored':
+            row = tuple(event['row'])
+            self.message_ids.observe(row[0])
+            self.room_seqs.observe(event['room'], row[5])
+            self.history_cache.merge(event['room'], row)
+        elif kind == 'presence':
+            self.remote_presence.update(event['worker'], event['username'], event['joined'], event['left'])
+            self.room_directory.mark(event['joined'] + event['left'])
+        elif kind == 'hello':
+            # A worker (re)started: give it our members, as one consistent snapshot
+            with self.presence_lock:
+                rooms = {room: self.presence.member_names(room) for room in self.presence.room_names()}
+                self.publish({'event': 'presence_sync', 'rooms': rooms})
+        elif kind == 'presence_sync':
+            self.remote_presence.replace(event['worker'], event['rooms'])
+            self.room_directory.mark_all(event['rooms'])
+        elif kind == 'worker_gone':
+            self.remote_presence.forget(event['worker'])
+            self.room_directory.mark_all()
+        elif kind == 'room_created':
+            self.presence.add_room(event['room'])
+            self.room_directory.add_room(event['room'])
+            
+    def start_bus(self):
+        """Connect to the other workers, when running in multi-process mode"""
+        if self.bus_path:
+            self.bus = BusClient(self.bus_path, self.worker_index, self.handle_bus_event)
+            self.bus.start()
+            
+    def send_response(self, session, response):
+        """Encrypt and send a response to a single client"""
+        session.send(self.encode_message(response, session.wire_format()))
+        
+    def send_to_sessions(self, sessions, message):
+        """Send one message to many clients, encoding it once per wire format in use"""
+        frames = {}
+        for session in sessions:
+            wire_format = session.wire_format()
+            frame = frames.get(wire_format)
+            if frame is None:
+                frame = frames[wire_format] = self.encode_message(message, wire_format)
+            try:
+                session.send(frame)
+            except ConnectionError:
+                pass
+        
+    def negotiate(self, session, data):
+        """Answer a client hello with the connection options both sides support"""
+        offered = data.get('compression', [])
+        compression = 'zlib' if self.compression and 'zlib' in offered else None
+        version = max((v for v in data.get('versions', [1]) if v in WIRE_VERSIONS), default=1)
+        codec = self.codec if self.codec in data.get('codecs', []) else 'json'
+        welcome = {
+            'type': 'welcome',
+            'version': version,
+            'codec': codec,
+            'compression': compression,
+            'compression_threshold': self.compression_threshold
+        }
+        if data.get('heartbeat') and self.heartbeat is not None:
+            welcome['heartbeat_interval'] = self.heartbeat.interval
+        self.send_response(session, welcome)
+        # Enabled only after the welcome is queued, which therefore always goes out in the
+        # format the client started with
+        session.wire_version = version
+        session.codec = codec
+        session.compression = compression
+        if 'heartbeat_interval' in welcome and not session.heartbeat:
+            session.heartbeat = True
+            self.heartbeat.watch(session)
+        
+    def send_ping(self, session):
+        """Heartbeat monitor callback for a connection that has gone quiet"""
+        self.send_response(session, {'type': 'ping'})
+        
+    def handle_auth(self, session, data):
+        """Run a login or registration request (on the auth pool)"""
+        started = time.perf_counter()
+        if data['action'] == 'login':
+            if self.authenticate_user(data['username'], data['password']):
+                response = self.start_user_session(session, data['username'])
+            else:
+                response = {'type': 'auth_result', 'success': False, 'error': 'Invalid credentials'}
+            self.send_response(session, response)
+                
+        elif data['action'] == 'register':
+            if self.register_user(data['username'], data['password'], data.get('email', '')):
+                response = {'type': 'register_result', 'success': True}
+            else:
+                response = {'type': 'register_result', 'success': False, 'error': 'Username already exists'}
+            self.send_response(session, response)
+        self.auth_seconds.observe(time.perf_counter() - started, data['action'])
+            
+    def start_user_session(self, session, username, resumed=False):
+        """Mark session as logged in and build an auth_result carrying a fresh session token"""
+        session.username = username
+        self.presence.login(session, username)
+        token, expires = self.session_tokens.issue(username)
+        response = {
+            'type': 'auth_result',
+            'success': True,
+            'username': username,
+            'session_token': token,
+            'token_expires': expires
+        }
+        if resumed:
+            response['resumed'] = True
+        return response
+        
+    def resume_session(self, session, data):
+        """Log a reconnecting client in from its session token, without touching the database"""
+        username = self.session_tokens.validate(data.get('token', ''))
+        if username:
+            response = self.start_user_session(session, username, resumed=True)
+        else:
+            response = {'type': 'auth_result', 'success': False, 'resumed': True, 'error': 'Session expired, please log in again'}
+        return response
+        
+    def init_handlers(self):
+        """Map each request type to the method handling it"""
+        handlers = self.handlers = HandlerRegistry(self.send_response, self.metrics, self.admins)
+        handlers.register('hello', self.negotiate, login=False)
+        handlers.register('ping', self.handle_ping, login=False)
+        handlers.register('pong', self.handle_pong, login=False)
+        handlers.register('auth', self.handle_auth_request, login=False)
+        handlers.register('join_room', self.handle_join_room)
+        handlers.register('message', self.handle_message)
+        handlers.register('get_history', self.handle_get_history)
+        handlers.register('search', self.search_messages)
+        handlers.register('upload_begin', self.begin_upload)
+        handlers.register('upload_chunk', self.upload_chunk)
+        handlers.register('upload_end', self.end_upload)
+        handlers.register('download', self.send_file_chunk)
+        handlers.register('get_rooms', self.handle_get_rooms)
+        handlers.register('create_room', self.handle_create_room)
+        handlers.register('get_metrics', self.handle_get_metrics, admin=True)
+        handlers.register('set_retention', self.handle_set_retention, admin=True)
+        handlers.register('profile', self.handle_profile, admin=True, sampled=False)
+        
+    def process_data(self, session, frame):
+        """Decrypt one request frame and dispatch it, independent of the I/O mode
+        
+        Returns a Future when the request was handed to a worker pool; the caller
+        waits for it before reading the next request so per-client ordering holds.
+        """
         try:
-            return self.cipher.decrypt(base64.b64decode(encrypted_message.encode())).decode()
+            data = self.decode_message(frame)
         except:
-            return encrypted_message
+            return None
+        return self.handlers.dispatch(session, data)
+        
+    def handle_ping(self, session, data):
+        return {'type': 'pong'}
+        
+    def handle_pong(self, session, data):
+        # Receiving it already refreshed last_seen
+        return None
+        
+    def handle_auth_request(self, session, data):
+        """Resume a session at once; logins and registrations go to the auth pool"""
+        if data['action'] == 'resume':
+            return self.resume_session(session, data)
+        if data['action'] == 'register':
+            wait = self.rate_limited('register', session.address[0])
+            if wait:
+                return {
+                    'type': 'register_result',
+                    'success': False,
+                    'error': f"Too many registrations, try again in {math.ceil(wait)}s",
+                    'retry_after': round(wait, 2)
+                }
+        future = self.auth_pool.submit(self.handle_auth, session, data)
+        if future is None:
+            result_type = 'auth_result' if data['action'] == 'login' else 'register_result'
+            return {'type': result_type, 'success': False, 'error': 'Server busy, please try again'}
+        return future
+        
+    def handle_join_room(self, session, data):
+        """Enter a room, answering with its members and history"""
+        room = data['room']
+        self.join_room(session, room)
+        session.current_room = room
+        
+        # Notify others
+        join_msg = {
+            'type': 'user_joined',
+            'username': session.username,
+            'room': room,
+            'timestamp': datetime.now().isoformat()
+        }
+        self.broadcast_to_room(room, join_msg, session)
+        
+        # Send room info and history; a rejoining client only gets what it missed
+        latest = self.room_seqs.latest(room)
+        delta = None
+        if data.get('since_seq') is not None:
+            delta = self.room_delta(room, int(data['since_seq']), latest)
+        if delta is not None:
+            return {
+                'type': 'room_joined',
+                'room': room,
+                'history': delta,
+                'delta': True,
+                'seq': latest,
+                'users': self.room_members(room)
+            }
+        history, before_id, has_more = self.get_history_page(room)
+        response = {
+            'type': 'room_joined',
+            'room': room,
+            'history': history,
+            'before_id': before_id,
+            'has_more': has_more,
+            'seq': latest,
+            'users': self.room_members(room)
+        }
+        if data.get('since_seq') is not None:
+            response['too_far_behind'] = True
+        return response
+        
+    def handle_message(self, session, data):
+        """Post a chat message to the session's current room"""
+        username = session.username
+        current_room = session.current_room
+        if not current_room:
+            return None
+        message = data['message']
+        message_type = data.get('message_type', 'text')
+        wait = self.rate_limited_all(
+            ('messages', username, 1),
+            ('message_bytes', username, len(message)),
+            ('room_messages', current_room, 1)
+        )
+        if wait:
+            self.send_throttled(session, 'message', wait)
+            return None
+        if message_type in ('image', 'file'):
+            # Attachments travel as blob references; the file itself is fetched on demand
+            message = self.attachment_reference(message_type, message)
+            if message is None:
+                return {'type': 'error', 'error': 'Attachment not found, upload it first'}
+        if message_type == 'image':
+            return self.post_image(session, current_room, message)
+        self.post_message(session, current_room, message, message_type)
+        
+    def run_on_db_pool(self, session, busy_response, function, *args):
+        """Hand a request that uses the database to the db pool, which sends function's response
+        
+        A query, an archive read or a commit waiting out the busy timeout must not hold
+        up the request path (the event loop, in asyncio mode). busy_response is sent
+        instead when the pool is saturated.
+        """
+        future = self.db_pool.submit(self.respond_with, session, function, *args)
+        if future is None:
+            busy_response['error'] = 'Server busy, please try again'
+            return busy_response
+        return future
+        
+    def respond_with(self, session, function, *args):
+        self.send_response(session, function(*args))
+        
+    def handle_get_history(self, session, data):
+        """One page of a room's history, older than before_id (on the db pool)"""
+        room = data.get('room', session.current_room)
+        limit = max(1, min(int(data.get('limit', 50)), self.MAX_HISTORY_PAGE))
+        busy = {'type': 'history_page', 'room': room, 'messages': [], 'has_more': False}
+        return self.run_on_db_pool(session, busy, self.history_response, room, data.get('before_id'), limit)
+        
+    def history_response(self, room, before_id, limit):
+        messages, before_id, has_more = self.get_history_page(room, before_id, limit)
+        return {
+            'type': 'history_page',
+            'room': room,
+            'messages': messages,
+            'before_id': before_id,
+            'has_more': has_more
+        }
+        
+    def handle_get_rooms(self, session, data):
+        """The room list with member counts; subscribers then get only its changes"""
+        if data.get('subscribe'):
+            self.room_directory.subscribe(session, self.send_response)
+            return None
+        return self.room_directory.rooms_list()
+        
+    def handle_create_room(self, session, data):
+        room_name = data['room_name']
+        wait = self.rate_limited('create_room', session.username)
+        if wait:
+            return {'type': 'room_created', 'success': False, 'retry_after': round(wait, 2),
+                    'error': f"Too many new rooms, try again in {math.ceil(wait)}s"}
+        busy = {'type': 'room_created', 'success': False}
+        return self.run_on_db_pool(session, busy, self.create_room_response, room_name, session.username)
+        
+    def create_room_response(self, room_name, created_by):
+        if self.create_room(room_name, created_by):
+            return {'type': 'room_created', 'success': True, 'room': room_name}
+        return {'type': 'room_created', 'success': False, 'error': 'Room already exists'}
+        
+    def handle_get_metrics(self, session, data):
+        return {'type': 'metrics', 'metrics': self.metrics.snapshot()}
+        
+    def handle_set_retention(self, session, data):
+        max_age_days = data.get('max_age_days')
+        max_messages = data.get('max_messages')
+        busy = {'type': 'retention', 'room': data['room']}
+        return self.run_on_db_pool(
+            session, busy, self.retention_response, data['room'],
+            None if max_age_days is None else float(max_age_days),
+            None if max_messages is None else int(max_messages)
+        )
+        
+    def retention_response(self, room, max_age_days, max_messages):
+        self.set_retention(room, max_age_days, max_messages)
+        return {'type': 'retention', 'room': room, 'max_age_days': max_age_days,
+                'max_messages': max_messages}
+        
+    def handle_profile(self, session, data):
+        """Switch handler profiling on or off, answering with what has been found so far
+        
+        Covers only this process; with several workers each is profiled on its own.
+        """
+        profiler = self.handlers.profiler
+        action = data.get('action', 'report')
+        if action == 'start':
+            profiler.start(data.get('sample_every', 100), bool(data.get('memory')))
+        elif action == 'stop':
+            profiler.stop()
+        elif action != 'report':
+            return {'type': 'error', 'error': f"Unknown profile action {action!r}"}
+        report = profiler.report(max(1, min(int(data.get('limit', 20)), 100)))
+        report.update(type='profile_report', handlers=self.handlers.stats())
+        return report
+        
+    def rate_limited(self, name, key, amount=1):
+        """Spend from a rate limit bucket; returns 0 when allowed, else seconds to wait"""
+        wait = self.rate_limiter.check(name, key, amount)
+        if wait:
+            self.throttled_requests.inc(1, name)
+        return wait
+        
+    def rate_limited_all(self, *requests):
+        """Spend from several (name, key, amount) buckets only if all allow it; returns the longest wait"""
+        wait, name = self.rate_limiter.check_all(requests)
+        if wait:
+            self.throttled_requests.inc(1, name)
+        return wait
+        
+    def send_throttled(self, session, request, wait):
+        """Tell a client its request was dropped, once per wait so a flood is not echoed back"""
+        now = time.monotonic()
+        if now < session.throttled_until:
+            return
+        session.throttled_until = now + wait
+        self.send_response(session, {
+            'type': 'throttled',
+            'request': request,
+            'retry_after': round(wait, 2),
+            'error': f"Slow down, try again in {math.ceil(wait)}s"
+        })
+        
+    def open_session(self, session):
+        """Register a new connection and start its writer"""
+        self.connections_total.inc()
+        self.sessions.add(session)
+        session.start()
+        
+    def outbound_stats(self):
+        """Send queue depth and slow consumer counters across all connections"""
+        sessions = list(self.sessions)
+        depths = [s.depth() for s in sessions]
+        return {
+            'connections': len(sessions),
+            'queued_frames': sum(depths),
+            'max_queue_depth': max(depths, default=0),
+            'peak_queue_depth': max((s.peak_depth for s in sessions), default=0),
+            'queued_bytes': sum(s.queued_bytes for s in sessions),
+            'dropped_frames': self.closed_session_stats['dropped_frames'] + sum(s.dropped for s in sessions),
+            'slow_disconnects': self.closed_session_stats['slow_disconnects'] + sum(1 for s in sessions if s.evicted)
+        }
+        
+    def post_message(self, session, room, message, message_type):
+        """Store a chat message and broadcast it to the other members of room"""
+        message_data = {
+            'type': 'message',
+            'username': session.username,
+            'message': message,
+            'message_type': message_type,
+            'room': room,
+            'timestamp': datetime.now().isoformat()
+        }
+        
+        self.messages_received.inc(1, room)
+        # Id, seq, cache and broadcast together, or a client could see seq N+1 before N
+        # and resume past N after a reconnect
+        with self.post_locks[hash(room) % self.POST_LOCKS]:
+            # Save to database
+            row = self.save_message(room, session.username, message, message_type)
+            message_data['seq'] = row[5]
             
-    def broadcast_to_room(self, room, message, sender_client=None):
-        """Broadcast message to all clients in a room"""
-        if room in self.rooms:
-            encrypted_msg = self.encrypt_message(json.dumps(message))
-            for client in self.rooms[room]:
-                if client != sender_client:
-                    try:
-                        client.send(encrypted_msg.encode())
-                    except:
-                        self.rooms[room].remove(client)
-                        
+            # Broadcast to room
+            self.broadcast_to_room(room, message_data, session)
+        
+    def post_image(self, session, room, reference):
+        """Post an image reference with its thumbnail, which members load instead of the original
+        
+        Thumbnails are usually made when the upload completes. If this one is still being
+        made, a Future is returned so only this client's next requests wait for it.
+        """
+        info = json.loads(reference)
+        thumbnail = self.thumbnailer.submit(info['sha256'])
+        
+        def post(future):
+            if future.exception() is None and future.result() is not None:
+                info['thumbnail'] = future.result()
+            self.post_message(session, room, json.dumps(info), 'image')
+            
+        if thumbnail.done():
+            post(thumbnail)
+            return None
+        posted = Future()
+        
+        def post_then_release(future):
+            try:
+                post(future)
+            finally:
+                posted.set_result(None)
+                
+        loop = getattr(session, 'loop', None)
+        if loop is not None:
+            # Sends from the pool reach the loop after whatever it sends meanwhile, so a
+            # later message could overtake this one; post from the loop instead
+            thumbnail.add_done_callback(lambda future: loop.call_soon_threadsafe(post_then_release, future))
+        else:
+            thumbnail.add_done_callback(post_then_release)
+        return posted
+        
+    def attachment_reference(self, message_type, message):
+        """Normalise an image/file message to a blob reference, or None if the blob is unknown
+        
+        Inline base64 payloads from older clients are moved into the blob store here,
+        so the messages table only ever holds references.
+        """
+        try:
+            try:
+                info = json.loads(message)
+            except ValueError:
+                info = None
+            if not isinstance(info, dict):
+                # Older clients send images as the bare base64 image
+                if message_type != 'image':
+                    return None
+                info = {'filename': 'image', 'mime_type': 'image/*'}
+                sha256 = self.blob_store.put_bytes(base64.b64decode(message))
+            elif 'data' in info:
+                sha256 = self.blob_store.put_bytes(base64.b64decode(info['data']))
+            else:
+                sha256 = info.get('sha256')
+                if not self.blob_store.exists(sha256):
+                    return None
+        except (ValueError, TypeError, OSError):
+            return None
+        return json.dumps({
+            'sha256': sha256,
+            'filename': os.path.basename(str(info.get('filename') or 'file')),
+            'size': self.blob_store.size(sha256),
+            'mime_type': info.get('mime_type')
+        })
+        
+    def begin_upload(self, session, data):
+        """Start or resume a chunked upload; answers with the offset to continue from"""
+        sha256 = data.get('sha256')
+        try:
+            upload = session.uploads.get(sha256)
+            if upload is None:
+                if len(session.uploads) >= self.MAX_UPLOADS_PER_SESSION:
+                    raise TransferError("Too many uploads in progress")
+                upload = self.blob_store.begin_upload(sha256, data.get('size'), session.username)
+            if upload is None:
+                response = {'type': 'upload_complete', 'sha256': sha256, 'size': self.blob_store.size(sha256)}
+            else:
+                session.uploads[sha256] = upload
+                response = {'type': 'upload_ready', 'sha256': sha256, 'offset': upload.offset}
+        except (TransferError, OSError) as e:
+            response = {'type': 'upload_failed', 'sha256': sha256, 'error': str(e)}
+        return response
+        
+    def upload_chunk(self, session, data):
+        """Append one chunk to an upload; only failures are answered"""
+        sha256 = data.get('sha256')
+        upload = session.uploads.get(sha256)
+        try:
+            if upload is None:
+                raise TransferError("No upload in progress for this file")
+            upload.write(data['offset'], base64.b64decode(data['data']))
+        except (TransferError, OSError, ValueError, KeyError) as e:
+            # The .part file is kept, so upload_begin resumes from the last good chunk
+            if upload is not None:
+                upload.close()
+                del session.uploads[sha256]
+            return {'type': 'upload_failed', 'sha256': sha256, 'error': str(e)}
+            
+    def end_upload(self, session, data):
+        """Verify and store a fully transferred upload"""
+        sha256 = data.get('sha256')
+        upload = session.uploads.pop(sha256, None)
+        try:
+            if upload is None:
+                raise TransferError("No upload in progress for this file")
+            self.blob_store.finish_upload(upload)
+            response = {'type': 'upload_complete', 'sha256': sha256, 'size': upload.size}
+            # Start the thumbnail now so it is ready by the time the image is posted
+            self.thumbnailer.submit(sha256)
+        except (TransferError, OSError) as e:
+            response = {'type': 'upload_failed', 'sha256': sha256, 'error': str(e)}
+        return response
+        
+    def send_file_chunk(self, session, data):
+        """Send one range of a stored file"""
+        sha256 = data.get('sha256')
+        try:
+            offset = int(data.get('offset', 0))
+            if offset < 0:
+                raise TransferError("Invalid offset")
+            length = max(1, min(int(data.get('length', CHUNK_SIZE)), CHUNK_SIZE))
+            chunk = self.blob_store.read(sha256, offset, length)
+            response = {
+                'type': 'file_chunk',
+                'sha256': sha256,
+                'offset': offset,
+                'size': self.blob_store.size(sha256),
+                'data': base64.b64encode(chunk).decode()
+            }
+        except (TransferError, OSError, ValueError) as e:
+            response = {'type': 'download_failed', 'sha256': sha256, 'error': str(e)}
+        return response
+        
+    def close_session(self, session):
+        """Remove a disconnected client from the server state"""
+        session.close()
+        self.room_directory.unsubscribe(session)
+        for upload in session.uploads.values():
+            upload.close()
+        session.uploads.clear()
+        if session in self.sessions:
+            self.sessions.discard(session)
+            self.closed_session_stats['dropped_frames'] += session.dropped
+            self.closed_session_stats['sent_frames'] += session.sent_frames
+            self.closed_session_stats['sent_bytes'] += session.sent_bytes
+            self.closed_session_stats['writes'] += session.writes
+            self.closed_session_stats['received_bytes'] += session.received_bytes
+            if session.evicted:
+                self.closed_session_stats['slow_disconnects'] += 1
+        for room in self.logout(session):
+            # Notify others about user leaving
+            if session.username:
+                leave_msg = {
+                    'type': 'user_left',
+                    'username': session.username,
+                    'room': room,
+                    'timestamp': datetime.now().isoformat()
+                }
+                self.broadcast_to_room(room, leave_msg)
+                
     def handle_client(self, client_socket, address):
-        """Handle individual client connection"""
-        username = None
-        current_room = None
+        """Handle individual client connection (threaded mode)"""
+        enable_keepalive(client_socket)
+        session = ThreadedSession(client_socket, address, **self.session_options)
+        self.open_session(session)
+        decoder = FrameDecoder()
         
         try:
             while True:
-                encrypted_data = client_socket.recv(1024).decode()
-                if not encrypted_data:
+                chunk = client_socket.recv(65536)
+                if not chunk:
                     break
-                    
-                try:
-                    data = json.loads(self.decrypt_message(encrypted_data))
-                except:
-                    continue
-                    
-                if data['type'] == 'auth':
-                    if data['action'] == 'login':
-                        if self.authenticate_user(data['username'], data['password']):
-                            username = data['username']
-                            self.clients[client_socket] = username
-                            response = {'type': 'auth_result', 'success': True, 'username': username}
-                            encrypted_response = self.encrypt_message(json.dumps(response))
-                            client_socket.send(encrypted_response.encode())
-                        else:
-                            response = {'type': 'auth_result', 'success': False, 'error': 'Invalid credentials'}
-                            encrypted_response = self.encrypt_message(json.dumps(response))
-                            client_socket.send(encrypted_response.encode())
-                            
-                    elif data['action'] == 'register':
-                        if self.register_user(data['username'], data['password'], data.get('email', '')):
-                            response = {'type': 'register_result', 'success': True}
-                            encrypted_response = self.encrypt_message(json.dumps(response))
-                            client_socket.send(encrypted_response.encode())
-                        else:
-                            response = {'type': 'register_result', 'success': False, 'error': 'Username already exists'}
-                            encrypted_response = self.encrypt_message(json.dumps(response))
-                            client_socket.send(encrypted_response.encode())
-                            
-                elif data['type'] == 'join_room' and username:
-                    room = data['room']
-                    if current_room and current_room in self.rooms:
-                        self.rooms[current_room].remove(client_socket)
-                    
-                    if room not in self.rooms:
-                        self.rooms[room] = []
-                    
-                    self.rooms[room].append(client_socket)
-                    current_room = room
-                    
-                    # Send room info and history
-                    history = self.get_message_history(room)
-                    response = {
-                        'type': 'room_joined',
-                        'room': room,
-                        'history': history,
-                        'users': [self.clients.get(c, 'Unknown') for c in self.rooms[room]]
-                    }
-                    encrypted_response = self.encrypt_message(json.dumps(response))
-                    client_socket.send(encrypted_response.encode())
-                    
-                    # Notify others
-                    join_msg = {
-                        'type': 'user_joined',
-                        'username': username,
-                        'room': room,
-                        'timestamp': datetime.now().isoformat()
-                    }
-                    self.broadcast_to_room(room, join_msg, client_socket)
-                    
-                elif data['type'] == 'message' and username and current_room:
-                    message_data = {
-                        'type': 'message',
-                        'username': username,
-                        'message': data['message'],
-                        'message_type': data.get('message_type', 'text'),
-                        'room': current_room,
-                        'timestamp': datetime.now().isoformat()
-                    }
-                    
-                    # Save to database
-                    self.save_message(current_room, username, data['message'], data.get('message_type', 'text'))
-                    
-                    # Broadcast to room
-                    self.broadcast_to_room(current_room, message_data, client_socket)
-                    
-                elif data['type'] == 'get_rooms' and username:
-                    rooms = self.get_rooms()
-                    response = {'type': 'rooms_list', 'rooms': rooms}
-                    encrypted_response = self.encrypt_message(json.dumps(response))
-                    client_socket.send(encrypted_response.encode())
-                    
-                elif data['type'] == 'create_room' and username:
-                    room_name = data['room_name']
-                    if self.create_room(room_name, username):
-                        response = {'type': 'room_created', 'success': True, 'room': room_name}
-                    else:
-                        response = {'type': 'room_created', 'success': False, 'error': 'Room already exists'}
-                    encrypted_response = self.encrypt_message(json.dumps(response))
-                    client_socket.send(encrypted_response.encode())
+                session.received_bytes += len(chunk)
+                session.last_seen = time.monotonic()
+                for frame in decoder.feed(chunk):
+                    pending = self.process_data(session, frame)
+                    if pending is not None:
+                        pending.result()
                     
         except Exception as e:
             print(f"Error handling client {address}: {e}")
         finally:
-            if client_socket in self.clients:
-                del self.clients[client_socket]
-            if current_room and current_room in self.rooms and client_socket in self.rooms[current_room]:
-                self.rooms[current_room].remove(client_socket)
-                # Notify others about user leaving
-                if username:
-                    leave_msg = {
-                        'type': 'user_left',
-                        'username': username,
-                        'room': current_room,
-                        'timestamp': datetime.now().isoformat()
-                    }
-                    self.broadcast_to_room(current_room, leave_msg)
-            client_socket.close()
+            self.close_session(session)
+            
+    async def handle_async_client(self, reader, writer):
+        """Handle individual client connection (asyncio mode)"""
+        address = writer.get_extra_info('peername')
+        print(f"New connection from {address}")
+        sock = writer.get_extra_info('socket')
+        if sock is not None:
+            enable_keepalive(sock)
+        session = AsyncSession(writer, address, **self.session_options)
+        self.open_session(session)
+        decoder = FrameDecoder()
+        
+        try:
+            while True:
+                chunk = await reader.read(65536)
+                if not chunk:
+                    break
+                session.received_bytes += len(chunk)
+                session.last_seen = time.monotonic()
+                for frame in decoder.feed(chunk):
+                    pending = self.process_data(session, frame)
+                    if pending is not None:
+                        await asyncio.wrap_future(pending)
+                
+        except asyncio.CancelledError:
+            # The loop is shutting down; returning spares a traceback per connection
+            pass
+        except Exception as e:
+            print(f"Error handling client {address}: {e}")
+        finally:
+            self.close_session(session)
             
     def start_server(self):
-        """Start the chat server"""
+        """Start the chat server with one thread per connection"""
         server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.worker_count > 1:
+            # Every worker listens on the same port and the kernel spreads connections
+            server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         server_socket.bind((self.host, self.port))
         server_socket.listen(5)
         
-        print(f"Chat server started on {self.host}:{self.port}")
+        print(f"Chat server started on {self.host}:{self.port}{self.worker_label()}")
         print(f"Encryption key: {self.encryption_key.decode()}")
         
         try:
+            self.start_bus()
+            self.start_metrics()
             while True:
                 client_socket, address = server_socket.accept()
                 print(f"New connection from {address}")
@@ -288,8 +1255,255 @@ class ChatServer:
             print("\nServer shutting down...")
         finally:
             server_socket.close()
-            self.conn.close()
+            self.shutdown()
+            
+    async def serve_async(self):
+        """Accept connections on a single asyncio event loop"""
+        server = await asyncio.start_server(
+            self.handle_async_client, self.host, self.port,
+            reuse_address=True, reuse_port=self.worker_count > 1, backlog=1024
+        )
+        
+        print(f"Chat server started on {self.host}:{self.port} (asyncio mode){self.worker_label()}")
+        print(f"Encryption key: {self.encryption_key.decode()}")
+        self.start_bus()
+        self.start_metrics()
+        if self.worker_count > 1:
+            # Stop between callbacks rather than raising inside whatever handler runs
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+        
+        async with server:
+            await server.serve_forever()
+            
+    def start_async_server(self):
+        """Start the chat server on an asyncio event loop"""
+        try:
+            asyncio.run(self.serve_async())
+        except (KeyboardInterrupt, asyncio.CancelledError):
+            print("\nServer shutting down...")
+        finally:
+            self.shutdown()
+            
+    def start_metrics(self):
+        """Serve the metrics registry over HTTP if a port was given"""
+        if self.metrics_port is None:
+            return
+        # Each worker has its own registry, so each gets its own port
+        port = self.metrics_port + self.worker_index
+        self.metrics_server = MetricsServer(self.metrics, self.host, port)
+        self.metrics_server.start()
+        print(f"Metrics on http://{self.host}:{port}/metrics{self.worker_label()}")
+        
+    def worker_label(self):
+        if self.worker_count > 1:
+            return f" [worker {self.worker_index + 1}/{self.worker_count}]"
+        return ""
+        
+    def shutdown(self):
+        """Flush pending messages and close the database"""
+        if self.bus is not None:
+            self.bus.close()
+        if self.metrics_server is not None:
+            self.metrics_server.close()
+        if self.heartbeat is not None:
+            self.heartbeat.close()
+        self.room_directory.close()
+        if self.retention_job is not None:
+            self.retention_job.close()
+        self.auth_pool.shutdown()
+        self.search_pool.shutdown()
+        self.db_pool.shutdown()
+        # Pending thumbnails still post their messages, so this goes before the writer
+        self.thumbnailer.shutdown()
+        self.message_writer.close()
+        self.conn.close()
+
+def run_worker(index, workers, bus_path, mode, host, port, options):
+    """Entry point of one worker process in multi-process mode
+    
+    Ctrl+C reaches every process of the group, so workers ignore SIGINT and leave it
+    to the supervisor to stop them with a single SIGTERM, which in async mode the
+    event loop handles instead.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, stop_worker)
+    server = ChatServer(host, port, worker_index=index, worker_count=workers, bus_path=bus_path, **options)
+    if mode == 'async':
+        server.start_async_server()
+    else:
+        server.start_server()
+        
+def prepare_retention(db_path, options):
+    """Convert the database for incremental vacuum before any worker opens it"""
+    if not os.path.exists(db_path):
+        return
+    conn = sqlite3.connect(db_path)
+    try:
+        configured = options.get('retain_days') is not None or options.get('retain_messages') is not None
+        if not configured:
+            table = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'room_retention'").fetchone()
+            configured = table is not None and conn.execute("SELECT 1 FROM room_retention LIMIT 1").fetchone() is not None
+        if configured:
+            enable_incremental_vacuum(conn)
+    finally:
+        conn.close()
+        
+def interrupt(signum, frame):
+    raise KeyboardInterrupt
+    
+def stop_worker(signum, frame):
+    # Only the first SIGTERM interrupts; another one must not break off shutdown() midway
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    raise KeyboardInterrupt
+    
+def run_cluster(host, port, mode, workers, options):
+    """Run worker processes that share one port and database, linked by a local message bus
+    
+    The supervisor generates the secrets every worker must share, relays bus events
+    between workers and restarts any worker that dies.
+    """
+    options = dict(options)
+    options['encryption_key'] = options.get('encryption_key') or Fernet.generate_key()
+    # Tokens issued by one worker must validate on the others
+    options['token_secret'] = options.get('token_secret') or os.urandom(32).hex()
+    prepare_retention(options.get('db_path', 'chat_app.db'), options)
+    context = multiprocessing.get_context('spawn')
+    signal.signal(signal.SIGTERM, interrupt)
+    
+    with tempfile.TemporaryDirectory(prefix='chat-bus-') as bus_dir:
+        hub = BusHub(os.path.join(bus_dir, 'bus.sock'))
+        hub.start()
+        processes = {}
+        
+        def spawn(index):
+            process = context.Process(
+                target=run_worker,
+                args=(index, workers, hub.path, mode, host, port, options),
+                name=f'chat-worker-{index}'
+            )
+            process.start()
+            processes[index] = process
+            
+        print(f"Starting {workers} workers on {host}:{port} ({mode} mode)")
+        print(f"Encryption key: {options['encryption_key'].decode()}")
+        for index in range(workers):
+            spawn(index)
+        try:
+            while True:
+                time.sleep(1)
+                for index, process in list(processes.items()):
+                    if not process.is_alive():
+                        print(f"Worker {index + 1} exited with code {process.exitcode}, restarting")
+                        spawn(index)
+        except KeyboardInterrupt:
+            print("\nServer shutting down...")
+        finally:
+            # Workers flush their message writers on SIGTERM; only stragglers are killed
+            for process in processes.values():
+                if process.is_alive():
+                    process.terminate()
+            for process in processes.values():
+                process.join(10)
+                if process.is_alive():
+                    process.kill()
+            hub.close()
 
 if __name__ == "__main__":
-    server = ChatServer()
-    server.start_server()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Encrypted multi-room chat server")
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=12345)
+    parser.add_argument('--mode', choices=['async', 'threaded'], default='async',
+                        help="asyncio event loop (default) or one thread per connection")
+    parser.add_argument('--send-queue-size', type=int, default=256,
+                        help="frames buffered per client before the overflow policy applies")
+    parser.add_argument('--overflow-policy', choices=['drop_oldest', 'disconnect'], default='drop_oldest',
+                        help="what to do with a client whose send queue is full")
+    parser.add_argument('--max-drops', type=int, default=1000,
+                        help="frames a slow client may lose under drop_oldest before it is disconnected")
+    parser.add_argument('--coalesce-ms', type=float, default=2,
+                        help="longest a frame waits for others to share its socket write during bursts (0: never wait)")
+    parser.add_argument('--coalesce-bytes', type=int, default=64 * 1024,
+                        help="bytes per coalesced socket write")
+    parser.add_argument('--auth-workers', type=int, default=None,
+                        help="threads hashing passwords (default: up to 4)")
+    parser.add_argument('--max-pending-auth', type=int, default=256,
+                        help="queued logins/registrations before new ones are refused as busy")
+    parser.add_argument('--search-workers', type=int, default=2,
+                        help="threads running full-text searches")
+    parser.add_argument('--token-secret', default=os.environ.get('CHAT_TOKEN_SECRET'),
+                        help="secret signing session tokens (default: random per start)")
+    parser.add_argument('--token-ttl', type=int, default=3600,
+                        help="seconds a session token stays valid")
+    parser.add_argument('--no-compression', action='store_true',
+                        help="never compress payloads, even for clients that offer it")
+    parser.add_argument('--compression-threshold', type=int, default=256,
+                        help="payloads smaller than this many bytes are sent uncompressed")
+    parser.add_argument('--codec', choices=sorted(CODECS), default='binary',
+                        help="message encoding for clients that support it (json is easier to debug)")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="server processes sharing the port (SO_REUSEPORT) and database")
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help="serve Prometheus metrics over HTTP on this port (worker i uses port + i)")
+    parser.add_argument('--no-metrics', action='store_true',
+                        help="skip latency and message counters (gauges stay available)")
+    parser.add_argument('--admin', action='append', default=[],
+                        help="username allowed to request metrics, set retention and profile handlers over the chat protocol (repeatable)")
+    parser.add_argument('--retain-days', type=float, default=None,
+                        help="archive messages older than this many days (rooms may override)")
+    parser.add_argument('--retain-messages', type=int, default=None,
+                        help="keep at most this many messages per room in the database (rooms may override)")
+    parser.add_argument('--retention-interval', type=float, default=3600,
+                        help="seconds between retention runs")
+    parser.add_argument('--thumbnail-workers', type=int, default=None,
+                        help="threads making image thumbnails (default: up to 2)")
+    parser.add_argument('--rate-limit', type=parse_rate_limit, action='append', default=[],
+                        metavar='NAME=RATE/BURST',
+                        help="override a rate limit in requests per second, or NAME=off; limits: "
+                             + ', '.join(f"{name} ({rate:g}/{burst:g})" for name, (rate, burst) in DEFAULT_RATE_LIMITS.items()))
+    parser.add_argument('--no-rate-limits', action='store_true',
+                        help="do not rate limit clients at all")
+    parser.add_argument('--heartbeat-interval', type=float, default=30,
+                        help="ping clients that support heartbeats after this many quiet seconds (0: never)")
+    parser.add_argument('--idle-timeout', type=float, default=90,
+                        help="close such clients after this many seconds without hearing from them")
+    parser.add_argument('--room-update-interval', type=float, default=0.5,
+                        help="seconds over which room list changes are gathered into one update for clients")
+    parser.add_argument('--archive-dir', default=None,
+                        help="directory for archive segments (default: chat_archive next to the database)")
+    args = parser.parse_args()
+    
+    options = {
+        'send_queue_size': args.send_queue_size,
+        'overflow_policy': args.overflow_policy,
+        'max_drops': args.max_drops,
+        'coalesce_window': args.coalesce_ms / 1000,
+        'coalesce_bytes': args.coalesce_bytes,
+        'auth_workers': args.auth_workers,
+        'max_pending_auth': args.max_pending_auth,
+        'search_workers': args.search_workers,
+        'token_secret': args.token_secret,
+        'token_ttl': args.token_ttl,
+        'compression': not args.no_compression,
+        'compression_threshold': args.compression_threshold,
+        'codec': args.codec,
+        'metrics': not args.no_metrics,
+        'metrics_port': args.metrics_port,
+        'admins': args.admin,
+        'retain_days': args.retain_days,
+        'retain_messages': args.retain_messages,
+        'retention_interval': args.retention_interval,
+        'archive_dir': args.archive_dir,
+        'thumbnail_workers': args.thumbnail_workers,
+        'rate_limits': dict.fromkeys(DEFAULT_RATE_LIMITS) if args.no_rate_limits else dict(args.rate_limit),
+        'heartbeat_interval': args.heartbeat_interval,
+        'idle_timeout': args.idle_timeout,
+        'room_update_interval': args.room_update_interval
+    }
+    if args.workers > 1:
+        run_cluster(args.host, args.port, args.mode, args.workers, options)
+    else:
+        server = ChatServer(args.host, args.port, **options)
+        if args.mode == 'async':
+            server.start_async_server()
+        else:
+            server.start_server()
@@ -0,0 +1,275 @@
+import socket
+import threading
+import asyncio
+import time
+from abc import ABC, abstractmethod
+from collections import deque
+
+OVERFLOW_POLICIES = ('drop_oldest', 'disconnect')
+
+# Frames per vectored write; stays well below the IOV_MAX of common platforms
+MAX_WRITE_FRAMES = 512
+
+class ClientSession(ABC):
+    """Per-connection state plus a bounded outbound queue drained by the connection's own writer
+
+    send() only enqueues, so a stalled client never blocks the thread doing the fan-out.
+    When the queue is full the overflow policy decides: 'drop_oldest' discards the oldest
+    pending frame and disconnects once max_drops frames have been lost, 'disconnect'
+    drops the slow consumer straight away.
+
+    The writer sends every pending frame, up to coalesce_bytes, in one write. While
+    frames keep arriving in bursts it also waits a little before writing so that more
+    of the burst joins the write; the wait doubles per bursty write up to
+    coalesce_window seconds and halves back to nothing once frames trickle in one at
+    a time, so a quiet connection is never delayed.
+    """
+    def __init__(self, address, max_queue=256, overflow='drop_oldest', max_drops=1000,
+                 coalesce_window=0.002, coalesce_bytes=64 * 1024):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy: {overflow}")
+        self.address = address
+        self.username = None
+        self.current_room = None
+        self.uploads = {}
+        self.compression = None
+        self.wire_version = 1
+        self.codec = 'json'
+        self.max_queue = max_queue
+        self.overflow = overflow
+        self.max_drops = max_drops
+        self.coalesce_window = coalesce_window
+        self.coalesce_bytes = coalesce_bytes
+        self.window = 0.0
+        self.outbound = deque()
+        self.queued_bytes = 0
+        self.peak_depth = 0
+        self.sent_frames = 0
+        self.sent_bytes = 0
+        self.writes = 0
+        self.received_bytes = 0
+        # Monotonic time of the last bytes from the client; whether it answers pings
+        self.last_seen = time.monotonic()
+        self.heartbeat = False
+        self.dropped = 0
+        # Until when throttled requests are dropped without another notice
+        self.throttled_until = 0.0
+        self.evicted = False
+        self.closed = False
+        self.lock = threading.Lock()
+
+    def send(self, data):
+        """Queue one frame for the writer; raises ConnectionError once the session is closed"""
+        with self.lock:
+            if self.closed:
+                raise ConnectionError("Connection closed")
+            if len(self.outbound) >= self.max_queue:
+                if self.overflow == 'disconnect' or self.dropped >= self.max_drops:
+                    self.evicted = True
+                    evict = True
+                else:
+                    self.queued_bytes -= len(self.outbound.popleft())
+                    self.dropped += 1
+                    evict = False
+            else:
+                evict = False
+            if not evict:
+                self.outbound.append(data)
+                self.queued_bytes += len(data)
+                self.peak_depth = max(self.peak_depth, len(self.outbound))
+
+        if evict:
+            self.close()
+            raise ConnectionError("Slow consumer disconnected")
+        self.wake_writer()
+
+    def take_frames(self):
+        """Pop the pending frames for one write, at least one and up to coalesce_bytes"""
+        with self.lock:
+            frames = []
+            size = 0
+            while self.outbound and len(frames) < MAX_WRITE_FRAMES:
+                if frames and size + len(self.outbound[0]) > self.coalesce_bytes:
+                    break
+                data = self.outbound.popleft()
+                frames.append(data)
+                size += len(data)
+            self.queued_bytes -= size
+            if frames:
+                self.sent_frames += len(frames)
+                self.sent_bytes += size
+                self.writes += 1
+                self.adapt(len(frames) > 1 or bool(self.outbound))
+            return frames
+
+    def adapt(self, bursty):
+        """Widen the coalescing window while writes find a backlog, narrow it otherwise"""
+        floor = self.coalesce_window / 16
+        if bursty:
+            self.window = min(self.coalesce_window, max(self.window * 2, floor))
+        elif self.window > floor:
+            self.window /= 2
+        else:
+            self.window = 0.0
+
+    def coalescing(self):
+        """Whether the writer should keep waiting for more frames before writing"""
+        return self.window > 0 and self.queued_bytes < self.coalesce_bytes and not self.closed
+
+    def wire_format(self):
+        """Key identifying how frames for this client are encoded"""
+        return (self.codec, self.wire_version, self.compression)
+
+    def depth(self):
+        """Number of frames waiting to be written"""
+        return len(self.outbound)
+
+    def close(self):
+        """Stop the writer and close the transport"""
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.outbound.clear()
+            self.queued_bytes = 0
+        self.wake_writer()
+        self.close_transport()
+
+    @abstractmethod
+    def start(self):
+        """Start the writer that drains the queue"""
+
+    @abstractmethod
+    def wake_writer(self):
+        """Tell the writer there are frames to send or that the session closed"""
+
+    @abstractmethod
+    def close_transport(self):
+        """Close the connection underneath the session"""
+
+class ThreadedSession(ClientSession):
+    """Session over a blocking socket, drained by a dedicated writer thread"""
+    def __init__(self, sock, address, **options):
+        super().__init__(address, **options)
+        self.sock = sock
+        self.ready = threading.Condition(self.lock)
+        self.writer_thread = threading.Thread(target=self.write_loop)
+        self.writer_thread.daemon = True
+
+    def start(self):
+        self.writer_thread.start()
+
+    def wake_writer(self):
+        with self.ready:
+            self.ready.notify()
+
+    def write_loop(self):
+        """Write queued frames until the session closes"""
+        try:
+            while True:
+                with self.ready:
+                    while not self.outbound and not self.closed:
+                        self.ready.wait()
+                    deadline = time.monotonic() + self.window
+                    while self.coalescing():
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        self.ready.wait(remaining)
+                    if self.closed:
+                        return
+                frames = self.take_frames()
+                if frames:
+                    self.write_frames(frames)
+        except OSError:
+            self.close()
+
+    def write_frames(self, frames):
+        """Send frames with one vectored write where the platform has sendmsg"""
+        if len(frames) == 1 or not hasattr(self.sock, 'sendmsg'):
+            self.sock.sendall(b''.join(frames))
+            return
+        sent = self.sock.sendmsg(frames)
+        if sent < sum(map(len, frames)):
+            self.sock.sendall(b''.join(frames)[sent:])
+
+    def close_transport(self):
+        try:
+            # shutdown() unblocks both the reader's recv and a writer stuck in sendall
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+class AsyncSession(ClientSession):
+    """Session over an asyncio StreamWriter, drained by a writer task on the event loop
+
+    send() from any other thread (e.g. a worker pool) is handed over to the loop.
+    """
+    def __init__(self, writer, address, **options):
+        super().__init__(address, **options)
+        self.writer = writer
+        self.ready = asyncio.Event()
+        self.writer_task = None
+        self.loop = None
+        self.loop_thread = None
+
+    def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread = threading.get_ident()
+        self.writer_task = self.loop.create_task(self.write_loop())
+
+    def send(self, data):
+        if threading.get_ident() != self.loop_thread:
+            if self.closed:
+                raise ConnectionError("Connection closed")
+            self.loop.call_soon_threadsafe(self.send_from_loop, data)
+            return
+        super().send(data)
+
+    def close(self):
+        # Closing touches the transport and the writer's event, which belong to the loop
+        if self.loop is not None and threading.get_ident() != self.loop_thread:
+            try:
+                self.loop.call_soon_threadsafe(super().close)
+            except RuntimeError:
+                pass
+            return
+        super().close()
+
+    def send_from_loop(self, data):
+        try:
+            super().send(data)
+        except ConnectionError:
+            pass
+
+    def wake_writer(self):
+        self.ready.set()
+
+    async def write_loop(self):
+        """Write queued frames, waiting for the transport to drain between writes"""
+        try:
+            while not self.closed:
+                await self.ready.wait()
+                self.ready.clear()
+                if self.coalescing():
+                    # send() sets ready for every frame; the timer ends the wait at the latest
+                    timer = self.loop.call_later(self.window, self.ready.set)
+                    while self.coalescing():
+                        await self.ready.wait()
+                        self.ready.clear()
+                        if self.loop.time() >= timer.when():
+                            break
+                    timer.cancel()
+                frames = self.take_frames()
+                while frames and not self.closed:
+                    # One transport write, so one send syscall, for the whole batch
+                    self.writer.write(b''.join(frames))
+                    await self.writer.drain()
+                    frames = self.take_frames()
+        except (ConnectionError, OSError):
+            self.close()
+
+    def close_transport(self):
+        # abort() rather than close(): a slow consumer would never let close() flush
+        self.writer.transport.abort()
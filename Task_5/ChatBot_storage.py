@@ -0,0 +1,256 @@
+import sqlite3
+import threading
+import queue
+import time
+from collections import OrderedDict, deque
+
+INSERT_MESSAGES = ("INSERT INTO messages (id, room, username, message, message_type, timestamp, seq) "
+                   "VALUES (?, ?, ?, ?, ?, ?, ?)")
+# Backoff between attempts while the database stays locked, in seconds
+RETRY_DELAY = 0.05
+MAX_RETRY_DELAY = 2.0
+# Attempts left for a batch once the server is shutting down, so close() cannot hang
+CLOSE_RETRIES = 5
+
+class MessageWriter:
+    """Write-behind persistence stage that group-commits chat messages on its own thread"""
+    def __init__(self, db_path, batch_size=256, flush_interval=0.05, on_commit=None, busy_timeout=30):
+        self.db_path = db_path
+        self.busy_timeout = busy_timeout
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        # Called with (rows, seconds) after every committed batch
+        self.on_commit = on_commit
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, name='message-writer')
+        self.thread.daemon = True
+        self.closed = False
+
+    def start(self):
+        """Start the writer thread"""
+        self.thread.start()
+
+    def submit(self, message_id, room, username, message, message_type, timestamp, seq=None):
+        """Queue a message for the next batch; never blocks on disk"""
+        if self.closed:
+            raise RuntimeError("Message writer is closed")
+        self.queue.put((message_id, room, username, message, message_type, timestamp, seq))
+
+    def flush(self, timeout=None):
+        """Block until everything submitted so far has been committed"""
+        done = threading.Event()
+        self.queue.put(done)
+        return done.wait(timeout)
+
+    def pending(self):
+        """Messages waiting to be written"""
+        return self.queue.qsize()
+
+    def close(self):
+        """Commit any queued messages and stop the writer thread"""
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(None)
+        self.thread.join()
+
+    def run(self):
+        """Drain the queue, committing once per batch instead of once per message"""
+        conn = sqlite3.connect(self.db_path, timeout=self.busy_timeout)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        running = True
+
+        while running:
+            item = self.queue.get()
+            batch = []
+            waiters = []
+            deadline = time.monotonic() + self.flush_interval
+
+            # Collect until the batch is full, the time window closes, or a flush/close is requested
+            while True:
+                if item is None:
+                    running = False
+                    break
+                if isinstance(item, threading.Event):
+                    waiters.append(item)
+                    break
+                batch.append(item)
+                if len(batch) >= self.batch_size:
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self.queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+
+            if batch:
+                try:
+                    started = time.perf_counter()
+                    written = self.write_batch(conn, batch)
+                    if self.on_commit and written:
+                        self.on_commit(written, time.perf_counter() - started)
+                except sqlite3.Error as e:
+                    print(f"Error persisting {len(batch)} messages: {e}")
+
+            for waiter in waiters:
+                waiter.set()
+
+        conn.close()
+
+    def write_batch(self, conn, batch):
+        """Commit a batch; returns the number of rows written
+
+        The messages were already broadcast and cached, so a batch is never dropped
+        as a whole: a row the database rejects is skipped on its own.
+        """
+        try:
+            return self.insert(conn, batch)
+        except sqlite3.IntegrityError:
+            written = 0
+            for row in batch:
+                try:
+                    written += self.insert(conn, [row])
+                except sqlite3.IntegrityError as e:
+                    print(f"Dropping message {row[0]} in {row[1]}: {e}")
+            return written
+
+    def insert(self, conn, rows):
+        """Insert and commit rows, retrying with backoff while the database is locked"""
+        delay = RETRY_DELAY
+        attempts = 0
+        while True:
+            try:
+                conn.executemany(INSERT_MESSAGES, rows)
+                conn.commit()
+                return len(rows)
+            except sqlite3.OperationalError as e:
+                conn.rollback()
+                attempts += 1
+                if self.closed and attempts >= CLOSE_RETRIES:
+                    raise
+                print(f"Retrying {len(rows)} messages in {delay:g}s: {e}")
+                time.sleep(delay)
+                delay = min(delay * 2, MAX_RETRY_DELAY)
+            except sqlite3.Error:
+                conn.rollback()
+                raise
+
+class RoomHistoryCache:
+    """In-memory ring buffer of the most recent messages of each room
+
+    A room is warmed from the database on first access and then kept current by
+    append(). Rooms are evicted least-recently-used when the room or byte caps are
+    exceeded, and dropped after idle_timeout seconds without access.
+    """
+    def __init__(self, loader, capacity=50, max_rooms=1000, max_bytes=64 * 1024 * 1024, idle_timeout=900):
+        self.loader = loader
+        self.capacity = capacity
+        self.max_rooms = max_rooms
+        self.max_bytes = max_bytes
+        self.idle_timeout = idle_timeout
+        self.rooms = OrderedDict()
+        self.room_bytes = {}
+        self.last_access = {}
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def row_size(row):
+        """Approximate memory held by a cached (id, username, message, type, timestamp, seq) row"""
+        return len(row[2]) + len(row[1]) + 64
+
+    def recent(self, room):
+        """Return the cached rows of a room oldest-first, loading it on a miss"""
+        with self.lock:
+            buffer = self.get_buffer(room)
+            return list(buffer)
+
+    def append(self, room, row):
+        """Record a newly posted message in its room's ring buffer"""
+        with self.lock:
+            buffer = self.get_buffer(room)
+            if len(buffer) == self.capacity:
+                self.account(room, -self.row_size(buffer.popleft()))
+            buffer.append(row)
+            self.account(room, self.row_size(row))
+            self.evict()
+
+    def merge(self, room, row):
+        """Record a message posted elsewhere, which may arrive after newer local ones
+
+        The row is inserted in id order and ignored if already cached or older than
+        everything a full buffer holds.
+        """
+        with self.lock:
+            buffer = self.get_buffer(room)
+            position = len(buffer)
+            while position and buffer[position - 1][0] >= row[0]:
+                if buffer[position - 1][0] == row[0]:
+                    return
+                position -= 1
+            if len(buffer) == self.capacity:
+                if position == 0:
+                    return
+                self.account(room, -self.row_size(buffer.popleft()))
+                position -= 1
+            buffer.insert(position, row)
+            self.account(room, self.row_size(row))
+            self.evict()
+
+    def discard(self, room):
+        """Forget a room so the next access reloads it"""
+        with self.lock:
+            self.drop(room)
+
+    def get_buffer(self, room):
+        """Return the ring buffer of a room, warming it from the loader if needed"""
+        now = time.monotonic()
+        buffer = self.rooms.get(room)
+        if buffer is None:
+            self.misses += 1
+            buffer = deque(self.loader(room, self.capacity), maxlen=self.capacity)
+            self.rooms[room] = buffer
+            self.room_bytes[room] = 0
+            self.last_access[room] = now
+            self.account(room, sum(self.row_size(row) for row in buffer))
+            self.evict()
+        else:
+            self.hits += 1
+            self.rooms.move_to_end(room)
+            self.last_access[room] = now
+        return buffer
+
+    def account(self, room, size):
+        self.room_bytes[room] += size
+        self.total_bytes += size
+
+    def drop(self, room):
+        if room in self.rooms:
+            del self.rooms[room]
+            del self.last_access[room]
+            self.total_bytes -= self.room_bytes.pop(room)
+
+    def evict(self):
+        """Drop idle rooms, then least-recently-used rooms until under both caps"""
+        now = time.monotonic()
+        for room in list(self.rooms):
+            if now - self.last_access[room] <= self.idle_timeout:
+                break
+            self.drop(room)
+        while len(self.rooms) > 1 and (len(self.rooms) > self.max_rooms or self.total_bytes > self.max_bytes):
+            self.drop(next(iter(self.rooms)))
+
+    def stats(self):
+        """Cache occupancy and hit counters"""
+        with self.lock:
+            return {
+                'rooms': len(self.rooms),
+                'bytes': self.total_bytes,
+                'hits': self.hits,
+                'misses': self.misses
+            }
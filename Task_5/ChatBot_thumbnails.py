@@ -0,0 +1,128 @@
+import io
+import json
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+THUMBNAIL_SIZE = (300, 300)
+# Formats worth decoding; anything else is recorded as "no thumbnail" from its first bytes
+IMAGE_SIGNATURES = (b'\x89PNG\r\n\x1a\n', b'\xff\xd8\xff', b'GIF87a', b'GIF89a', b'BM')
+
+def looks_like_image(head):
+    return head.startswith(IMAGE_SIGNATURES) or (head[:4] == b'RIFF' and head[8:12] == b'WEBP')
+
+class Thumbnailer:
+    """Makes a small preview of each stored image once, on a worker pool
+
+    A thumbnail is a blob of its own, so clients fetch it like any other file and only
+    download the original when it is opened. The outcome for each original (its
+    thumbnail, or that it has none) is kept in a JSON file next to the blobs, so every
+    image is decoded once however often it is posted, across restarts and workers.
+    Without Pillow nothing is thumbnailed and clients fall back to the original.
+    """
+    def __init__(self, blob_store, workers=None, size=THUMBNAIL_SIZE):
+        self.blob_store = blob_store
+        self.size = size
+        self.enabled = Image is not None
+        self.directory = os.path.join(blob_store.root, 'thumbnails')
+        os.makedirs(self.directory, exist_ok=True)
+        self.workers = workers or min(2, os.cpu_count() or 1)
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='thumbnail')
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.generated = 0
+        self.failed = 0
+
+    def record_path(self, sha256):
+        return os.path.join(self.directory, sha256[:2], f"{sha256}.json")
+
+    def lookup(self, sha256):
+        """(known, info) for a blob; info is None when the blob has no thumbnail"""
+        try:
+            with open(self.record_path(sha256)) as f:
+                return True, json.load(f) or None
+        except (OSError, ValueError):
+            return False, None
+
+    def submit(self, sha256):
+        """Future of a stored blob's thumbnail info, generating it if needed
+
+        The info is {'sha256', 'width', 'height', 'size', 'mime_type'} of the thumbnail
+        blob, or None for blobs that are not images or too small to be worth it.
+        """
+        future = Future()
+        if not self.enabled or not self.blob_store.exists(sha256):
+            future.set_result(None)
+            return future
+        known, info = self.lookup(sha256)
+        if known:
+            future.set_result(info)
+            return future
+        with self.lock:
+            running = self.pending.get(sha256)
+            if running is not None:
+                return running
+            self.pending[sha256] = future = self.executor.submit(self.generate, sha256)
+        future.add_done_callback(lambda f: self.forget(sha256))
+        return future
+
+    def forget(self, sha256):
+        with self.lock:
+            self.pending.pop(sha256, None)
+
+    def generate(self, sha256):
+        """Decode, shrink and store one image; runs on the pool"""
+        path = self.blob_store.path(sha256)
+        with open(path, 'rb') as f:
+            head = f.read(16)
+        info = None
+        if looks_like_image(head):
+            try:
+                data, width, height, mime_type = self.render(path)
+                # Small originals are cheaper to send as they are
+                if len(data) < self.blob_store.size(sha256):
+                    info = {
+                        'sha256': self.blob_store.put_bytes(data),
+                        'width': width,
+                        'height': height,
+                        'size': len(data),
+                        'mime_type': mime_type
+                    }
+                    self.generated += 1
+            except (OSError, ValueError, Image.DecompressionBombError) as e:
+                print(f"Could not thumbnail {sha256}: {e}")
+                self.failed += 1
+        self.save_record(sha256, info)
+        return info
+
+    def render(self, path):
+        """Encoded thumbnail of an image file as (data, width, height, mime_type)"""
+        with Image.open(path) as image:
+            # Lets the JPEG decoder skip straight to roughly the target size
+            image.draft('RGB', self.size)
+            image.thumbnail(self.size)
+            if image.mode in ('RGBA', 'LA') or 'transparency' in image.info:
+                image = image.convert('RGBA')
+                image_format, mime_type = 'PNG', 'image/png'
+            else:
+                image = image.convert('RGB')
+                image_format, mime_type = 'JPEG', 'image/jpeg'
+            out = io.BytesIO()
+            image.save(out, image_format, quality=80, optimize=True)
+        return out.getvalue(), image.width, image.height, mime_type
+
+    def save_record(self, sha256, info):
+        path = self.record_path(sha256)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        part = f"{path}.{threading.get_ident()}.part"
+        with open(part, 'w') as f:
+            json.dump(info or {}, f)
+        os.replace(part, path)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)